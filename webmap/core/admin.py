@@ -7,7 +7,48 @@ from django.utils.translation import ngettext
 from django.db.models import Max
 
 from . import models
-from . import views
+from . import tasks
+
+class ActiveSpectralFitAdmin(admin.ModelAdmin):
+    list_display = ('pulsar', 'spectrum_model_name', 'parameters', 'errors',)
+    search_fields = ('pulsar__bname', 'pulsar__jname')
+    list_filter = ('spectrum_model_name',)
+    readonly_fields = ('pulsar', 'spectrum_model_name', 'parameters', 'errors', 'covariance',)
+
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'task', 'status', 'progress', 'message', 'requested_by', 'created', 'duration',)
+    list_filter = ('status', 'task',)
+    readonly_fields = [field.name for field in models.BackgroundJob._meta.fields] + ['progress', 'duration']
+    actions = ['cancel']
+
+    def has_add_permission(self, request):
+        # Jobs are queued by admin actions
+        return False
+
+    @admin.display(description="Progress")
+    def progress(self, obj):
+        if obj.progress_total:
+            return format_html(
+                '<progress value="{done}" max="{total}"></progress> {done}/{total}',
+                done=obj.progress_done,
+                total=obj.progress_total,
+            )
+        return obj.progress_done or ""
+
+    @admin.action(description="Cancel selected jobs (if not yet started)")
+    def cancel(self, request, queryset):
+
+        num_cancelled = queryset.filter(status=models.BackgroundJob.QUEUED).update(status=models.BackgroundJob.CANCELLED)
+
+        self.message_user(
+            request,
+            ngettext(
+                "%d job cancelled.",
+                "%d jobs cancelled.",
+                num_cancelled,
+            ) % num_cancelled,
+            messages.SUCCESS,
+        )
 
 class ATNFFluxMeasurementAdmin(admin.ModelAdmin):
     list_display = ('id', 'pulsar', 'freq', 'flux_str',)
@@ -34,49 +75,48 @@ class PulsarAdmin(admin.ModelAdmin):
     def construct_ephemeris_link(self, obj):
         url = reverse('construct_ephemeris', kwargs={"pk": obj.pk})
         return format_html('<a href="{url}">Construct ephemeris</a>', url=url)
+    '''
 
-    actions = ['set_atnf_power_laws', 'set_atnf_power_laws_force']
-
-    @admin.action(description="Set to ATNF simple power law")
-    def set_atnf_power_laws(self, request, queryset):
-
-        num_set = 0
+    actions = ['set_atnf_power_laws', 'set_atnf_power_laws_force', 'update_atnf_fluxes', 'regenerate_caches']
 
-        for pulsar in queryset.all():
+    def enqueue(self, request, task_name, **arguments):
+        '''
+        Queues a background job for the selected pulsars, to be run by a worker
+        (python manage.py run_worker) rather than inside this request
+        '''
 
-            if views.set_atnf_power_law(pulsar):
-                num_set += 1
+        background_job = tasks.enqueue(task_name, requested_by=request.user, **arguments)
+        url = reverse('admin:core_backgroundjob_change', args=[background_job.pk])
 
         self.message_user(
             request,
-            ngettext(
-                "%d pulsar updated.",
-                "%d pulsars updated.",
-                num_set,
-            ) % num_set,
+            format_html(
+                'Queued <a href="{url}">{job}</a>. Its progress is shown in the <a href="{list_url}">background jobs</a>.',
+                url=url,
+                job=background_job,
+                list_url=reverse('admin:core_backgroundjob_changelist'),
+            ),
             messages.SUCCESS,
         )
 
-    @admin.action(description="Set to ATNF simple power law (force)")
-    def set_atnf_power_laws_force(self, request, queryset):
+    def pulsar_ids(self, queryset):
+        return list(queryset.order_by().values_list('pk', flat=True))
 
-        num_set = 0
+    @admin.action(description="Set to ATNF simple power law")
+    def set_atnf_power_laws(self, request, queryset):
+        self.enqueue(request, 'set_atnf_power_laws', pulsar_ids=self.pulsar_ids(queryset))
 
-        for pulsar in queryset.all():
+    @admin.action(description="Set to ATNF simple power law (force)")
+    def set_atnf_power_laws_force(self, request, queryset):
+        self.enqueue(request, 'set_atnf_power_laws', pulsar_ids=self.pulsar_ids(queryset), overwrite=True)
 
-            if views.set_atnf_power_law(pulsar, overwrite=True):
-                num_set += 1
+    @admin.action(description="Re-import ATNF flux densities")
+    def update_atnf_fluxes(self, request, queryset):
+        self.enqueue(request, 'update_atnf_fluxes', pulsar_ids=self.pulsar_ids(queryset))
 
-        self.message_user(
-            request,
-            ngettext(
-                "%d pulsar updated.",
-                "%d pulsars updated.",
-                num_set,
-            ) % num_set,
-            messages.SUCCESS,
-        )
-    '''
+    @admin.action(description="Regenerate cached data")
+    def regenerate_caches(self, request, queryset):
+        self.enqueue(request, 'regenerate_caches', pulsar_ids=self.pulsar_ids(queryset))
 
 class PulsarMentionAdmin(admin.ModelAdmin):
     list_display = ('id', 'pulsar', 'bibtex', 'importance',)
@@ -94,6 +134,11 @@ class PulsarPropertyMeasurementAdmin(admin.ModelAdmin):
         ('bibtex', admin.RelatedOnlyFieldListFilter),
     )
 
+class SpectralFitCovarianceAdmin(admin.ModelAdmin):
+    list_display = ('id', 'pulsar', 'spectrum_model', 'parameter_names',)
+    search_fields = ('pulsar__bname', 'pulsar__jname')
+    list_filter = ('spectrum_model',)
+
 class SpectrumModelAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'pulsar_spectra_name',)
 
@@ -101,13 +146,15 @@ class SpectrumModelParameterAdmin(admin.ModelAdmin):
     list_display = ('id', 'spectrum_model', 'name',)
 
 class SpectralFitAdmin(admin.ModelAdmin):
-    list_display = ('id', 'pulsar', 'parameter', 'value',)
+    list_display = ('id', 'pulsar', 'parameter', 'value', 'error',)
     search_fields = ('pulsar__bname', 'pulsar__jname')
 
     def model_name(self, obj):
         return f"{obj.parameter.spectrum_model}"
 
 
+admin.site.register(models.ActiveSpectralFit, ActiveSpectralFitAdmin)
+admin.site.register(models.BackgroundJob, BackgroundJobAdmin)
 admin.site.register(models.ATNFFluxMeasurement, ATNFFluxMeasurementAdmin)
 admin.site.register(models.Pulsar, PulsarAdmin)
 admin.site.register(models.PulsarMention, PulsarMentionAdmin)
@@ -116,3 +163,4 @@ admin.site.register(models.PulsarPropertyMeasurement, PulsarPropertyMeasurementA
 admin.site.register(models.SpectrumModel, SpectrumModelAdmin)
 admin.site.register(models.SpectrumModelParameter, SpectrumModelParameterAdmin)
 admin.site.register(models.SpectralFit, SpectralFitAdmin)
+admin.site.register(models.SpectralFitCovariance, SpectralFitCovarianceAdmin)
@@ -0,0 +1,406 @@
+'''
+A benchmark harness for the start-up of a web worker, the map view, the ATNF
+ingestion functions, the ATNF power law fitting, and the admin changelists.
+
+Everything here runs against a synthetic catalogue in a throwaway test
+database (see the "benchmark" management command), with a fake psrcat
+executable standing in for the real ATNF catalogue.
+'''
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from . import ingest
+from . import models
+from . import snapshot
+import literature.models as literature_models
+
+import contextlib
+import io
+import json
+import os
+import stat
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+# The frequencies (MHz) of the ATNF flux density columns, in the order that
+# update_atnf_fluxes() asks psrcat for them
+ATNF_FREQS = ingest.ATNF_FLUX_FREQS
+
+# psrcat -v prints something like "Software version: 2.1.1 Catalogue version number = 2.5.1"
+PSRCAT_VERSION = "Catalogue version number = 0.0.0-synthetic"
+
+PSRCAT_STUB = '''#!{python}
+import sys
+here = {here!r}
+if "-v" in sys.argv:
+    print({version!r})
+elif any("S1400" in arg for arg in sys.argv):
+    sys.stdout.write(open(here + "/fluxes.txt").read())
+else:
+    sys.stdout.write(open(here + "/pulsars.txt").read())
+'''
+
+# Ranges of plausible values for each spectrum model parameter
+PARAMETER_GENERATORS = {
+    'a': lambda rng: rng.normal(-1.6, 0.5),
+    'a1': lambda rng: rng.normal(-1.0, 0.5),
+    'a2': lambda rng: rng.normal(-2.0, 0.5),
+    'b': lambda rng: rng.normal(-0.5, 0.2),
+    'beta': lambda rng: rng.uniform(0.5, 2.1),
+    'c': lambda rng: 10**rng.uniform(-3, 0),
+    'v0': lambda rng: 10**rng.uniform(8, 9.5),
+    'vb': lambda rng: 10**rng.uniform(8, 9.5),
+    'vc': lambda rng: 10**rng.uniform(9, 10.5),
+    'vpeak': lambda rng: 10**rng.uniform(7.5, 8.5),
+}
+
+
+class FakePsrcat:
+    '''
+    Writes a psrcat stand-in for the synthetic catalogue into a temporary
+    directory, which is put at the front of PATH while in use.
+    '''
+
+    def __init__(self, num_pulsars, fluxes_per_pulsar, seed=0):
+        self.num_pulsars = num_pulsars
+        self.fluxes_per_pulsar = min(fluxes_per_pulsar, len(ATNF_FREQS))
+        self.rng = np.random.default_rng(seed)
+
+    def pulsars_txt(self):
+        lines = []
+        for i in range(self.num_pulsars):
+            bname = f"B{i:07d}" if i % 3 == 0 else "*"
+            jname = f"J{i:07d}"
+            ra, dec = self.rng.uniform(0, 360), np.degrees(np.arcsin(self.rng.uniform(-1, 1)))
+            p0 = 10**self.rng.uniform(-2.5, 0.5)
+            dm = 10**self.rng.uniform(0, 3)
+            rm = self.rng.normal(0, 100)
+            lines.append(
+                f"{bname} {jname} {ra:.6f} 0 {dec:.6f} 0 {p0:.10f} 1e-12 {dm:.3f} 0.1 {rm:.2f} 1"
+            )
+        return "\n".join(lines) + "\n"
+
+    def fluxes_txt(self):
+        lines = []
+        for i in range(self.num_pulsars):
+            bname = f"B{i:07d}" if i % 3 == 0 else "*"
+            jname = f"J{i:07d}"
+            tokens = ["*"] * (max(ingest.ATNF_ERROR_COLS[-1], ingest.ATNF_FLUX_COLS[-1]) + 1)
+            tokens[0], tokens[1] = bname, jname
+
+            chosen = self.rng.choice(len(ATNF_FREQS), size=self.fluxes_per_pulsar, replace=False)
+            S1400 = 10**self.rng.uniform(-1, 2)
+            alpha = self.rng.normal(-1.6, 0.5)
+            for j in chosen:
+                flux = S1400 * (ATNF_FREQS[j]/1400)**alpha
+                tokens[ingest.ATNF_FLUX_COLS[j]] = f"{flux:.4f}"
+                if ingest.ATNF_ERROR_COLS[j] is not None:
+                    tokens[ingest.ATNF_ERROR_COLS[j]] = f"{0.1*flux:.4f}"
+            lines.append(" ".join(tokens))
+        return "\n".join(lines) + "\n"
+
+    def __enter__(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        here = self.tmpdir.name
+
+        with open(os.path.join(here, "pulsars.txt"), "w") as f:
+            f.write(self.pulsars_txt())
+        with open(os.path.join(here, "fluxes.txt"), "w") as f:
+            f.write(self.fluxes_txt())
+
+        stub = os.path.join(here, "psrcat")
+        with open(stub, "w") as f:
+            f.write(PSRCAT_STUB.format(python=sys.executable, here=here, version=PSRCAT_VERSION))
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IEXEC)
+
+        self.old_path = os.environ.get("PATH", "")
+        os.environ["PATH"] = here + os.pathsep + self.old_path
+        return self
+
+    def __exit__(self, *exc):
+        os.environ["PATH"] = self.old_path
+        self.tmpdir.cleanup()
+
+
+def generate_catalogue(fits_per_pulsar=1, num_bibtex=50, measurements_per_pulsar=2, seed=0):
+    '''
+    Adds synthetic spectral fits, BibTeX entries and property measurements to
+    the pulsars already in the database. Each pulsar gets fits for
+    fits_per_pulsar different (non-ATNF) spectrum models, the first of which
+    is selected as its spectrum model.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    if not models.SpectrumModel.objects.exists():
+        ingest.init_spectrum_models()
+
+    spectrum_models = list(
+        models.SpectrumModel.objects.exclude(name=ingest.ATNF_SIMPLE_POWER_LAW).prefetch_related('parameters')
+    )
+    pulsars = list(models.Pulsar.objects.all())
+
+    fits = []
+    for pulsar in pulsars:
+        chosen = rng.choice(len(spectrum_models), size=min(fits_per_pulsar, len(spectrum_models)), replace=False)
+        for k, i in enumerate(chosen):
+            spectrum_model = spectrum_models[i]
+            if k == 0:
+                pulsar.spectrum_model = spectrum_model
+            for parameter in spectrum_model.parameters.all():
+                fits.append(models.SpectralFit(
+                    pulsar=pulsar,
+                    parameter=parameter,
+                    value=PARAMETER_GENERATORS[parameter.name](rng),
+                ))
+
+    models.Pulsar.objects.bulk_update(pulsars, ['spectrum_model'], batch_size=1000)
+    models.SpectralFit.objects.bulk_create(fits, batch_size=1000)
+    models.ActiveSpectralFit.refresh()
+
+    # Literature (re-read after bulk_create, because MariaDB doesn't return the new primary keys)
+    literature_models.Author.objects.bulk_create([
+        literature_models.Author(first=f"A{i}", last=f"Author{i}") for i in range(max(3, num_bibtex))
+    ])
+    literature_models.Bibtex.objects.bulk_create([
+        literature_models.Bibtex(citekey=f"synthetic{i}", title=f"Paper {i}", year=str(1968 + i % 56))
+        for i in range(num_bibtex)
+    ])
+    authors = list(literature_models.Author.objects.order_by('id'))
+    bibtexs = list(literature_models.Bibtex.objects.order_by('id'))
+    literature_models.AuthorOrder.objects.bulk_create([
+        literature_models.AuthorOrder(bibtex=bibtex, author=authors[(i + order) % len(authors)], order=order)
+        for i, bibtex in enumerate(bibtexs)
+        for order in range(3)
+    ])
+
+    # Property measurements
+    properties = [
+        models.PulsarProperty.objects.get_or_create(name="Flux density", defaults={'symbol': "S", 'unit': "mJy"})[0],
+        models.PulsarProperty.objects.get_or_create(name="Spin frequency", defaults={'symbol': "ν", 'ephemeris_parameter_name': "F0", 'unit': "Hz"})[0],
+        models.PulsarProperty.objects.get_or_create(name="Dispersion measure", defaults={'symbol': "DM", 'ephemeris_parameter_name': "DM", 'unit': "pc/cm3"})[0],
+    ]
+    if bibtexs:
+        models.PulsarPropertyMeasurement.objects.bulk_create([
+            models.PulsarPropertyMeasurement(
+                pulsar=pulsar,
+                pulsar_property=properties[j % len(properties)],
+                value=f"{rng.uniform(1, 100):.6f}",
+                error=f"{rng.uniform(0.01, 1):.6f}",
+                freq_MHz=float(rng.choice(ATNF_FREQS)),
+                bandwidth_MHz=float(rng.uniform(1, 100)),
+                mjd=float(rng.uniform(40000, 60000)),
+                bibtex=bibtexs[int(rng.integers(len(bibtexs)))],
+            )
+            for pulsar in pulsars
+            for j in range(measurements_per_pulsar)
+        ], batch_size=1000)
+
+
+class QueryCounter:
+    '''
+    A database execute wrapper that counts queries. Unlike connection.queries,
+    this isn't capped, so it also works for the (many-query) ingestion functions.
+    '''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(func, repeat=1):
+    '''
+    Times func() over several repeats, and then runs it once more under
+    tracemalloc to find its peak (Python) memory usage.
+
+    Returns {"time_s": median wall time, "queries": query count, "peak_memory_MiB": ...}
+    '''
+
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'time_s': statistics.median(times),
+        'queries': counter.count,
+        'peak_memory_MiB': peak / 2**20,
+    }
+
+
+# What a web worker does before serving its first request: load the WSGI
+# application (which sets up Django, including the admin's autodiscovery), and
+# import the views of every URL
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+from django.urls import get_resolver
+get_resolver().url_patterns
+elapsed = time.perf_counter() - start
+with open("/proc/self/status") as f:
+    rss_kB = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+print(json.dumps({
+    "time_s": elapsed,
+    "rss_MiB": rss_kB / 1024,
+    "heavy_modules": sorted(name for name in HEAVY_MODULES if name in sys.modules),
+}))
+'''
+
+# Packages that the request path shouldn't need to import
+HEAVY_MODULES = ["astropy", "scipy", "matplotlib", "iminuit", "pulsar_spectra.catalogue", "pulsar_spectra.spectral_fit"]
+
+
+def measure_startup(repeat=1):
+    '''
+    Starts a fresh Python process as a web worker would (see STARTUP_SCRIPT),
+    several times over.
+
+    Returns {"time_s": median start-up time, "queries": 0, "peak_memory_MiB":
+    the worker's resident set size once started, "heavy_modules": the
+    HEAVY_MODULES it imported}
+    '''
+
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", f"HEAVY_MODULES = {HEAVY_MODULES!r}\n{STARTUP_SCRIPT}"],
+            # The project's directory, from which the settings module is imported
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    return {
+        'time_s': statistics.median(run['time_s'] for run in runs),
+        'queries': 0,
+        'peak_memory_MiB': statistics.median(run['rss_MiB'] for run in runs),
+        'heavy_modules': runs[-1]['heavy_modules'],
+    }
+
+
+def _get(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError(f"GET {url} returned {response.status_code}")
+    # Consume streaming responses too, so that their cost is included
+    return response.getvalue() if not response.streaming else b"".join(response.streaming_content)
+
+
+def run(num_pulsars=1000, fits_per_pulsar=2, fluxes_per_pulsar=4, num_bibtex=50,
+        measurements_per_pulsar=2, repeat=5, seed=0, log=None):
+    '''
+    Runs all the benchmarks against the current (empty) database.
+    Returns {benchmark name: measurement} (see measure()).
+    '''
+
+    log = log or (lambda message: None)
+    results = {}
+
+    log("worker startup")
+    results['worker startup'] = measure_startup(repeat=repeat)
+    if results['worker startup']['heavy_modules']:
+        log(f"worker startup imported {', '.join(results['worker startup']['heavy_modules'])}")
+
+    # The ingestion functions change the database, so they are only run once.
+    # update_atnf_fluxes() is run twice: first to create the flux
+    # measurements, then to update them.
+    with FakePsrcat(num_pulsars, fluxes_per_pulsar, seed=seed):
+        log("import_atnf")
+        results['import_atnf'] = measure(ingest.import_atnf)
+        log("update_atnf_fluxes (create)")
+        results['update_atnf_fluxes (create)'] = measure(ingest.update_atnf_fluxes)
+        log("update_atnf_fluxes (update)")
+        results['update_atnf_fluxes (update)'] = measure(ingest.update_atnf_fluxes)
+
+    log("generating synthetic fits and literature")
+    generate_catalogue(
+        fits_per_pulsar=fits_per_pulsar,
+        num_bibtex=num_bibtex,
+        measurements_per_pulsar=measurements_per_pulsar,
+        seed=seed,
+    )
+
+    log("set_all_atnf_power_laws")
+    results['set_all_atnf_power_laws'] = measure(ingest.set_all_atnf_power_laws)
+
+    log("catalogue snapshot")
+    results['catalogue snapshot'] = measure(snapshot.CatalogueSnapshot.from_database, repeat=repeat)
+
+    # The first request builds the snapshot, so this measures the map served from it
+    client = Client()
+    log("map")
+    results['map'] = measure(lambda: _get(client, reverse('map')), repeat=repeat)
+
+    admin = get_user_model().objects.create_superuser("benchmark", "benchmark@example.com", "benchmark")
+    client.force_login(admin)
+    for changelist in [
+        'admin:core_pulsar_changelist',
+        'admin:core_spectralfit_changelist',
+        'admin:core_atnffluxmeasurement_changelist',
+        'admin:core_pulsarpropertymeasurement_changelist',
+        'admin:literature_bibtex_changelist',
+    ]:
+        log(changelist)
+        results[changelist] = measure(lambda: _get(client, reverse(changelist)), repeat=repeat)
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    Compares results against a baseline (in the same format). A benchmark has
+    regressed if it takes longer than (1 + tolerance) times its baseline time,
+    or makes more queries than its baseline.
+
+    Returns a list of (benchmark name, description of the regression)
+    '''
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['time_s'] > base['time_s'] * (1 + tolerance):
+            regressions.append((name, f"time {result['time_s']:.3f} s > baseline {base['time_s']:.3f} s"))
+        if result['queries'] > base['queries']:
+            regressions.append((name, f"{result['queries']} queries > baseline {base['queries']}"))
+
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, parameters, results):
+    with open(path, "w") as f:
+        json.dump({'parameters': parameters, 'results': results}, f, indent=2)
@@ -0,0 +1,238 @@
+'''
+Everything known about a single pulsar: its properties, ATNF flux densities,
+spectral fits (with the active fit's curve sampled on a frequency grid),
+mentions in the literature and property measurements, with the references
+they cite.
+
+The pulsar and its related rows are read in a fixed number of queries,
+however many of them there are, and the result is cached (as JSON-ready
+data) until the pulsar, or any row it depends on, changes; see
+core.revisions.
+'''
+
+from django.core.cache import cache
+from django.db.models import Prefetch
+
+import literature.models as literature_models
+
+from . import models
+from . import revisions
+from . import spectra
+
+import numpy as np
+
+
+# The frequencies (MHz) of the sampled curve of the active spectral fit,
+# spanning the ATNF catalogue's flux density columns
+CURVE_MIN_FREQ_MHZ = 30
+CURVE_MAX_FREQ_MHZ = 150000
+CURVE_POINTS = 100
+
+
+def details_revision(pk):
+    '''
+    A string that changes whenever the details of the pulsar with the given
+    ID do, for keying data derived from them
+    '''
+
+    shared_revision = revisions.get_revision(revisions.PULSARS)
+    pulsar_revision = revisions.get_revision(revisions.pulsar(pk))
+    return f"{shared_revision}:{pulsar_revision}"
+
+
+def _float_or_none(value):
+    return None if np.isnan(value) else float(value)
+
+
+def curve_freqs_MHz():
+    return np.geomspace(CURVE_MIN_FREQ_MHZ, CURVE_MAX_FREQ_MHZ, CURVE_POINTS)
+
+
+def fit_curve(active_fit, freqs_MHz):
+    '''
+    The flux densities (Jy) that an ActiveSpectralFit predicts at the given
+    frequencies (MHz), and their 1σ uncertainties, as {"freq_MHz": [...],
+    "flux": [...], "error": [...]}, with None where they can't be worked out
+    '''
+
+    names = spectra.model_parameter_names(active_fit.spectrum_model_name)
+    fluxes, errors = spectra.predict_flux_errors(
+        [active_fit.spectrum_model_name],
+        {name: [active_fit.parameters.get(name, np.nan)] for name in names},
+        spectra.covariance_matrices(names, [active_fit.errors], [active_fit.covariance]),
+        names,
+        np.asarray(freqs_MHz) * 1e6,
+    )
+
+    return {
+        'freq_MHz': [float(freq) for freq in freqs_MHz],
+        'flux': [_float_or_none(flux) for flux in fluxes[0]],
+        'error': [_float_or_none(error) for error in errors[0]],
+    }
+
+
+def reference_dict(bibtex, author_orders):
+    return {
+        'citekey': bibtex.citekey,
+        'entry_type': bibtex.get_entry_type_display(),
+        'authors': [str(author_order.author) for author_order in author_orders],
+        'title': bibtex.title,
+        'journal': str(bibtex.journal) if bibtex.journal else None,
+        'year': bibtex.year,
+        'volume': bibtex.volume,
+        'pages': bibtex.pages,
+        'doi': bibtex.doi,
+        'url': bibtex.url,
+    }
+
+
+def pulsar_queryset():
+    '''
+    Pulsars with everything pulsar_details() needs, apart from the references'
+    authors (which are read once for all of the references)
+    '''
+
+    return models.Pulsar.objects.select_related(
+        'spectrum_model',
+        'active_fit',
+    ).prefetch_related(
+        Prefetch(
+            'atnf_flux_measurements',
+            queryset=models.ATNFFluxMeasurement.objects.order_by('freq'),
+        ),
+        Prefetch(
+            'fits',
+            queryset=models.SpectralFit.objects.select_related('parameter__spectrum_model'),
+        ),
+        Prefetch(
+            'fit_covariances',
+            queryset=models.SpectralFitCovariance.objects.all(),
+        ),
+        Prefetch(
+            'pulsarmention_set',
+            queryset=models.PulsarMention.objects.select_related('bibtex__journal').order_by('-importance', 'bibtex__year'),
+        ),
+        Prefetch(
+            'pulsarpropertymeasurement_set',
+            queryset=models.PulsarPropertyMeasurement.objects.select_related(
+                'pulsar_property',
+                'bibtex__journal',
+            ).order_by('pulsar_property__name', 'mjd', 'bibtex__year'),
+        ),
+    )
+
+
+def pulsar_details(pk):
+    '''
+    The details of the pulsar with the given ID, as JSON-ready data, or None
+    if there's no such pulsar. Uncached; see cached_pulsar_details().
+    '''
+
+    pulsar = pulsar_queryset().filter(pk=pk).first()
+    if pulsar is None:
+        return None
+
+    mentions = list(pulsar.pulsarmention_set.all())
+    measurements = list(pulsar.pulsarpropertymeasurement_set.all())
+
+    bibtexes = {item.bibtex_id: item.bibtex for item in mentions + measurements}
+    author_orders = {bibtex_id: [] for bibtex_id in bibtexes}
+    for author_order in literature_models.AuthorOrder.objects.filter(
+        bibtex__in=bibtexes,
+    ).select_related('author').order_by('bibtex', 'order'):
+        author_orders[author_order.bibtex_id].append(author_order)
+
+    # The fits, grouped by spectrum model
+    fits = {}
+    for fit in pulsar.fits.all():
+        spectrum_model = fit.parameter.spectrum_model
+        entry = fits.setdefault(spectrum_model.pk, {
+            'spectrum_model': spectrum_model.name,
+            'pulsar_spectra_name': spectrum_model.pulsar_spectra_name,
+            'active': spectrum_model.pk == pulsar.spectrum_model_id,
+            'parameters': {},
+            'covariance': None,
+        })
+        entry['parameters'][fit.parameter.name] = {'value': fit.value, 'error': fit.error}
+    for covariance in pulsar.fit_covariances.all():
+        if covariance.spectrum_model_id in fits:
+            fits[covariance.spectrum_model_id]['covariance'] = {
+                'parameter_names': covariance.parameter_names,
+                'matrix': covariance.matrix,
+            }
+
+    try:
+        active_fit = pulsar.active_fit
+    except models.ActiveSpectralFit.DoesNotExist:
+        active_fit = None
+
+    return {
+        'id': pulsar.id,
+        'name': pulsar.name,
+        'bname': pulsar.bname,
+        'jname': pulsar.jname,
+        'ra': pulsar.ra,
+        'dec': pulsar.dec,
+        'ra_dec': pulsar.ra_dec,
+        'period': pulsar.period,
+        'pdot': pulsar.pdot,
+        'dm': pulsar.dm,
+        'dm_error': pulsar.dm_error,
+        'rm': pulsar.rm,
+        'rm_error': pulsar.rm_error,
+        'catalogue_version': pulsar.catalogue_version,
+        'spectrum_model': active_fit.spectrum_model_name if active_fit else None,
+        'parameters': active_fit.parameters if active_fit else None,
+        'parameter_errors': active_fit.errors if active_fit else None,
+        'curve': fit_curve(active_fit, curve_freqs_MHz()) if active_fit else None,
+        'atnf_fluxes': [
+            {'freq': flux.freq, 'flux': flux.flux, 'error': flux.error}
+            for flux in pulsar.atnf_flux_measurements.all()
+        ],
+        'fits': list(fits.values()),
+        'mentions': [
+            {
+                'bibtex': mention.bibtex.citekey,
+                'importance': mention.importance,
+                'importance_display': mention.get_importance_display(),
+            }
+            for mention in mentions
+        ],
+        'measurements': [
+            {
+                'property': measurement.pulsar_property.name,
+                'value': measurement.value,
+                'error': measurement.error,
+                'error_low': measurement.error_low,
+                'value_display': measurement.value_display,
+                'is_lower_limit': measurement.is_lower_limit,
+                'is_upper_limit': measurement.is_upper_limit,
+                'mode': measurement.mode,
+                'unit': measurement.unit or measurement.pulsar_property.unit,
+                'freq_MHz': measurement.freq_MHz,
+                'bandwidth_MHz': measurement.bandwidth_MHz,
+                'mjd': measurement.mjd,
+                'time_span_s': measurement.time_span_s,
+                'bibtex': measurement.bibtex.citekey,
+            }
+            for measurement in measurements
+        ],
+        'references': {
+            bibtex.citekey: reference_dict(bibtex, author_orders[bibtex_id])
+            for bibtex_id, bibtex in bibtexes.items()
+        },
+    }
+
+
+def cached_pulsar_details(pk):
+    '''
+    pulsar_details(), cached until the pulsar or anything it depends on changes
+    '''
+
+    key = f"pulsar_detail:{details_revision(pk)}:{pk}"
+    details = cache.get(key)
+    if details is None:
+        details = pulsar_details(pk)
+        if details is not None:
+            cache.set(key, details)
+    return details
@@ -0,0 +1,328 @@
+'''
+Streaming exports of the catalogue: every pulsar with its active spectral fit
+and the flux densities it predicts at the requested frequencies (with their
+1σ uncertainties), as CSV, VOTable, Arrow (IPC stream) or Parquet.
+
+Pulsars are read in chunks of EXPORT_CHUNK_SIZE (by ID, so that each chunk is
+a separate, bounded query: MySQL drivers buffer a whole result set, even with
+QuerySet.iterator()), and each chunk is encoded and yielded before the next
+is read, so memory use doesn't grow with the size of the catalogue.
+
+Arrow and Parquet need pyarrow, which is an optional dependency.
+'''
+
+from . import ingest
+from . import snapshot
+from . import spectra
+
+from xml.sax.saxutils import escape, quoteattr
+import csv
+import io
+import math
+
+import numpy as np
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+# The largest number of frequencies that predicted flux densities can be requested at
+EXPORT_MAX_FREQS = 20
+
+# (name, VOTable datatype, unit, description)
+BASE_FIELDS = [
+    ('id', 'long', None, "Pulsar ID"),
+    ('bname', 'char', None, "B name"),
+    ('jname', 'char', None, "J name"),
+    ('ra', 'double', 'deg', "Right ascension (J2000)"),
+    ('dec', 'double', 'deg', "Declination (J2000)"),
+    ('period', 'double', 's', "Rotation period"),
+    ('pdot', 'double', 's/s', "Period derivative"),
+    ('dm', 'double', 'pc/cm3', "Dispersion measure"),
+    ('dm_error', 'double', 'pc/cm3', "Dispersion measure error"),
+    ('rm', 'double', 'rad/m2', "Rotation measure"),
+    ('rm_error', 'double', 'rad/m2', "Rotation measure error"),
+    ('spectrum_model', 'char', None, "pulsar_spectra name of the active spectrum model"),
+]
+
+
+def parameter_names():
+    '''
+    The names of all of the spectrum models' parameters
+    '''
+
+    return sorted({name for _, _, names in ingest.SPECTRUM_MODELS for name in names})
+
+
+class ExportUnavailable(Exception):
+    pass
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportUnavailable("Arrow and Parquet exports need pyarrow, which isn't installed")
+    return pyarrow
+
+
+def flux_field_name(freq_MHz):
+    return f"flux_{freq_MHz:g}MHz"
+
+
+def flux_error_field_name(freq_MHz):
+    return f"{flux_field_name(freq_MHz)}_error"
+
+
+def export_fields(freqs_MHz):
+
+    return BASE_FIELDS + [
+        (f"parameter_{name}", 'double', None, f"Spectral fit parameter {name} (units depend on the model)")
+        for name in parameter_names()
+    ] + [
+        field
+        for freq in freqs_MHz
+        for field in [
+            (flux_field_name(freq), 'double', 'Jy', f"Flux density at {freq:g} MHz predicted by the spectral fit"),
+            (flux_error_field_name(freq), 'double', 'Jy', f"1σ uncertainty of the flux density at {freq:g} MHz"),
+        ]
+    ]
+
+
+def catalogue_chunks(chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+    Lists of (at most chunk_size) rows of snapshot.snapshot_queryset()
+    '''
+
+    last_id = 0
+    while True:
+        rows = list(snapshot.snapshot_queryset().filter(id__gt=last_id)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def export_chunks(freqs_MHz, chunk_size=EXPORT_CHUNK_SIZE, min_flux=None, sigma=0):
+    '''
+    The catalogue as {field name: column} dicts, one per chunk of pulsars.
+    Float columns are arrays (with NaN for missing values); the others are lists.
+
+    If min_flux (Jy) is given, only the pulsars whose predicted flux density at
+    one of the frequencies is at least min_flux (after subtracting sigma times
+    its uncertainty) are included.
+    '''
+
+    freqs_Hz = np.array(freqs_MHz, dtype=np.float64) * 1e6
+    names = parameter_names()
+
+    for rows in catalogue_chunks(chunk_size):
+        ids, bnames, jnames, *float_values, spectrum_models, parameters, errors, covariances = zip(*rows)
+
+        chunk = {
+            'id': list(ids),
+            'bname': list(bnames),
+            'jname': list(jnames),
+            'spectrum_model': list(spectrum_models),
+        }
+        for name, values in zip(snapshot.FLOAT_COLUMNS, float_values):
+            chunk[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+        parameter_columns = {
+            name: np.array([(fit or {}).get(name, np.nan) for fit in parameters], dtype=np.float64)
+            for name in names
+        }
+        for name, column in parameter_columns.items():
+            chunk[f"parameter_{name}"] = column
+
+        fluxes, flux_errors = spectra.predict_flux_errors(
+            spectrum_models,
+            parameter_columns,
+            spectra.covariance_matrices(names, errors, covariances),
+            names,
+            freqs_Hz,
+        )
+        for i, freq in enumerate(freqs_MHz):
+            chunk[flux_field_name(freq)] = fluxes[:, i]
+            chunk[flux_error_field_name(freq)] = flux_errors[:, i]
+
+        if min_flux is not None:
+            with np.errstate(invalid='ignore'):
+                selected = np.any(spectra.lower_bounds(fluxes, flux_errors, sigma) >= min_flux, axis=1)
+            chunk = _select(chunk, selected)
+
+        yield chunk
+
+
+def _select(chunk, selected):
+    '''
+    The rows of the chunk where the boolean array selected is True
+    '''
+
+    indices = np.flatnonzero(selected)
+    return {
+        name: values[indices] if isinstance(values, np.ndarray) else [values[i] for i in indices]
+        for name, values in chunk.items()
+    }
+
+
+def _python_columns(chunk, names):
+    '''
+    The chunk's columns as lists of Python values, with None for missing values
+    '''
+
+    columns = []
+    for name in names:
+        values = chunk[name]
+        if isinstance(values, np.ndarray):
+            values = [None if math.isnan(value) else value for value in values.tolist()]
+        columns.append(values)
+    return columns
+
+
+def write_csv(fields, chunks):
+
+    names = [name for name, _, _, _ in fields]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+
+    for chunk in chunks:
+        writer.writerows(zip(*_python_columns(chunk, names)))
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue().encode("utf-8")
+
+
+def write_votable(fields, chunks):
+
+    names = [name for name, _, _, _ in fields]
+
+    header = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<VOTABLE version="1.4" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">',
+        '<RESOURCE type="results">',
+        '<TABLE name="pulsar_sky">',
+    ]
+    for name, datatype, unit, description in fields:
+        attributes = f'name={quoteattr(name)} datatype="{datatype}"'
+        if datatype == 'char':
+            attributes += ' arraysize="*"'
+        if unit:
+            attributes += f' unit={quoteattr(unit)}'
+        header.append(f'<FIELD {attributes}><DESCRIPTION>{escape(description)}</DESCRIPTION></FIELD>')
+    header.append('<DATA><TABLEDATA>')
+    yield ("\n".join(header) + "\n").encode("utf-8")
+
+    for chunk in chunks:
+        lines = [
+            "<TR>" + "".join("<TD/>" if value is None else f"<TD>{escape(str(value))}</TD>" for value in row) + "</TR>\n"
+            for row in zip(*_python_columns(chunk, names))
+        ]
+        yield "".join(lines).encode("utf-8")
+
+    yield "</TABLEDATA></DATA>\n</TABLE>\n</RESOURCE>\n</VOTABLE>\n".encode("utf-8")
+
+
+class StreamBuffer(io.RawIOBase):
+    '''
+    A write-only file that hands over what has been written to it so far with
+    drain(), while tell() still counts every byte (writers such as Parquet's
+    record file offsets)
+    '''
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_schema(pa, fields):
+
+    types = {'long': pa.int64(), 'double': pa.float64(), 'char': pa.string()}
+    return pa.schema([
+        pa.field(name, types[datatype], metadata={'unit': unit or '', 'description': description})
+        for name, datatype, unit, description in fields
+    ])
+
+
+def _arrow_batch(pa, schema, chunk):
+    return pa.record_batch(
+        # from_pandas=True turns NaNs into nulls
+        [pa.array(chunk[field.name], type=field.type, from_pandas=True) for field in schema],
+        schema=schema,
+    )
+
+
+def write_arrow(fields, chunks):
+
+    pa = _pyarrow()
+    schema = _arrow_schema(pa, fields)
+    sink = StreamBuffer()
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for chunk in chunks:
+            writer.write_batch(_arrow_batch(pa, schema, chunk))
+            yield sink.drain()
+
+    yield sink.drain()
+
+
+def write_parquet(fields, chunks):
+
+    pa = _pyarrow()
+    schema = _arrow_schema(pa, fields)
+    sink = StreamBuffer()
+
+    # Each chunk becomes a row group
+    with pa.parquet.ParquetWriter(sink, schema) as writer:
+        for chunk in chunks:
+            writer.write_batch(_arrow_batch(pa, schema, chunk))
+            yield sink.drain()
+
+    yield sink.drain()
+
+
+# format: (content type, file extension, writer)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv', write_csv),
+    'votable': ('application/x-votable+xml', 'vot', write_votable),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows', write_arrow),
+    'parquet': ('application/vnd.apache.parquet', 'parquet', write_parquet),
+}
+
+
+def export(export_format, freqs_MHz=(), chunk_size=EXPORT_CHUNK_SIZE, min_flux=None, sigma=0):
+    '''
+    The catalogue in the given format, as an iterator of bytes (see
+    export_chunks() for min_flux and sigma). Raises ExportUnavailable
+    (straight away, rather than when iterated) if the format's dependencies
+    aren't installed.
+    '''
+
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format '{export_format}'. Choose from {list(EXPORT_FORMATS)}")
+
+    if export_format in ('arrow', 'parquet'):
+        _pyarrow()
+
+    _, _, writer = EXPORT_FORMATS[export_format]
+    return writer(export_fields(freqs_MHz), export_chunks(freqs_MHz, chunk_size, min_flux=min_flux, sigma=sigma))
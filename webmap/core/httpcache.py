@@ -0,0 +1,152 @@
+'''
+Caching of the public pages and APIs by the front proxy (see nginx/pulsar-sky.conf).
+
+Responses that only depend on the data (the map, the cone, flux and
+measurement searches, the pulsar details and plots, and the exports) are
+marked as cacheable with cache_headers(), which sets:
+
+  - Cache-Control: a short max-age for browsers, and a longer s-maxage for
+    the proxy,
+  - an ETag made from the revision of the data they were made from (see
+    core.revisions), so that the proxy (and browsers) can revalidate a stale
+    copy and get a 304 if it hasn't changed,
+  - Surrogate-Key: the groups of data they depend on ("catalogue",
+    "pulsars", "pulsar-<id>", "measurements"), by which they can be purged, and
+  - Vary: Accept-Encoding, as the proxy compresses them.
+
+When the ingestion pipeline has changed the catalogue, its last stage
+(purge_proxy_cache()) deletes the proxy's cached copies of everything that
+depends on it, so that the new data is served straight away rather than once
+the copies go stale. The proxy's cache directory has to be shared with the
+app (settings.PROXY_CACHE_DIR); if it isn't set, nothing is purged.
+'''
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+
+from .jobs import Job
+
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Surrogate keys
+CATALOGUE = "catalogue"
+PULSARS = "pulsars"
+MEASUREMENTS = "measurements"
+
+
+def pulsar(pk):
+    '''
+    The surrogate key of the responses about a single pulsar
+    '''
+    return f"pulsar-{pk}"
+
+
+# The surrogate keys of the data that the ingestion pipeline changes
+INGESTION_KEYS = [CATALOGUE, PULSARS]
+
+# How much of each cached file to read for its headers (bytes)
+CACHE_FILE_HEADER_SIZE = 16384
+
+
+def etag(revision):
+    return f'"{revision}"'
+
+
+def not_modified(request, revision):
+    '''
+    A 304 response if the request's If-None-Match matches the revision's ETag,
+    otherwise None
+    '''
+
+    return get_conditional_response(request, etag=etag(revision))
+
+
+def cache_headers(response, revision, keys):
+    '''
+    Marks a response (made from data of the given revision, which depends on
+    the data of the given surrogate keys) as cacheable by browsers and the
+    front proxy. Error responses are left alone.
+    '''
+
+    if response.status_code not in (200, 304):
+        return response
+
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=settings.HTTP_CACHE_MAX_AGE,
+        s_maxage=settings.HTTP_CACHE_S_MAXAGE,
+        stale_while_revalidate=settings.HTTP_CACHE_STALE_WHILE_REVALIDATE,
+    )
+    patch_vary_headers(response, ["Accept-Encoding"])
+    response["ETag"] = etag(revision)
+    response["Surrogate-Key"] = " ".join(keys)
+    return response
+
+
+def _surrogate_keys(path):
+    '''
+    The surrogate keys of the response in one of nginx's cache files, or None
+    if it doesn't have any (or can't be read). Each file starts with a binary
+    header, the cache key and then the response's HTTP headers.
+    '''
+
+    try:
+        with open(path, "rb") as f:
+            head = f.read(CACHE_FILE_HEADER_SIZE)
+    except OSError:
+        return None
+
+    head = head.split(b"\r\n\r\n", 1)[0]
+    for line in head.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"surrogate-key":
+            return value.decode("latin-1").split()
+    return None
+
+
+def purge(keys=None, cache_dir=None):
+    '''
+    Deletes the front proxy's cached responses that depend on any of the given
+    surrogate keys (or all of them, if keys is None). Returns the number of
+    responses deleted.
+    '''
+
+    cache_dir = cache_dir or settings.PROXY_CACHE_DIR
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return 0
+
+    keys = set(keys) if keys is not None else None
+    purged = 0
+    for directory, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if keys is not None and not keys.intersection(_surrogate_keys(path) or ()):
+                continue
+            try:
+                os.remove(path)
+                purged += 1
+            except FileNotFoundError:
+                # Already evicted by the proxy
+                pass
+            except OSError:
+                logger.exception(f"purge: couldn't delete {path}")
+
+    return purged
+
+
+def purge_proxy_cache(job=None, keys=INGESTION_KEYS):
+
+    with (job or Job("purge_proxy_cache")) as job:
+        if not settings.PROXY_CACHE_DIR:
+            job.write("purge_proxy_cache: PROXY_CACHE_DIR isn't set, so there's nothing to purge")
+            return
+
+        with job.stage("purge"):
+            purged = purge(keys)
+        job.count("responses", purged)
+        job.write(f"purge_proxy_cache: purged {purged} cached responses")
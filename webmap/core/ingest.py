@@ -0,0 +1,549 @@
+'''
+Ingestion and fitting: importing the pulsars and their flux densities from
+the ATNF catalogue (with psrcat), fitting power laws to the ATNF flux
+densities, and importing pulsar_spectra's fits. These are run by the
+ingestion pipeline (core.pipeline) and the background jobs (core.tasks),
+never while serving a request.
+
+scipy and pulsar_spectra's catalogue and fitting modules take about a second
+to import and tens of MB to hold, so they are imported by the functions that
+use them rather than here, keeping them out of the web workers.
+'''
+
+from django.db.models import Q
+
+from . import models
+from . import revisions
+from . import signals
+from .jobs import Job
+
+import subprocess
+
+import numpy as np
+
+
+# The name of the SpectrumModel used for power laws fitted to the ATNF flux densities
+ATNF_SIMPLE_POWER_LAW = "ATNF simple power law"
+
+# The frequencies (MHz) of the ATNF flux density columns requested by update_atnf_fluxes(),
+# and the indices of the flux density and error columns in psrcat's output.
+# ***WARNING***
+# The below column indices may change for different versions of the catalogue!!
+ATNF_FLUX_FREQS = [30, 40, 50, 60, 80, 100, 150, 200, 300, 350, 400, 600, 700, 800, 900, 1400, 1600, 2000, 3000, 4000, 5000, 6000, 8000, 10000, 20000, 50000, 100000, 150000]
+ATNF_FLUX_COLS = [2, 3, 5, 7, 9, 11, 13, 15, 17, 19, 21, 23, 25, 27, 29, 31, 33, 35, 37, 39, 41, 43, 45, 47, 48, 49, 50, 52]
+ATNF_ERROR_COLS = [None, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26, 28, 30, 32, 34, 36, 38, 40, 42, 44, 46, None, None, None, 51, 53]
+
+
+def power_law_fit(νnorm, c, α):
+    return c*νnorm**α
+
+def power_law(ν, νref, c, α):
+    return power_law_fit(ν/νref)
+
+def set_all_atnf_power_laws(job=None):
+
+    with (job or Job("set_all_atnf_power_laws")) as job, signals.deferred_updates():
+        # Pulsars are processed in ID order, so that an interrupted run can be resumed
+        with job.stage("db read"):
+            pulsars = models.Pulsar.objects.order_by('pk')
+            if job.resume is not None:
+                pulsars = pulsars.filter(pk__gt=job.resume)
+            pulsars = list(pulsars)
+
+        for i, pulsar in enumerate(pulsars):
+            if set_atnf_power_law(pulsar, job=job):
+                job.count("pulsars fitted")
+            job.progress(i + 1, len(pulsars))
+            job.checkpoint(pulsar.pk)
+
+
+def set_atnf_power_law(pulsar, default_spectral_index=-1.6, overwrite=False, set_as_select=True, job=None):
+    '''
+    If overwrite = False, ignore pulsars which already have simple power laws
+    '''
+
+    job = job or Job("set_atnf_power_law", progress_interval=None, summary=False)
+
+    with job.stage("db read"):
+        result = _atnf_power_law_inputs(pulsar, overwrite)
+    if not result:
+        return False
+    simple_power_law, a, c, v0, atnf_flux_measurements = result
+
+    with job.stage("fit"):
+        result = _fit_atnf_power_law(atnf_flux_measurements, default_spectral_index)
+    if not result:
+        return False
+    a_value, c_value, X_ref, covariance = result
+
+    with job.stage("db write"):
+        _save_atnf_power_law(pulsar, simple_power_law, a, c, v0, a_value, c_value, X_ref, covariance, set_as_select)
+
+    return True
+
+
+def _atnf_power_law_inputs(pulsar, overwrite):
+    '''
+    Returns (model, a, c, v0, flux measurements) for fitting an ATNF power law
+    to the given pulsar, or None if it shouldn't (or can't) be fitted
+    '''
+
+    # Ignore pulsars that don't have ATNF flux measurements
+    atnf_flux_measurements_queryset = models.ATNFFluxMeasurement.objects.filter(pulsar=pulsar)
+    if not atnf_flux_measurements_queryset.exists():
+        return None
+
+    # Retrieve the SpectrumModel object corresponding to a simple power law
+    simple_power_law = models.SpectrumModel.objects.filter(name=ATNF_SIMPLE_POWER_LAW).first()
+    if not simple_power_law:
+        # ...then we have bigger problems. Abort! Abort!
+        return None
+
+    # Retrieve the three simple power law model parameters
+    a = models.SpectrumModelParameter.objects.filter(spectrum_model=simple_power_law, name="a").first()
+    c = models.SpectrumModelParameter.objects.filter(spectrum_model=simple_power_law, name="c").first()
+    v0 = models.SpectrumModelParameter.objects.filter(spectrum_model=simple_power_law, name="v0").first()
+
+    if not a or not c or not v0:
+        # ...then we have bigger problems. Abort! Abort!
+        return None
+
+    # If overwrite = False, ignore pulsars which already have simple power laws
+    spectral_fit = models.SpectralFit.objects.filter(pulsar=pulsar, parameter__spectrum_model=simple_power_law).all()
+    if spectral_fit.exists() and overwrite == False:
+        return None
+
+    # If we got this far, we're definitely going to be adding/overwriting this pulsar's power law fit
+    # That means we've got to DO the fit on the ATNF data...
+    atnf_flux_measurements = list(atnf_flux_measurements_queryset.all())
+
+    return simple_power_law, a, c, v0, atnf_flux_measurements
+
+
+def _fit_atnf_power_law(atnf_flux_measurements, default_spectral_index):
+    '''
+    Returns (a, c, reference frequency, covariance) of a power law fitted to
+    the ATNF flux measurements, or None if the fit failed. The covariance is the
+    2x2 covariance matrix of (a, c), or None if it can't be estimated (i.e.
+    when there are fewer than three measurements).
+    '''
+
+    from scipy.optimize import curve_fit
+
+    covariance = None
+
+    # If there is only one measurement, assume a spectral index
+    if len(atnf_flux_measurements) == 1:
+
+        atnf = atnf_flux_measurements[0]
+        X_ref = atnf.freq # in MHz
+        a_value = default_spectral_index
+        c_value = atnf.flux
+
+    elif len(atnf_flux_measurements) == 2:
+        # Calculate the power law explicitly
+        X_MHz = np.array([atnf.freq for atnf in atnf_flux_measurements]) # in MHz
+        X_ref = np.sqrt(X_MHz[0]*X_MHz[-1]) # in MHz
+        X = X_MHz / X_ref # Now normalised to the geometric mean of the range
+        Y = np.array([atnf.flux for atnf in atnf_flux_measurements]) # in mJy
+
+        a_value = np.log(Y[1]/Y[0]) / np.log(X[1]/X[0])
+        c_value = Y[0] / X[0]**a_value
+
+    else: # if len(...) > 1
+
+        X_MHz = np.array([atnf.freq for atnf in atnf_flux_measurements]) # in MHz
+        X_ref = np.sqrt(X_MHz[0]*X_MHz[-1]) # in MHz
+        X = X_MHz / X_ref # Now normalised to the geometric mean of the range
+        Y = np.array([atnf.flux for atnf in atnf_flux_measurements]) # in mJy
+
+        # Not sure how to handle the case where some flux measurements have errors
+        # but others don't. For now, I'll just treat them all as not having errors.
+        #sigma = [atnf.error for atnf in atnf_flux_measurements]
+
+        p0 = (0.05, -1.6)
+        try:
+            popt, pcov = curve_fit(power_law_fit, X, Y, p0=p0)
+        except RuntimeError:
+            # The fit didn't converge
+            return None
+
+        a_value = popt[1]
+        c_value = popt[0]
+
+        # Reorder the covariance matrix from (c, α) to (a, c)
+        if np.all(np.isfinite(pcov)):
+            covariance = pcov[::-1, ::-1]
+
+    # If any of the parameters have turned up non-finite, do nothing with them
+    if not np.isfinite(a_value) or not np.isfinite(c_value) or not np.isfinite(X_ref):
+        return None
+
+    # ATNF fluxes are in mJy, but pulsar_spectra expects Jy
+    c_value /= 1e3
+    if covariance is not None:
+        covariance = covariance * np.array([[1, 1e-3], [1e-3, 1e-6]])
+
+    return a_value, c_value, X_ref, covariance
+
+
+def _save_atnf_power_law(pulsar, simple_power_law, a, c, v0, a_value, c_value, X_ref, covariance, set_as_select):
+
+    a_error = c_error = None
+    if covariance is not None:
+        a_error, c_error = np.sqrt(np.diag(covariance)).tolist()
+
+    fit_a = models.SpectralFit.objects.filter(pulsar=pulsar, parameter=a).first()
+    if fit_a:
+        fit_a.value = a_value
+        fit_a.error = a_error
+    else:
+        fit_a = models.SpectralFit(pulsar=pulsar, parameter=a, value=a_value, error=a_error)
+    fit_a.save()
+
+    fit_c = models.SpectralFit.objects.filter(pulsar=pulsar, parameter=c).first()
+    if fit_c:
+        fit_c.value = c_value
+        fit_c.error = c_error
+    else:
+        fit_c = models.SpectralFit(pulsar=pulsar, parameter=c, value=c_value, error=c_error)
+    fit_c.save()
+
+    # The reference frequency is fixed, not fitted, so it has no error
+    fit_v0 = models.SpectralFit.objects.filter(pulsar=pulsar, parameter=v0).first()
+    if fit_v0:
+        fit_v0.value = X_ref*1e6 # in Hz
+        fit_v0.error = None
+    else:
+        fit_v0 = models.SpectralFit(pulsar=pulsar, parameter=v0, value=X_ref*1e6)
+    fit_v0.save()
+
+    if covariance is None:
+        models.SpectralFitCovariance.objects.filter(pulsar=pulsar, spectrum_model=simple_power_law).delete()
+    else:
+        _save_covariance(pulsar, simple_power_law, ["a", "c"], covariance)
+
+    if set_as_select:
+        if not pulsar.spectrum_model:
+            pulsar.spectrum_model = simple_power_law
+            pulsar.save()
+
+def update_atnf_fluxes(job=None, pulsar_ids=None):
+    '''
+    Imports the ATNF flux densities of the pulsars in the database (or only of
+    those with the given IDs)
+    '''
+
+    if pulsar_ids is not None:
+        pulsar_ids = set(pulsar_ids)
+
+    with (job or Job("update_atnf_fluxes")) as job, signals.deferred_updates():
+
+        # Now grab the catalogue's contents
+        with job.stage("subprocess"):
+            completed_process = subprocess.run(
+                ['psrcat', '-nonumber', '-nohead', '-o', 'short_error', '-c',
+                 'bname jname S30 S40 S50 S60 S80 S100 S150 S200 S300 S350 S400 S600 S700 S800 S900 S1400 S1600 S2000 S3000 S4000 S5000 S6000 S8000 S10G S20G S50G S100G S150G'],
+                capture_output=True,
+            )
+            stdout = completed_process.stdout.decode("utf-8")
+
+        freqs = ATNF_FLUX_FREQS
+        flux_cols = ATNF_FLUX_COLS
+        error_cols = ATNF_ERROR_COLS
+
+        lines = stdout.split('\n')
+        for n, line in enumerate(lines):
+
+            job.progress(n + 1, len(lines))
+
+            with job.stage("parse"):
+                tokens = line.split()
+
+            # Ignore problematic lines with too few tokens
+            if len(tokens) < 12:
+                continue
+
+            bname = None if tokens[0] == '*' else tokens[0]
+            jname = None if tokens[1] == '*' else tokens[1]
+
+            # Find the matching pulsar, otherwise ignore
+            with job.stage("db read"):
+                pulsar = models.Pulsar.objects.filter(bname=bname, jname=jname).first()
+            if not pulsar:
+                continue
+            if pulsar_ids is not None and pulsar.pk not in pulsar_ids:
+                continue
+
+            job.count("pulsars")
+
+            for i in range(len(freqs)):
+                freq = freqs[i]
+                try:
+                    flux = float(tokens[flux_cols[i]])
+                except:
+                    # If there's no flux for this frequency, skip this and go to the next frequency
+                    continue
+                try:
+                    error = float(tokens[error_cols[i]])
+                except:
+                    # If there's no error, just set it to None
+                    error = None
+
+                # Look for matching entries
+                with job.stage("db read"):
+                    atnf_flux_measurement = models.ATNFFluxMeasurement.objects.filter(pulsar=pulsar, freq=freq).first()
+
+                if atnf_flux_measurement is not None:
+                    # Update the existing entry
+                    atnf_flux_measurement.flux = flux
+                    atnf_flux_measurement.error = error
+                    job.count("flux densities updated")
+                else:
+                    # Make a new entry
+                    atnf_flux_measurement = models.ATNFFluxMeasurement(
+                        pulsar=pulsar,
+                        freq=freq,
+                        flux=flux,
+                        error=error,
+                    )
+                    job.count("flux densities created")
+
+                with job.stage("db write"):
+                    atnf_flux_measurement.save()
+
+
+def import_atnf(job=None):
+
+    with (job or Job("import_atnf")) as job:
+
+        with job.stage("subprocess"):
+            # Grab the ATNF catalogue number (this also tests whether psrcat is installed)
+            completed_process = subprocess.run(
+                ['psrcat', '-v'],
+                capture_output=True,
+            )
+            stdout = completed_process.stdout.decode("utf-8")
+            catalogue_version = stdout.split()[-1]
+
+            # Now grab the catalogue's contents
+            completed_process = subprocess.run(
+                ['psrcat', '-nonumber', '-nohead', '-o', 'short_error', '-c', 'bname jname rajd decjd p0 dm rm'],
+                capture_output=True,
+            )
+            stdout = completed_process.stdout.decode("utf-8")
+
+        atnf_pulsars = []
+        bnames = []
+        jnames = []
+
+        with job.stage("parse"):
+            for line in stdout.split('\n'):
+
+                tokens = line.split()
+
+                # Ignore problematic lines with too few tokens
+                if len(tokens) < 12:
+                    continue
+
+                bname = None if tokens[0] == '*' else tokens[0]
+                jname = None if tokens[1] == '*' else tokens[1]
+
+                try:
+                    ra = float(tokens[2])
+                except:
+                    ra = None
+                try:
+                    dec = float(tokens[4])
+                except:
+                    dec = None
+                try:
+                    period = float(tokens[6])
+                except:
+                    period = None
+                try:
+                    dm = float(tokens[8])
+                except:
+                    dm = None
+                try:
+                    dm_error = float(tokens[9])
+                except:
+                    dm_error = None
+                try:
+                    rm = float(tokens[10])
+                except:
+                    rm = None
+                try:
+                    rm_error = float(tokens[11])
+                except:
+                    rm_error = None
+
+                atnf_pulsars.append(
+                    models.Pulsar(
+                        bname=bname,
+                        jname=jname,
+                        ra=ra,
+                        dec=dec,
+                        period=period,
+                        dm=dm,
+                        dm_error=dm_error,
+                        rm=rm,
+                        rm_error=rm_error,
+                        catalogue_version=catalogue_version,
+                    )
+                )
+
+                bnames.append(bname)
+                jnames.append(jname)
+
+        job.count("pulsars parsed", len(atnf_pulsars))
+
+        with job.stage("db read"):
+            duplicates = models.Pulsar.objects.filter(Q(bname__in=bnames) | Q(jname__in=jnames))
+            duplicate_names = [p.name for p in duplicates]
+            new_pulsars = [p for p in atnf_pulsars if p.name not in duplicate_names]
+
+        with job.stage("db write"):
+            models.Pulsar.objects.bulk_create(new_pulsars)
+
+        # bulk_create() doesn't send the signals that would otherwise do this
+        revisions.bump_revision(revisions.CATALOGUE)
+
+        job.count("pulsars created", len(new_pulsars))
+
+
+def import_spectra(job=None):
+
+    from pulsar_spectra.catalogue import collect_catalogue_fluxes
+
+    with (job or Job("import_spectra")) as job, signals.deferred_updates():
+
+        with job.stage("catalogue"):
+            cat_dict = collect_catalogue_fluxes()
+
+        # Pulsars are processed in ID order, so that an interrupted run can be resumed
+        with job.stage("db read"):
+            pulsars = models.Pulsar.objects.order_by('pk')
+            if job.resume is not None:
+                pulsars = pulsars.filter(pk__gt=job.resume)
+            pulsars = list(pulsars)
+
+        for i, pulsar in enumerate(pulsars):
+            job.progress(i + 1, len(pulsars), message=str(pulsar))
+            if import_pulsar_spectrum(pulsar, cat_dict, job=job):
+                job.count("pulsars fitted")
+            job.checkpoint(pulsar.pk)
+
+
+def import_pulsar_spectrum(pulsar, cat_dict, job=None):
+    '''
+    Fits the pulsar_spectra catalogue fluxes of the given pulsar and stores
+    the best fitting model as the pulsar's active spectral fit.
+    Returns True if a fit was stored.
+    '''
+
+    from pulsar_spectra.spectral_fit import find_best_spectral_fit
+
+    job = job or Job("import_pulsar_spectrum", progress_interval=None, summary=False)
+
+    try:
+        with job.stage("fit"):
+            freqs, bands, fluxs, flux_errs, refs = cat_dict[pulsar.jname]
+            best_model_name, iminuit_result, fit_info, p_best, p_category = find_best_spectral_fit(
+                pulsar.name,
+                freqs,
+                bands,
+                fluxs,
+                flux_errs,
+                refs,
+                plot_best=False
+            )
+
+    except:
+        return False
+
+    # Find the django counterpart of the spectrum model (not the ATNF one,
+    # which shares its pulsar_spectra_name with pulsar_spectra's own simple power law)
+    with job.stage("db read"):
+        spectrum_model = models.SpectrumModel.objects.filter(
+            pulsar_spectra_name=best_model_name,
+        ).exclude(
+            name=ATNF_SIMPLE_POWER_LAW,
+        ).first()
+    if not spectrum_model:
+        job.write(f"Couldn't find SpectrumModel {best_model_name}")
+        return False
+
+    with job.stage("db write"):
+        pulsar.spectrum_model = spectrum_model
+        pulsar.save()
+        for p, v, e in zip(iminuit_result.parameters, iminuit_result.values, iminuit_result.errors):
+            # Find a matching parameter object, or create a new one
+            parameter, _ = models.SpectrumModelParameter.objects.get_or_create(
+                spectrum_model=spectrum_model,
+                name=p,
+            )
+
+            # Only this model's fit for this parameter is touched; fits of the
+            # same-named parameters of other models are left alone
+            fit = models.SpectralFit.objects.filter(pulsar=pulsar, parameter=parameter).first()
+            if fit:
+                # Update the value
+                fit.value = v
+                fit.error = e
+            else:
+                # And a new fit
+                fit = models.SpectralFit(pulsar=pulsar, parameter=parameter, value=v, error=e)
+            fit.save()
+
+        if iminuit_result.covariance is None:
+            models.SpectralFitCovariance.objects.filter(pulsar=pulsar, spectrum_model=spectrum_model).delete()
+        else:
+            _save_covariance(pulsar, spectrum_model, list(iminuit_result.parameters), np.array(iminuit_result.covariance))
+
+    return True
+
+
+def _save_covariance(pulsar, spectrum_model, parameter_names, matrix):
+    '''
+    Stores the covariance matrix (over the named parameters) of a pulsar's fit
+    of the given spectrum model
+    '''
+
+    models.SpectralFitCovariance.objects.update_or_create(
+        pulsar=pulsar,
+        spectrum_model=spectrum_model,
+        defaults={
+            'parameter_names': parameter_names,
+            'matrix': np.asarray(matrix, dtype=np.float64).tolist(),
+        },
+    )
+
+
+# The spectrum models (name, pulsar_spectra name, parameter names) created by init_spectrum_models()
+SPECTRUM_MODELS = [
+    ("Simple power law", "simple_power_law", ['a', 'c', 'v0']),
+    (ATNF_SIMPLE_POWER_LAW, "simple_power_law", ['a', 'c', 'v0']),
+    ("Broken power law", "broken_power_law", ['vb', 'a1', 'a2', 'c', 'v0']),
+    ("Double turn-over", "double_turn_over_spectrum", ['vc', 'vpeak', 'a', 'beta', 'c', 'v0']),
+    ("High frequency cut-off power law", "high_frequency_cut_off_power_law", ['vc', 'a', 'c', 'v0']),
+    ("Log-parabolic", "log_parabolic_spectrum", ['a', 'b', 'c', 'v0']),
+    ("Low frequency turn-over power law", "low_frequency_turn_over_power_law", ['vpeak', 'a', 'c', 'beta', 'v0']),
+]
+
+
+def init_spectrum_models(job=None):
+    '''
+    Creates the spectrum models and their parameters. Models and parameters
+    that already exist are left alone, so this is safe to run repeatedly.
+    '''
+
+    with (job or Job("init_spectrum_models", summary=False)) as job, signals.deferred_updates():
+        with job.stage("db write"):
+            for name, pulsar_spectra_name, parameter_names in SPECTRUM_MODELS:
+                spectrum_model, _ = models.SpectrumModel.objects.get_or_create(
+                    name=name,
+                    defaults={'pulsar_spectra_name': pulsar_spectra_name},
+                )
+                for parameter_name in parameter_names:
+                    spectrum_model.parameters.get_or_create(name=parameter_name)
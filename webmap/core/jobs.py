@@ -0,0 +1,160 @@
+'''
+Instrumentation for the long-running import and fitting jobs.
+
+A Job accumulates the time spent in named stages (e.g. "subprocess",
+"parse", "db read", "fit", "db write") and counts of processed items, writes
+rate-limited progress messages, optionally runs the whole job under cProfile,
+and writes a summary when it finishes:
+
+    with Job("import_atnf") as job:
+        with job.stage("subprocess"):
+            ...
+        job.count("pulsars")
+        job.progress(i, total)
+
+Jobs can be nested (e.g. a job function that is passed an existing job);
+only the outermost "with" starts the profiler and writes the summary.
+
+Resumable jobs record how far they have got with job.checkpoint(value), and
+start again from job.resume (the last value checkpointed by an earlier,
+interrupted run), if it is set; see core.pipeline.
+'''
+
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import time
+
+
+class Job:
+
+    def __init__(self, name, write=print, progress_interval=10.0, profile=None, summary=True,
+                 checkpoint=None, resume=None, checkpoint_interval=5.0):
+        '''
+        name               The name of the job, used in its messages
+        write              Callable used to output messages (default: print)
+        progress_interval  Minimum time (s) between progress messages; None for no progress messages
+        profile            If given, the path of a cProfile (pstats) file to dump the job's profile to
+        summary            Whether to write a summary of the stage timings and counts at the end
+        checkpoint         Callable used to save the job's progress (see checkpoint())
+        resume             The progress saved by an earlier run of the job, to resume from
+        checkpoint_interval  Minimum time (s) between calls to the checkpoint callable
+        '''
+        self.name = name
+        self.write = write
+        self.progress_interval = progress_interval
+        self.profile_path = profile
+        self.show_summary = summary
+        self.checkpoint_callback = checkpoint
+        self.resume = resume
+        self.checkpoint_interval = checkpoint_interval
+
+        self.stage_times = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        self.counts = defaultdict(int)
+
+        self.depth = 0
+        self.profiler = None
+        self.start_time = None
+        self.end_time = None
+        self.last_progress = 0.0
+        self.last_checkpoint = 0.0
+        self.pending_checkpoint = None
+
+    def __enter__(self):
+        self.depth += 1
+        if self.depth == 1:
+            self.start_time = time.perf_counter()
+            self.last_progress = self.start_time
+            if self.profile_path:
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            self.end_time = time.perf_counter()
+            # Save the progress made so far, even if the job was interrupted
+            self.flush_checkpoint()
+            if self.profiler:
+                self.profiler.disable()
+                self.profiler.dump_stats(self.profile_path)
+                self.write(f"{self.name}: profile written to {self.profile_path}")
+            if self.show_summary:
+                self.write(self.summary())
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_times[name] += time.perf_counter() - start
+            self.stage_calls[name] += 1
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def progress(self, done, total=None, message=""):
+        '''
+        Writes a progress message, unless one was written less than
+        progress_interval seconds ago
+        '''
+
+        if self.progress_interval is None:
+            return
+
+        now = time.perf_counter()
+        if now - self.last_progress < self.progress_interval and done != total:
+            return
+        self.last_progress = now
+
+        of_total = f"/{total}" if total is not None else ""
+        rate = done / (now - self.start_time) if now > self.start_time else 0
+        self.write(f"{self.name}: {done}{of_total} ({rate:.1f}/s) {message}".rstrip())
+
+    def checkpoint(self, value):
+        '''
+        Records that the job has got as far as value (which must be
+        JSON-serialisable). The checkpoint callable is only called every
+        checkpoint_interval seconds, and when the job finishes.
+        '''
+
+        if self.checkpoint_callback is None:
+            return
+
+        self.pending_checkpoint = value
+        now = time.perf_counter()
+        if now - self.last_checkpoint >= self.checkpoint_interval:
+            self.flush_checkpoint()
+            self.last_checkpoint = now
+
+    def flush_checkpoint(self):
+        if self.checkpoint_callback is not None and self.pending_checkpoint is not None:
+            self.checkpoint_callback(self.pending_checkpoint)
+            self.pending_checkpoint = None
+
+    @property
+    def elapsed(self):
+        end = self.end_time if self.end_time is not None else time.perf_counter()
+        return end - self.start_time if self.start_time is not None else 0.0
+
+    def summary(self):
+
+        elapsed = self.elapsed
+        lines = [f"{self.name} finished in {elapsed:.2f} s"]
+
+        if self.stage_times:
+            lines.append(f"    {'Stage':<20} {'Time (s)':>10} {'%':>6} {'Calls':>8}")
+            for name, stage_time in sorted(self.stage_times.items(), key=lambda item: -item[1]):
+                percent = 100 * stage_time / elapsed if elapsed else 0
+                lines.append(f"    {name:<20} {stage_time:>10.3f} {percent:>6.1f} {self.stage_calls[name]:>8}")
+            other = elapsed - sum(self.stage_times.values())
+            lines.append(f"    {'(other)':<20} {other:>10.3f} {100 * other / elapsed if elapsed else 0:>6.1f}")
+
+        for name, n in self.counts.items():
+            rate = n / elapsed if elapsed else 0
+            lines.append(f"    {n} {name} ({rate:.1f}/s)")
+
+        return "\n".join(lines)
@@ -0,0 +1,108 @@
+'''
+A load test of a running server (e.g. uwsgi with pulsar-sky.uwsgi.ini), for
+checking its process, thread and timeout settings: a number of concurrent
+clients request the given URLs (by default, the map) over and over for a
+while, and the throughput, latencies and errors are reported (see the
+"load_test" management command).
+
+The clients are threads in this process, so for high concurrencies, run it
+from another machine than the server's, or a few copies of it at once.
+'''
+
+import collections
+import itertools
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+
+def _request(url, timeout):
+    '''
+    Requests the URL, reading the whole response; returns the status code, or
+    None if there was no response (or it didn't arrive within timeout seconds)
+    '''
+
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+    except (urllib.error.URLError, OSError):
+        return None
+
+
+def run(urls, concurrency=16, duration=30, warm_up=5, timeout=30):
+    '''
+    Requests the URLs (in turn) from concurrency threads for duration seconds,
+    after warm_up seconds of requests that aren't counted. Returns {"requests",
+    "errors", "statuses", "rps", "latency_s": {"p50", "p95", "p99", "max"}},
+    where errors are the requests that failed or got anything but a 200.
+    '''
+
+    urls = itertools.cycle(urls)
+    url_lock = threading.Lock()
+    results_lock = threading.Lock()
+    latencies = []
+    statuses = collections.Counter()
+
+    start = time.perf_counter()
+    measure_from = start + warm_up
+    stop = measure_from + duration
+
+    def client():
+        while True:
+            with url_lock:
+                url = next(urls)
+            sent = time.perf_counter()
+            if sent >= stop:
+                return
+            status = _request(url, timeout)
+            received = time.perf_counter()
+            if sent >= measure_from:
+                with results_lock:
+                    latencies.append(received - sent)
+                    statuses[status] += 1
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - measure_from
+    requests = len(latencies)
+    latencies = np.array(latencies) if latencies else np.array([np.nan])
+    return {
+        'requests': requests,
+        'errors': requests - statuses[200],
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'rps': requests / elapsed,
+        'latency_s': {
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(np.max(latencies)),
+        },
+    }
+
+
+def check(result, max_p95_s=None, max_error_rate=None, min_rps=None):
+    '''
+    The ways in which a result of run() falls short of the given limits, as a
+    list of descriptions (empty if it doesn't)
+    '''
+
+    failures = []
+    if max_p95_s is not None and not result['latency_s']['p95'] <= max_p95_s:
+        failures.append(f"95th percentile latency {result['latency_s']['p95']:.3f} s > {max_p95_s} s")
+    error_rate = result['errors'] / result['requests'] if result['requests'] else 1
+    if max_error_rate is not None and error_rate > max_error_rate:
+        failures.append(f"error rate {error_rate:.2%} > {max_error_rate:.2%}")
+    if min_rps is not None and result['rps'] < min_rps:
+        failures.append(f"throughput {result['rps']:.1f} requests/s < {min_rps} requests/s")
+    return failures
@@ -0,0 +1,106 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment, override_settings
+
+from core import benchmarks
+from core import metrics
+from core import snapshot
+
+import os
+import tempfile
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the map view, ATNF ingestion, ATNF power law fitting and admin changelists "
+        "against a synthetic catalogue in a throwaway test database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pulsars", type=int, default=1000, help="Number of synthetic pulsars (default 1000)")
+        parser.add_argument("--fits-per-pulsar", type=int, default=2, help="Number of spectrum models fitted to each pulsar (default 2)")
+        parser.add_argument("--fluxes-per-pulsar", type=int, default=4, help="Number of ATNF flux densities per pulsar (default 4)")
+        parser.add_argument("--bibtex", type=int, default=50, help="Number of BibTeX entries (default 50)")
+        parser.add_argument("--measurements-per-pulsar", type=int, default=2, help="Number of property measurements per pulsar (default 2)")
+        parser.add_argument("--repeat", type=int, default=5, help="Number of repeats of each read benchmark (default 5)")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic catalogue")
+        parser.add_argument("--baseline", default="benchmark_baseline.json", help="Baseline file to compare against (or save to)")
+        parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+        parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed fractional slow-down relative to the baseline (default 0.2)")
+
+    def handle(self, *args, **options):
+
+        parameters = {
+            'num_pulsars': options["pulsars"],
+            'fits_per_pulsar': options["fits_per_pulsar"],
+            'fluxes_per_pulsar': options["fluxes_per_pulsar"],
+            'num_bibtex': options["bibtex"],
+            'measurements_per_pulsar': options["measurements_per_pulsar"],
+            'seed': options["seed"],
+        }
+
+        log = lambda message: self.stdout.write(f"  {message}...")
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        tmpdir = tempfile.TemporaryDirectory()
+        old_store = metrics.store
+        try:
+            # Keep the benchmark's cache entries, catalogue snapshots, request
+            # metrics and pipeline state out of the real ones (and don't purge
+            # the front proxy's cache), and don't depend on collectstatic's
+            # manifest of hashed static file names
+            with override_settings(
+                CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                STORAGES={
+                    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+                    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+                },
+                CATALOGUE_SNAPSHOT_DIR=os.path.join(tmpdir.name, "snapshots"),
+                METRICS_DIR=os.path.join(tmpdir.name, "metrics"),
+                PIPELINE_LOCK_FILE=os.path.join(tmpdir.name, "refresh.lock"),
+                PIPELINE_CHECKPOINT_FILE=os.path.join(tmpdir.name, "checkpoint.json"),
+                WARM_UP_READY_FILE=os.path.join(tmpdir.name, "warm-up-ready.json"),
+                PROXY_CACHE_DIR=None,
+            ):
+                # ...nor the snapshot and metrics this process already has in memory
+                snapshot._snapshot = None
+                metrics.store = metrics.MetricsStore()
+                results = benchmarks.run(repeat=options["repeat"], log=log, **parameters)
+        finally:
+            metrics.store.close()
+            metrics.store = old_store
+            snapshot._snapshot = None
+            tmpdir.cleanup()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        baseline = None
+        if os.path.exists(options["baseline"]) and not options["save_baseline"]:
+            baseline = benchmarks.load_baseline(options["baseline"])
+            if baseline['parameters'] != parameters:
+                self.stdout.write(self.style.WARNING(
+                    f"Baseline {options['baseline']} was made with different parameters: {baseline['parameters']}"
+                ))
+
+        self.stdout.write(f"\n{'Benchmark':<50} {'Time (s)':>10} {'Queries':>8} {'Peak (MiB)':>11} {'Baseline (s)':>13}")
+        for name, result in results.items():
+            base = baseline['results'].get(name) if baseline else None
+            base_time = f"{base['time_s']:.4f}" if base else "-"
+            self.stdout.write(
+                f"{name:<50} {result['time_s']:>10.4f} {result['queries']:>8} "
+                f"{result['peak_memory_MiB']:>11.2f} {base_time:>13}"
+            )
+
+        if options["save_baseline"]:
+            benchmarks.save_baseline(options["baseline"], parameters, results)
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to {options['baseline']}"))
+            return
+
+        if baseline:
+            regressions = benchmarks.compare(results, baseline['results'], tolerance=options["tolerance"])
+            for name, description in regressions:
+                self.stdout.write(self.style.ERROR(f"Regression in {name}: {description}"))
+            if regressions:
+                raise CommandError(f"{len(regressions)} regressions against {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
@@ -0,0 +1,141 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core import models
+from core import snapshot
+from core import views
+
+
+# Tables for which a full scan is expected: small lookup tables, and the
+# active fits, which the map reads in their entirety
+EXPECTED_SCANS = [
+    "core_spectrummodel",
+    "core_spectrummodelparameter",
+    "core_pulsarproperty",
+    "core_activespectralfit",
+]
+
+
+def hot_queries():
+    '''
+    The querysets on the application's hot paths, as (description, queryset) pairs.
+    Parameter values are placeholders; only the shape of each query matters.
+    '''
+
+    return [
+        (
+            "Catalogue snapshot: pulsars with their active spectral fits",
+            snapshot.snapshot_queryset(),
+        ),
+        (
+            "update_atnf_fluxes(): pulsar by (bname, jname)",
+            models.Pulsar.objects.filter(bname="B0000+00", jname="J0000+0000"),
+        ),
+        (
+            "Pulsar by bname",
+            models.Pulsar.objects.filter(bname="B0000+00"),
+        ),
+        (
+            "Pulsar by jname",
+            models.Pulsar.objects.filter(jname="J0000+0000"),
+        ),
+        (
+            "Pulsars ordered by (ra, dec)",
+            models.Pulsar.objects.order_by("ra", "dec")[:100],
+        ),
+        (
+            "update_atnf_fluxes(): ATNF flux measurement by (pulsar, freq)",
+            models.ATNFFluxMeasurement.objects.filter(pulsar_id=1, freq=1400),
+        ),
+        (
+            "set_atnf_power_law(): fits by (pulsar, parameter__spectrum_model)",
+            models.SpectralFit.objects.filter(pulsar_id=1, parameter__spectrum_model_id=1),
+        ),
+        (
+            "ActiveSpectralFit.refresh(): fits of a pulsar's active spectrum model",
+            models.SpectralFit.objects.active().filter(pulsar_id=1),
+        ),
+        (
+            "Property measurements of a pulsar, ordered by bibtex__year",
+            models.PulsarPropertyMeasurement.objects.filter(pulsar_id=1),
+        ),
+        (
+            "measurements_api(): property measurements in a frequency range",
+            models.PulsarPropertyMeasurement.objects.filter(
+                pulsar_property_id=1,
+                freq_MHz__gte=100,
+                freq_MHz__lte=200,
+            ),
+        ),
+        (
+            "ephemeris_measurements(): latest measurement per ephemeris parameter",
+            views.ephemeris_measurements_queryset([1]),
+        ),
+    ]
+
+
+def explain(queryset):
+    '''
+    Runs EXPLAIN on the queryset's SQL and returns (plan rows, scanned tables)
+    '''
+
+    sql, params = queryset.query.sql_with_params()
+
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            rows = cursor.fetchall()
+            plan = [row[-1] for row in rows]
+            # e.g. "SCAN core_pulsar", but not "SCAN core_pulsar USING COVERING INDEX ..."
+            scans = [
+                detail.split()[1] for detail in plan
+                if detail.startswith("SCAN ") and "INDEX" not in detail
+            ]
+        elif connection.vendor == "mysql":
+            cursor.execute("EXPLAIN " + sql, params)
+            columns = [col[0] for col in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            plan = [
+                f"{row['table']}: type={row['type']} key={row['key']} rows={row['rows']} {row['Extra'] or ''}"
+                for row in rows
+            ]
+            scans = [row['table'] for row in rows if row['type'] == "ALL"]
+        else:
+            plan = [queryset.explain()]
+            scans = []
+
+    return plan, scans
+
+
+class Command(BaseCommand):
+    help = "Runs EXPLAIN on each of the hot queries and flags full table scans"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fail-on-scan",
+            action="store_true",
+            help="Exit with an error if any hot query scans a (non-lookup) table",
+        )
+
+    def handle(self, *args, **options):
+
+        flagged = []
+        tables = connection.introspection.table_names()
+
+        for description, queryset in hot_queries():
+            plan, scans = explain(queryset)
+            # Derived tables (subqueries) have no indexes to use, so only real tables are flagged
+            scans = [table for table in scans if table in tables and table not in EXPECTED_SCANS]
+
+            self.stdout.write(self.style.MIGRATE_HEADING(description))
+            for line in plan:
+                self.stdout.write(f"    {line}")
+
+            if scans:
+                flagged.append(description)
+                self.stdout.write(self.style.WARNING(f"    Table scan on {', '.join(scans)}"))
+
+        if flagged and options["fail_on_scan"]:
+            raise CommandError(f"{len(flagged)} hot queries use table scans")
+
+        self.stdout.write(f"{len(flagged)} of {len(hot_queries())} hot queries use table scans")
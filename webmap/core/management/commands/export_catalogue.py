@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import export
+
+import sys
+
+
+class Command(BaseCommand):
+    help = "Exports the catalogue, with each pulsar's active spectral fit and predicted flux densities"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format",
+            choices=export.EXPORT_FORMATS.keys(),
+            default="csv",
+            help="The output format (default csv; arrow and parquet need pyarrow)",
+        )
+        parser.add_argument(
+            "--freq",
+            type=float,
+            action="append",
+            default=[],
+            metavar="MHZ",
+            help="A frequency (MHz) to predict flux densities at (repeatable)",
+        )
+        parser.add_argument(
+            "--min-flux",
+            type=float,
+            metavar="JY",
+            help="Only export pulsars whose predicted flux density at one of the frequencies is at least this",
+        )
+        parser.add_argument(
+            "--sigma",
+            type=float,
+            default=0,
+            help="Number of standard deviations subtracted from the flux densities compared with --min-flux (default 0)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=export.EXPORT_CHUNK_SIZE,
+            help=f"Number of pulsars read from the database at a time (default {export.EXPORT_CHUNK_SIZE})",
+        )
+        parser.add_argument(
+            "-o", "--output",
+            default="-",
+            help="The file to write to (default: standard output)",
+        )
+
+    def handle(self, *args, **options):
+
+        if any(freq <= 0 for freq in options["freq"]):
+            raise CommandError("Frequencies must be positive")
+        if options["sigma"] < 0:
+            raise CommandError("--sigma must not be negative")
+
+        try:
+            content = export.export(
+                options["format"],
+                options["freq"],
+                chunk_size=options["chunk_size"],
+                min_flux=options["min_flux"],
+                sigma=options["sigma"],
+            )
+        except export.ExportUnavailable as e:
+            raise CommandError(str(e))
+
+        if options["output"] == "-":
+            for data in content:
+                sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        else:
+            with open(options["output"], "wb") as f:
+                for data in content:
+                    f.write(data)
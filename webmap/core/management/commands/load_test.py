@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        "Load tests a running server with concurrent requests for the map (or the given URLs), "
+        "and fails if the latency, error rate or throughput are outside the given limits"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("base_url", help="The server's base URL, e.g. http://localhost")
+        parser.add_argument("--path", action="append", dest="paths",
+                            help="Path to request, relative to base_url (repeatable; default /map/)")
+        parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent clients (default 16)")
+        parser.add_argument("--duration", type=float, default=30, help="Seconds of measured requests (default 30)")
+        parser.add_argument("--warm-up", type=float, default=5, help="Seconds of unmeasured requests first (default 5)")
+        parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for each response (default 30)")
+        parser.add_argument("--max-p95", type=float, help="Fail if the 95th percentile latency (s) is above this")
+        parser.add_argument("--max-error-rate", type=float, default=0.0, help="Fail if more than this fraction of requests fail (default 0)")
+        parser.add_argument("--min-rps", type=float, help="Fail if the throughput (requests/s) is below this")
+
+    def handle(self, *args, **options):
+
+        urls = [
+            options["base_url"].rstrip("/") + "/" + path.lstrip("/")
+            for path in options["paths"] or ["/map/"]
+        ]
+
+        self.stdout.write(
+            f"Requesting {', '.join(urls)} from {options['concurrency']} clients "
+            f"for {options['warm_up']:g} + {options['duration']:g} s..."
+        )
+        result = loadtest.run(
+            urls,
+            concurrency=options["concurrency"],
+            duration=options["duration"],
+            warm_up=options["warm_up"],
+            timeout=options["timeout"],
+        )
+
+        latency = result['latency_s']
+        self.stdout.write(f"Requests:   {result['requests']} ({result['rps']:.1f}/s)")
+        self.stdout.write(f"Statuses:   {', '.join(f'{status}: {count}' for status, count in result['statuses'].items())}")
+        self.stdout.write(
+            f"Latency (s): p50 {latency['p50']:.3f}, p95 {latency['p95']:.3f}, "
+            f"p99 {latency['p99']:.3f}, max {latency['max']:.3f}"
+        )
+
+        failures = loadtest.check(
+            result,
+            max_p95_s=options["max_p95"],
+            max_error_rate=options["max_error_rate"],
+            min_rps=options["min_rps"],
+        )
+        for failure in failures:
+            self.stdout.write(self.style.ERROR(failure))
+        if failures:
+            raise CommandError(f"{len(failures)} limits exceeded")
+        self.stdout.write(self.style.SUCCESS("Within the limits"))
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import pipeline
+
+
+class Command(BaseCommand):
+    help = (
+        "Refreshes the catalogue by running the ingestion stages in dependency order. "
+        "An interrupted refresh resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "stages",
+            nargs="*",
+            help=f"The stages to run (default: all). In order: {', '.join(pipeline.STAGE_NAMES)}",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the checkpoint of any interrupted refresh and start from scratch",
+        )
+        parser.add_argument(
+            "--profile-dir",
+            metavar="DIR",
+            help="Run each stage under cProfile and dump its stats to DIR/<stage>.prof",
+        )
+        parser.add_argument(
+            "--progress-interval",
+            type=float,
+            default=10.0,
+            help="Minimum number of seconds between progress messages (default 10)",
+        )
+
+    def handle(self, *args, **options):
+
+        unknown = set(options["stages"]) - set(pipeline.STAGE_NAMES)
+        if unknown:
+            raise CommandError(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+        try:
+            pipeline.run(
+                stages=options["stages"],
+                restart=options["restart"],
+                write=self.stdout.write,
+                profile_dir=options["profile_dir"],
+                progress_interval=options["progress_interval"],
+            )
+        except pipeline.PipelineLocked as e:
+            raise CommandError(str(e))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+
+from core import pipeline
+from core.jobs import Job
+
+
+JOBS = dict(pipeline.STAGES)
+
+
+class Command(BaseCommand):
+    help = "Runs a single stage of the ingestion pipeline with timing instrumentation (see also: refresh)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("job", choices=JOBS.keys())
+        parser.add_argument(
+            "--profile",
+            metavar="PATH",
+            help="Run the job under cProfile and dump the stats (pstats format) to PATH",
+        )
+        parser.add_argument(
+            "--progress-interval",
+            type=float,
+            default=10.0,
+            help="Minimum number of seconds between progress messages (default 10)",
+        )
+        parser.add_argument(
+            "--no-progress",
+            action="store_true",
+            help="Don't write progress messages",
+        )
+        parser.add_argument(
+            "--no-summary",
+            action="store_true",
+            help="Don't write the summary of stage timings at the end",
+        )
+
+    def handle(self, *args, **options):
+
+        job = Job(
+            options["job"],
+            write=self.stdout.write,
+            progress_interval=None if options["no_progress"] else options["progress_interval"],
+            profile=options["profile"],
+            summary=not options["no_summary"],
+        )
+
+        JOBS[options["job"]](job=job)
@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core import tasks
+
+import multiprocessing
+import signal
+import threading
+
+
+class Command(BaseCommand):
+    help = "Runs worker processes that execute the background jobs queued by the admin"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of worker processes (default 1)",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5.0,
+            help="Number of seconds to wait before checking for new jobs when the queue is empty (default 5)",
+        )
+        parser.add_argument(
+            "--stale-after",
+            type=float,
+            default=10*tasks.HEARTBEAT_INTERVAL,
+            help=(
+                "Number of seconds without a heartbeat after which a running job is assumed to have "
+                f"lost its worker and is marked as failed (default {10*tasks.HEARTBEAT_INTERVAL})"
+            ),
+        )
+
+    def work(self, poll_interval, stale_after):
+        # Finish the current job, then stop
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stop.set())
+        signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+        def write(message):
+            self.stdout.write(message)
+            self.stdout.flush()
+
+        tasks.work(stop, poll_interval=poll_interval, stale_after=stale_after, write=write)
+
+    def handle(self, *args, **options):
+
+        work_args = (options["poll_interval"], options["stale_after"])
+
+        if options["processes"] == 1:
+            self.work(*work_args)
+            return
+
+        # The forked processes mustn't share the parent's database connections
+        connections.close_all()
+
+        processes = [
+            multiprocessing.Process(target=self.work, args=work_args)
+            for _ in range(options["processes"])
+        ]
+        for process in processes:
+            process.start()
+
+        def stop(*args):
+            for process in processes:
+                process.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for process in processes:
+            process.join()
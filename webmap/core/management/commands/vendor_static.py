@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import staticassets
+
+import os
+import urllib.request
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks the pinned versions of the map's third-party libraries in the app's static files against "
+        "their committed SHA-256 digests, downloading any that are missing"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only check the libraries; a missing one is an error rather than downloaded",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Download the libraries even if they're already there",
+        )
+        parser.add_argument(
+            "--write-checksums",
+            action="store_true",
+            help=(
+                f"Record the digests of libraries that don't have one yet in {staticassets.VENDOR_CHECKSUMS} "
+                "(after checking any already recorded)"
+            ),
+        )
+
+    def handle(self, *args, **options):
+
+        if options["check"] and (options["force"] or options["write_checksums"]):
+            raise CommandError("--check can't be combined with --force or --write-checksums")
+
+        checksums = staticassets.read_checksums()
+
+        for path, url in staticassets.VENDOR_SCRIPTS:
+            destination = os.path.join(staticassets.STATIC_DIR, path)
+            filename = os.path.basename(path)
+
+            if os.path.exists(destination) and not options["force"]:
+                with open(destination, "rb") as f:
+                    checksums[filename] = self.check_digest(filename, f.read(), checksums.get(filename), destination, options)
+                self.stdout.write(f"{path} is already there")
+                continue
+
+            if options["check"]:
+                raise CommandError(f"{path} is missing (run vendor_static to download it)")
+
+            try:
+                with urllib.request.urlopen(url, timeout=30) as response:
+                    content = response.read()
+            except OSError as e:
+                raise CommandError(f"Couldn't download {url}: {e}")
+            checksums[filename] = self.check_digest(filename, content, checksums.get(filename), url, options)
+
+            # Write to a temporary file first, so that a failed download doesn't leave a truncated file behind
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            tmp_destination = destination + ".tmp"
+            with open(tmp_destination, "wb") as f:
+                f.write(content)
+            os.replace(tmp_destination, destination)
+
+            self.stdout.write(f"Downloaded {url} to {path}")
+
+        if options["write_checksums"]:
+            staticassets.write_checksums({
+                os.path.basename(path): checksums[os.path.basename(path)] for path, _ in staticassets.VENDOR_SCRIPTS
+            })
+            self.stdout.write(f"Wrote {staticassets.VENDOR_CHECKSUMS}")
+
+    def check_digest(self, filename, content, expected, source, options):
+        '''
+        Returns the digest of content, if it matches the recorded one. Without
+        a recorded digest, that's an error unless it's being recorded.
+        '''
+
+        digest = staticassets.sha256(content)
+        if expected is None:
+            if not options["write_checksums"]:
+                raise CommandError(
+                    f"No digest is recorded for {filename} in {staticassets.VENDOR_CHECKSUMS}; "
+                    "check the file and record its digest with --write-checksums"
+                )
+            self.stdout.write(self.style.WARNING(f"Recording the digest of {filename} ({digest}); check the file before committing it"))
+        elif digest != expected:
+            raise CommandError(f"{source} doesn't match its recorded SHA-256 digest ({expected})")
+        return digest
@@ -0,0 +1,404 @@
+'''
+Per-request instrumentation.
+
+RequestMetricsMiddleware records each request's wall time, database time,
+number of queries, and repeated query "fingerprints" (the same SQL run more
+than once, the hallmark of an N+1 pattern). These are
+
+  - added to the response as a Server-Timing header,
+  - accumulated per view and exposed in the Prometheus text format by the
+    metrics() view, and
+  - logged as a warning when a request exceeds settings.QUERY_BUDGET queries.
+
+Each worker process accumulates its metrics in memory, and saves them to its
+own file in settings.METRICS_DIR every settings.METRICS_FLUSH_INTERVAL seconds
+(from a background thread, so that requests don't wait on the disk), when it
+serves /metrics and when it exits. metrics() adds up the files of all the
+processes, so that a scrape covers every worker, whichever one serves it. The
+files of processes that have exited (e.g. workers recycled by uwsgi) are merged
+into an archive file, so the counters don't go backwards. Each file records
+the start time of its process, so that a new process that happens to get a
+dead worker's PID archives the old file rather than taking it over.
+'''
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+from collections import Counter, defaultdict
+import atexit
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Collapses "IN (%s, %s, %s)" into "IN (...)" so that lists of different lengths share a fingerprint
+IN_LIST = re.compile(r"IN \((?:%s, )*%s\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(sql):
+    return WHITESPACE.sub(" ", IN_LIST.sub("IN (...)", sql)).strip()
+
+
+class QueryRecorder:
+    '''
+    A database execute wrapper that times queries and counts their fingerprints
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    @property
+    def duplicates(self):
+        return {sql: n for sql, n in self.fingerprints.items() if n > 1}
+
+
+class ViewMetrics:
+
+    def __init__(self):
+        self.requests = 0
+        self.duration = 0.0
+        self.db_duration = 0.0
+        self.queries = 0
+        self.duplicate_queries = 0
+        self.over_budget = 0
+
+    def add(self, values):
+        for attribute, value in values.items():
+            setattr(self, attribute, getattr(self, attribute, 0) + value)
+
+
+# The file (in settings.METRICS_DIR) of the metrics of processes that have exited
+ARCHIVE_FILENAME = "archive.json"
+LOCK_FILENAME = "metrics.lock"
+
+
+def _process_identity(pid):
+    '''
+    Something that tells apart the processes that have had the given PID (the
+    start time of the running one, on Linux), or None if there's no such
+    process
+    '''
+
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except FileNotFoundError:
+        return None
+    except OSError:
+        # No /proc: fall back to whether the PID is in use
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+        return "alive"
+
+    # The fields after the (parenthesised) command name, the 20th of which is the start time
+    return stat.rsplit(")", 1)[1].split()[19]
+
+
+def _read(path):
+    '''
+    The contents of a metrics file ({} if it can't be read)
+    '''
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _add(total, views):
+    for view, values in views.items():
+        for attribute, value in values.items():
+            total.setdefault(view, {})
+            total[view][attribute] = total[view].get(attribute, 0) + value
+
+
+class MetricsStore:
+
+    def __init__(self, directory=None):
+        self.lock = threading.Lock()
+        self.views = defaultdict(ViewMetrics)
+        self._directory = directory
+        # The process whose metrics self.views holds (they're reset in a forked child)
+        self._pid = None
+        self._identity = None
+
+    @property
+    def directory(self):
+        return self._directory or settings.METRICS_DIR
+
+    def record(self, view, duration, recorder, over_budget):
+        with self.lock:
+            if self._pid != os.getpid():
+                self._start()
+
+            metrics = self.views[view]
+            metrics.requests += 1
+            metrics.duration += duration
+            metrics.db_duration += recorder.duration
+            metrics.queries += recorder.count
+            metrics.duplicate_queries += sum(n - 1 for n in recorder.duplicates.values())
+            metrics.over_budget += over_budget
+
+    def _start(self):
+        '''
+        Starts recording in this process: from nothing (rather than from
+        whatever a forked child inherited from its parent), and with a thread
+        that saves the metrics periodically and at exit
+        '''
+
+        self._pid = os.getpid()
+        self._identity = _process_identity(self._pid)
+        self.views = defaultdict(ViewMetrics)
+
+        threading.Thread(target=self._flush_periodically, name="metrics-flush", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _flush_periodically(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        '''
+        Saves this process's metrics to its file (if it has recorded any).
+        Any file of an earlier process with the same PID is archived first.
+        '''
+
+        with self.lock:
+            if self._pid != os.getpid():
+                return
+            data = {
+                "identity": self._identity,
+                "views": {view: dict(vars(metrics)) for view, metrics in self.views.items()},
+            }
+
+        path = os.path.join(self.directory, f"{self._pid}.json")
+        try:
+            with self._directory_lock():
+                previous = _read(path)
+                if previous and previous.get("identity") != self._identity:
+                    self._archive([path])
+                _write(path, data)
+        except OSError:
+            logger.exception("Couldn't save the request metrics")
+
+    def close(self):
+        '''
+        Stops saving this store's metrics (which are discarded)
+        '''
+
+        with self.lock:
+            self._pid = None
+
+    @contextlib.contextmanager
+    def _directory_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILENAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _archive(self, paths):
+        '''
+        Merges the given process files into the archive, and deletes them
+        (with the directory locked). Returns the archive.
+        '''
+
+        archive_path = os.path.join(self.directory, ARCHIVE_FILENAME)
+        archive = _read(archive_path)
+        if paths:
+            for path in paths:
+                _add(archive, _read(path).get("views", {}))
+            _write(archive_path, archive)
+            for path in paths:
+                os.remove(path)
+        return archive
+
+    def collect(self):
+        '''
+        The metrics of every process, added up per view, as {view: ViewMetrics}.
+        The files of processes that have exited are merged into the archive.
+        '''
+
+        # Include this process's latest requests
+        self.flush()
+
+        with self._directory_lock():
+            live = []
+            exited = []
+            for filename in os.listdir(self.directory):
+                pid, extension = os.path.splitext(filename)
+                if extension != ".json" or not pid.isdecimal():
+                    continue
+                path = os.path.join(self.directory, filename)
+                data = _read(path)
+                identity = _process_identity(int(pid))
+                if identity is not None and data.get("identity") == identity:
+                    live.append(data)
+                else:
+                    exited.append(path)
+
+            archive = self._archive(exited)
+
+        views = defaultdict(ViewMetrics)
+        for process_views in [archive] + [data.get("views", {}) for data in live]:
+            for view, values in process_views.items():
+                views[view].add(values)
+
+        return views
+
+    def prometheus(self):
+        '''
+        The metrics of every process, added up, in the Prometheus text
+        exposition format
+        '''
+
+        families = [
+            ("pulsarsky_requests_total", "counter", "Number of requests handled", "requests"),
+            ("pulsarsky_request_duration_seconds_total", "counter", "Total wall time spent handling requests", "duration"),
+            ("pulsarsky_request_db_duration_seconds_total", "counter", "Total time spent in database queries", "db_duration"),
+            ("pulsarsky_request_queries_total", "counter", "Number of database queries", "queries"),
+            ("pulsarsky_request_duplicate_queries_total", "counter", "Number of queries repeating an earlier query of the same request", "duplicate_queries"),
+            ("pulsarsky_request_over_query_budget_total", "counter", "Number of requests exceeding the query budget", "over_budget"),
+        ]
+
+        views = self.collect()
+        lines = []
+        for name, metric_type, description, attribute in families:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for view, metrics in sorted(views.items()):
+                lines.append(f'{name}{{view="{view}"}} {getattr(metrics, attribute)}')
+
+        return "\n".join(lines) + "\n"
+
+
+store = MetricsStore()
+
+
+def _view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    return match.view_name or match._func_path
+
+
+class RequestMetricsMiddleware:
+    '''
+    Supports both WSGI and ASGI. Under ASGI, queries made by async views run
+    in the request's thread-sensitive executor thread (whose database
+    connection is the one that gets the execute wrapper), so the wrapper is
+    installed and removed in that thread.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        recorder = QueryRecorder()
+
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            self.record_queries(stack, recorder)
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        return self.process_metrics(request, response, recorder, duration)
+
+    async def __acall__(self, request):
+
+        recorder = QueryRecorder()
+
+        start = time.perf_counter()
+        stack = contextlib.ExitStack()
+        await sync_to_async(self.record_queries)(stack, recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        duration = time.perf_counter() - start
+
+        return self.process_metrics(request, response, recorder, duration)
+
+    def record_queries(self, stack, recorder):
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+
+    def process_metrics(self, request, response, recorder, duration):
+
+        view = _view_name(request)
+
+        budget = getattr(settings, "QUERY_BUDGET", None)
+        over_budget = budget is not None and recorder.count > budget
+        if over_budget:
+            duplicates = sorted(recorder.duplicates.items(), key=lambda item: -item[1])
+            logger.warning(
+                "%s (%s) made %d queries (budget %d) in %.1f ms, %d of them repeated:\n%s",
+                request.path, view, recorder.count, budget, duration*1e3,
+                sum(n - 1 for _, n in duplicates),
+                "\n".join(f"  {n} × {sql}" for sql, n in duplicates[:5]),
+            )
+
+        store.record(view, duration, recorder, over_budget)
+
+        response["Server-Timing"] = (
+            f'total;dur={duration*1e3:.1f}, '
+            f'db;dur={recorder.duration*1e3:.1f};desc="{recorder.count} queries"'
+        )
+
+        return response
+
+
+def metrics(request):
+    '''
+    Serves the request metrics accumulated by all the workers to local clients
+    '''
+
+    if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+
+    return HttpResponse(store.prometheus(), content_type="text/plain; version=0.0.4")
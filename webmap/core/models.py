@@ -1,13 +1,18 @@
-from django.db import models
-from django.db.models import Q
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Q, F
 from django.utils.html import format_html
 
 from django.core.exceptions import ValidationError
 
 import literature.models as literature_models
 
-from astropy.coordinates import SkyCoord
-import astropy.units as u
+from . import revisions
+
+from collections import defaultdict
+
+# astropy is imported where it's used, rather than here, so that the web
+# workers only import it if they need it (it takes a few tenths of a second)
 
 # Create your models here.
 
@@ -152,6 +157,8 @@ class Pulsar(models.Model):
     @property
     def ra_dec(self):
         if self.ra and self.dec:
+            from astropy.coordinates import SkyCoord
+            import astropy.units as u
             coord = SkyCoord(ra=self.ra*u.deg, dec=self.dec*u.deg)
             return coord.to_string('hmsdms', precision=1)
 
@@ -173,6 +180,11 @@ class Pulsar(models.Model):
 
     class Meta:
         ordering = ("ra", "dec",)
+        indexes = [
+            # Lookups by bname alone are served by the unique_names constraint
+            models.Index(fields=["jname"], name="pulsar_jname_idx"),
+            models.Index(fields=["ra", "dec"], name="pulsar_ra_dec_idx"),
+        ]
         constraints = [
             models.CheckConstraint(
                 check=Q(bname__isnull=False) | Q(jname__isnull=False),
@@ -223,6 +235,15 @@ class SpectrumModelParameter(models.Model):
         unique_together = [["spectrum_model", "name"]]
 
 
+class SpectralFitQuerySet(models.QuerySet):
+
+    def active(self):
+        '''
+        Only the fits of parameters that belong to their pulsar's selected spectrum model
+        '''
+        return self.filter(parameter__spectrum_model=F('pulsar__spectrum_model'))
+
+
 class SpectralFit(models.Model):
 
     pulsar = models.ForeignKey(
@@ -239,12 +260,170 @@ class SpectralFit(models.Model):
 
     value = models.FloatField()
 
+    error = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="The 1σ uncertainty of the fitted value, if known.",
+    )
+
+    objects = SpectralFitQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.pulsar}: {self.parameter} = {self.value}"
 
     class Meta:
         ordering = ("pulsar", "parameter",)
         unique_together = [["pulsar", "parameter"]]
+        indexes = [
+            # Covers the map's fits join without reading the table rows
+            models.Index(fields=["pulsar", "parameter", "value"], name="fit_pulsar_param_value_idx"),
+        ]
+
+
+class SpectralFitCovariance(models.Model):
+    '''
+    The covariance matrix of the parameters of a pulsar's fit of a spectrum model
+    '''
+
+    pulsar = models.ForeignKey(
+        "Pulsar",
+        on_delete=models.CASCADE,
+        related_name="fit_covariances",
+    )
+
+    spectrum_model = models.ForeignKey(
+        "SpectrumModel",
+        on_delete=models.CASCADE,
+        related_name="fit_covariances",
+    )
+
+    parameter_names = models.JSONField(
+        help_text="The names of the parameters, in the order of the matrix's rows and columns.",
+    )
+
+    matrix = models.JSONField(
+        help_text="The covariance matrix, as a list of rows.",
+    )
+
+    def __str__(self):
+        return f"{self.pulsar}: {self.spectrum_model} covariance"
+
+    class Meta:
+        ordering = ("pulsar", "spectrum_model",)
+        unique_together = [["pulsar", "spectrum_model"]]
+
+
+class ActiveSpectralFit(models.Model):
+    '''
+    A denormalised copy of each pulsar's active spectral fit, i.e. the
+    SpectralFit values of the parameters belonging to the pulsar's
+    spectrum_model. This is kept up to date by the signal handlers in
+    core.signals, so that all active spectra can be read with one row per
+    pulsar instead of joining fits, parameters and models.
+    '''
+
+    pulsar = models.OneToOneField(
+        "Pulsar",
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="active_fit",
+    )
+
+    spectrum_model_name = models.CharField(
+        max_length=128,
+        help_text="The pulsar_spectra name of the pulsar's spectrum model.",
+    )
+
+    parameters = models.JSONField(
+        help_text="The fitted parameter values, as {name: value}.",
+    )
+
+    errors = models.JSONField(
+        default=dict,
+        help_text="The 1σ uncertainties of the fitted parameter values that have them, as {name: error}.",
+    )
+
+    covariance = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="The covariance matrix of the fit, as {\"parameter_names\": [...], \"matrix\": [[...], ...]}, if known.",
+    )
+
+    @classmethod
+    def refresh(cls, pulsar_ids=None):
+        '''
+        Rebuilds the active fits of the given pulsars (or of all pulsars, if
+        pulsar_ids is None) from the SpectralFit table. Only the rows that
+        have changed are rewritten, and the catalogue's revision is only
+        bumped (once the transaction commits) if any have. Returns whether
+        any had.
+        '''
+
+        pulsars = Pulsar.objects.all()
+        if pulsar_ids is not None:
+            pulsars = pulsars.filter(pk__in=pulsar_ids)
+
+        fits = SpectralFit.objects.active().filter(
+            pulsar__in=pulsars,
+        ).values_list('pulsar_id', 'parameter__name', 'value', 'error')
+
+        parameters = defaultdict(dict)
+        errors = defaultdict(dict)
+        for pulsar_id, name, value, error in fits:
+            parameters[pulsar_id][name] = value
+            if error is not None:
+                errors[pulsar_id][name] = error
+
+        covariances = {
+            pulsar_id: {'parameter_names': parameter_names, 'matrix': matrix}
+            for pulsar_id, parameter_names, matrix in SpectralFitCovariance.objects.filter(
+                pulsar__in=pulsars,
+                spectrum_model=F('pulsar__spectrum_model'),
+            ).values_list('pulsar_id', 'parameter_names', 'matrix')
+        }
+
+        active_fits = {
+            pulsar_id: cls(
+                pulsar_id=pulsar_id,
+                spectrum_model_name=spectrum_model_name,
+                parameters=parameters[pulsar_id],
+                errors=errors[pulsar_id],
+                covariance=covariances.get(pulsar_id),
+            )
+            for pulsar_id, spectrum_model_name in pulsars.filter(spectrum_model__isnull=False).values_list(
+                'id', 'spectrum_model__pulsar_spectra_name',
+            )
+            if pulsar_id in parameters
+        }
+
+        with transaction.atomic():
+            existing = {
+                pulsar_id: values
+                for pulsar_id, *values in cls.objects.filter(pulsar__in=pulsars).values_list(
+                    'pulsar_id', 'spectrum_model_name', 'parameters', 'errors', 'covariance',
+                )
+            }
+            changed = [
+                active_fit for pulsar_id, active_fit in active_fits.items()
+                if existing.get(pulsar_id) != [
+                    active_fit.spectrum_model_name, active_fit.parameters, active_fit.errors, active_fit.covariance,
+                ]
+            ]
+            removed = [pulsar_id for pulsar_id in existing if pulsar_id not in active_fits]
+            if not changed and not removed:
+                return False
+
+            cls.objects.filter(pulsar__in=removed + [active_fit.pulsar_id for active_fit in changed]).delete()
+            cls.objects.bulk_create(changed)
+            transaction.on_commit(lambda: revisions.bump_revision(revisions.CATALOGUE))
+
+        return True
+
+    def __str__(self):
+        return f"{self.pulsar}: {self.spectrum_model_name}"
+
+    class Meta:
+        ordering = ("pulsar",)
 
 
 class PulsarProperty(models.Model):
@@ -281,6 +460,8 @@ class PulsarProperty(models.Model):
 
     def clean(self):
 
+        import astropy.units as u
+
         if self.unit:
             try:
                 unit = u.Unit(self.unit)
@@ -400,6 +581,7 @@ class PulsarPropertyMeasurement(models.Model):
             valstr += f" ± {self.error}"
 
         if self.unit:
+            import astropy.units as u
             valstr += f" {u.Unit(self.unit)}"
 
         if self.is_lower_limit:
@@ -411,6 +593,8 @@ class PulsarPropertyMeasurement(models.Model):
 
     def clean(self):
 
+        import astropy.units as u
+
         if self.unit:
             try:
                 u1 = u.Unit(self.unit)
@@ -426,6 +610,10 @@ class PulsarPropertyMeasurement(models.Model):
 
     class Meta:
         ordering = ("pulsar", "pulsar_property", "bibtex__year",)
+        indexes = [
+            models.Index(fields=["pulsar", "pulsar_property", "mjd"], name="ppm_pulsar_property_mjd_idx"),
+            models.Index(fields=["pulsar_property", "freq_MHz"], name="ppm_property_freq_idx"),
+        ]
 
 
 class PulsarMention(models.Model):
@@ -471,3 +659,132 @@ class PulsarMention(models.Model):
             ),
         ]
 
+
+
+class BackgroundJob(models.Model):
+    '''
+    A task queued to run outside of the web request that asked for it (e.g.
+    by an admin action), and its progress. Queued jobs are picked up by the
+    workers started with "python manage.py run_worker"; see core.tasks.
+    '''
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+
+    task = models.CharField(
+        max_length=64,
+        help_text="The name of the task to run (one of core.tasks.TASKS).",
+    )
+
+    arguments = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="The keyword arguments to pass to the task.",
+    )
+
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=QUEUED,
+    )
+
+    requested_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        help_text="The user who queued the job.",
+    )
+
+    progress_done = models.IntegerField(
+        default=0,
+        help_text="The number of items processed so far.",
+    )
+
+    progress_total = models.IntegerField(
+        null=True,
+        blank=True,
+        help_text="The total number of items to process, if known.",
+    )
+
+    message = models.CharField(
+        max_length=256,
+        blank=True,
+        help_text="The latest progress message.",
+    )
+
+    output = models.TextField(
+        blank=True,
+        help_text="The job's summary on completion, or the traceback if it failed.",
+    )
+
+    worker = models.CharField(
+        max_length=128,
+        blank=True,
+        help_text="The worker (host:PID) running the job.",
+    )
+
+    created = models.DateTimeField(
+        auto_now_add=True,
+    )
+
+    started = models.DateTimeField(
+        null=True,
+        blank=True,
+    )
+
+    finished = models.DateTimeField(
+        null=True,
+        blank=True,
+    )
+
+    heartbeat = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Updated periodically by the worker while the job is running.",
+    )
+
+    @property
+    def duration(self):
+        if self.started and self.finished:
+            return self.finished - self.started
+        return None
+
+    def __str__(self):
+        return f"{self.task} #{self.pk} ({self.status})"
+
+    class Meta:
+        ordering = ("-created",)
+        indexes = [
+            # Workers look for the oldest queued job
+            models.Index(fields=["status", "created"], name="backgroundjob_status_idx"),
+        ]
+
+
+class Revision(models.Model):
+    '''
+    A revision counter of core.revisions. The counters are kept here, rather
+    than only in the cache, so that they can be incremented atomically by any
+    number of processes.
+    '''
+
+    name = models.CharField(
+        max_length=64,
+        primary_key=True,
+    )
+
+    value = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
@@ -0,0 +1,169 @@
+'''
+The ingestion pipeline: the import and fitting jobs, run in dependency order.
+
+Progress is checkpointed to a JSON file (settings.PIPELINE_CHECKPOINT_FILE)
+after each completed stage, and periodically within the resumable stages, so
+that an interrupted refresh picks up where it stopped. A lock file
+(settings.PIPELINE_LOCK_FILE) prevents two refreshes from running at once.
+'''
+
+from django.conf import settings
+
+from . import httpcache
+from . import ingest
+from . import models
+from . import snapshot
+from . import warmup
+from .jobs import Job
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+
+
+def refresh_active_fits(job=None):
+    with (job or Job("refresh_active_fits", summary=False)) as job:
+        with job.stage("db write"):
+            models.ActiveSpectralFit.refresh()
+
+
+# (name, job function), in dependency order
+STAGES = [
+    ('init_spectrum_models', ingest.init_spectrum_models),
+    ('import_atnf', ingest.import_atnf),
+    ('update_atnf_fluxes', ingest.update_atnf_fluxes),
+    ('import_spectra', ingest.import_spectra),
+    ('set_all_atnf_power_laws', ingest.set_all_atnf_power_laws),
+    ('refresh_active_fits', refresh_active_fits),
+    ('write_snapshot', snapshot.write_snapshot),
+    ('warm_up', warmup.warm_up),
+    ('purge_proxy_cache', httpcache.purge_proxy_cache),
+]
+
+STAGE_NAMES = [name for name, _ in STAGES]
+
+
+class PipelineLocked(Exception):
+    pass
+
+
+@contextmanager
+def pipeline_lock(path=None):
+    '''
+    Holds an exclusive lock on the pipeline's lock file, or raises
+    PipelineLocked if another process already holds it
+    '''
+
+    path = path or settings.PIPELINE_LOCK_FILE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, "a+") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.seek(0)
+            raise PipelineLocked(f"Another refresh is already running (PID {lock_file.read().strip() or 'unknown'})")
+
+        try:
+            lock_file.truncate(0)
+            lock_file.write(str(os.getpid()))
+            lock_file.flush()
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class Checkpoint:
+    '''
+    The pipeline's progress: the completed stages, and how far the current
+    stage had got (its last job.checkpoint() value)
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or settings.PIPELINE_CHECKPOINT_FILE
+        self.completed = []
+        self.stage = None
+        self.position = None
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.completed = state.get('completed', [])
+            self.stage = state.get('stage')
+            self.position = state.get('position')
+
+    @property
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Write to a temporary file and rename it, so that an interruption can't leave a half-written checkpoint
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'completed': self.completed, 'stage': self.stage, 'position': self.position}, f)
+        os.replace(tmp_path, self.path)
+
+    def start_stage(self, name):
+        if self.stage != name:
+            self.stage = name
+            self.position = None
+        self.save()
+
+    def update_position(self, position):
+        self.position = position
+        self.save()
+
+    def complete_stage(self, name):
+        self.completed.append(name)
+        self.stage = None
+        self.position = None
+        self.save()
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run(stages=None, restart=False, write=print, profile_dir=None, progress_interval=10.0):
+    '''
+    Runs the named stages (default: all of them) in dependency order,
+    resuming from the checkpoint of an interrupted run unless restart is True.
+    If profile_dir is given, each stage's cProfile stats are dumped to
+    <profile_dir>/<stage>.prof.
+    '''
+
+    stages = stages or STAGE_NAMES
+
+    with pipeline_lock():
+        checkpoint = Checkpoint()
+        if restart:
+            checkpoint.clear()
+            checkpoint = Checkpoint()
+        elif checkpoint.exists:
+            write(f"Resuming refresh: already completed {checkpoint.completed or 'nothing'}")
+
+        for name, function in STAGES:
+            if name not in stages:
+                continue
+            if name in checkpoint.completed:
+                write(f"Skipping {name} (already completed)")
+                continue
+
+            checkpoint.start_stage(name)
+            job = Job(
+                name,
+                write=write,
+                progress_interval=progress_interval,
+                profile=os.path.join(profile_dir, f"{name}.prof") if profile_dir else None,
+                checkpoint=checkpoint.update_position,
+                resume=checkpoint.position,
+            )
+            if job.resume is not None:
+                write(f"Resuming {name} after {job.resume}")
+            function(job=job)
+            checkpoint.complete_stage(name)
+
+        # Everything's done, so the next refresh starts from scratch
+        checkpoint.clear()
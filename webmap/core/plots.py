@@ -0,0 +1,310 @@
+'''
+Plots of pulsars' spectra: the ATNF flux densities (with their errors) and
+the active spectral fit's curve (with its 1σ band), on log-log axes.
+
+SVGs are generated directly from the sampled curve in core.details, without
+a plotting library. PNGs are drawn with matplotlib (a dependency of
+pulsar_spectra), which is only imported when a PNG is first requested.
+
+Plots are cached per (pulsar, revision of its details), so they are redrawn
+only after the pulsar's fits or flux densities change, and the plots of the
+brightest pulsars can be drawn in advance with warm_spectrum_plots().
+'''
+
+from django.core.cache import cache
+
+from . import details
+from . import snapshot
+from .jobs import Job
+
+from xml.sax.saxutils import escape
+import io
+import math
+
+import numpy as np
+
+
+# The plots of this many of the brightest pulsars (at SPECTRUM_PLOT_WARM_FREQ_MHZ)
+# are drawn by warm_spectrum_plots()
+SPECTRUM_PLOT_WARM_COUNT = 200
+SPECTRUM_PLOT_WARM_FREQ_MHZ = 1400
+
+# The size (px) of the plots, and of the margins around their axes
+PLOT_WIDTH = 480
+PLOT_HEIGHT = 360
+MARGIN_LEFT = 70
+MARGIN_RIGHT = 15
+MARGIN_TOP = 30
+MARGIN_BOTTOM = 45
+
+
+class PlotUnavailable(Exception):
+    pass
+
+
+def spectrum_data(pulsar):
+    '''
+    The arrays to plot from a pulsar's details (see core.details): the ATNF
+    frequencies (MHz), flux densities and errors (Jy, NaN where unknown), and
+    the fit's frequencies, flux densities and errors (empty if it has no fit)
+    '''
+
+    atnf_fluxes = pulsar['atnf_fluxes']
+    points = (
+        np.array([flux['freq'] for flux in atnf_fluxes], dtype=np.float64),
+        # The ATNF flux densities are in mJy
+        np.array([flux['flux'] for flux in atnf_fluxes], dtype=np.float64) / 1e3,
+        np.array([np.nan if flux['error'] is None else flux['error'] for flux in atnf_fluxes], dtype=np.float64) / 1e3,
+    )
+
+    curve = pulsar['curve'] or {'freq_MHz': [], 'flux': [], 'error': []}
+    curve = tuple(
+        np.array([np.nan if value is None else value for value in curve[name]], dtype=np.float64)
+        for name in ('freq_MHz', 'flux', 'error')
+    )
+
+    return points, curve
+
+
+def axis_limits(points, curve):
+    '''
+    The decades (log10) spanned by the axes: ((x_min, x_max), (y_min, y_max))
+    '''
+
+    (freqs, fluxes, _), (curve_freqs, curve_fluxes, _) = points, curve
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_freqs = np.log10(np.concatenate([freqs, curve_freqs]))
+        log_fluxes = np.log10(fluxes[fluxes > 0])
+        log_curve = np.log10(curve_fluxes[curve_fluxes > 0])
+
+    log_freqs = log_freqs[np.isfinite(log_freqs)]
+    if len(log_freqs) == 0:
+        log_freqs = np.log10([details.CURVE_MIN_FREQ_MHZ, details.CURVE_MAX_FREQ_MHZ])
+
+    # The curve can run off to extremes at the ends of the frequency range, so
+    # when there are points it's only allowed to widen the axis a little
+    if len(log_fluxes):
+        log_curve = np.clip(log_curve, log_fluxes.min() - 1, log_fluxes.max() + 1)
+    log_fluxes = np.concatenate([log_fluxes, log_curve])
+    if len(log_fluxes) == 0:
+        log_fluxes = np.array([-3.0, 0.0])
+
+    x = (math.floor(log_freqs.min()), math.ceil(log_freqs.max()))
+    y = (math.floor(log_fluxes.min()), math.ceil(log_fluxes.max()))
+    if y[1] - y[0] < 2:
+        y = (y[0] - 1, y[1] + 1)
+
+    return x, y
+
+
+def _format_decade(decade):
+    return f'10<tspan dy="-6" font-size="8">{decade}</tspan>'
+
+
+def spectrum_svg(pulsar):
+    '''
+    The spectrum of a pulsar (from its details) as an SVG document
+    '''
+
+    points, curve = spectrum_data(pulsar)
+    (x_min, x_max), (y_min, y_max) = axis_limits(points, curve)
+
+    left, right = MARGIN_LEFT, PLOT_WIDTH - MARGIN_RIGHT
+    top, bottom = MARGIN_TOP, PLOT_HEIGHT - MARGIN_BOTTOM
+
+    def x(freqs):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return left + (np.log10(freqs) - x_min) / (x_max - x_min) * (right - left)
+
+    def y(fluxes):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Non-positive flux densities (e.g. the lower end of a large error) go off the bottom
+            return bottom - (np.log10(np.where(fluxes > 0, fluxes, 10.0**(y_min - 1))) - y_min) / (y_max - y_min) * (bottom - top)
+
+    def path(xs, ys):
+        return " ".join(
+            f"{'M' if i == 0 else 'L'}{px:.1f},{py:.1f}"
+            for i, (px, py) in enumerate(zip(xs, ys))
+        )
+
+    elements = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{PLOT_WIDTH}" height="{PLOT_HEIGHT}" '
+        f'viewBox="0 0 {PLOT_WIDTH} {PLOT_HEIGHT}" font-family="sans-serif" font-size="11">',
+        f'<defs><clipPath id="plot-area"><rect x="{left}" y="{top}" width="{right - left}" height="{bottom - top}"/></clipPath></defs>',
+        f'<rect width="{PLOT_WIDTH}" height="{PLOT_HEIGHT}" fill="white"/>',
+        f'<text x="{(left + right) / 2}" y="{top - 10}" text-anchor="middle" font-size="13">{escape(pulsar["name"])}</text>',
+    ]
+
+    # Axes, with a tick and a label at each decade
+    elements.append(f'<rect x="{left}" y="{top}" width="{right - left}" height="{bottom - top}" fill="none" stroke="black"/>')
+    for decade in range(x_min, x_max + 1):
+        px = x(10.0**decade)
+        elements.append(f'<line x1="{px:.1f}" y1="{bottom}" x2="{px:.1f}" y2="{bottom - 5}" stroke="black"/>')
+        elements.append(f'<text x="{px:.1f}" y="{bottom + 16}" text-anchor="middle">{_format_decade(decade)}</text>')
+    for decade in range(y_min, y_max + 1):
+        py = y(10.0**decade)
+        elements.append(f'<line x1="{left}" y1="{py:.1f}" x2="{left + 5}" y2="{py:.1f}" stroke="black"/>')
+        elements.append(f'<text x="{left - 6}" y="{py + 4:.1f}" text-anchor="end">{_format_decade(decade)}</text>')
+    elements.append(f'<text x="{(left + right) / 2}" y="{PLOT_HEIGHT - 8}" text-anchor="middle">Frequency (MHz)</text>')
+    elements.append(
+        f'<text x="14" y="{(top + bottom) / 2}" text-anchor="middle" '
+        f'transform="rotate(-90 14 {(top + bottom) / 2})">Flux density (Jy)</text>'
+    )
+
+    elements.append('<g clip-path="url(#plot-area)">')
+
+    # The fit, with its 1σ band where the uncertainties are known
+    curve_freqs, curve_fluxes, curve_errors = curve
+    known = np.isfinite(curve_fluxes)
+    banded = known & np.isfinite(curve_errors)
+    if np.any(banded):
+        band_freqs = curve_freqs[banded]
+        upper = curve_fluxes[banded] + curve_errors[banded]
+        lower = curve_fluxes[banded] - curve_errors[banded]
+        band = path(
+            np.concatenate([x(band_freqs), x(band_freqs[::-1])]),
+            np.concatenate([y(upper), y(lower[::-1])]),
+        )
+        elements.append(f'<path d="{band} Z" fill="steelblue" fill-opacity="0.25" stroke="none"/>')
+    if np.any(known):
+        elements.append(f'<path d="{path(x(curve_freqs[known]), y(curve_fluxes[known]))}" fill="none" stroke="steelblue" stroke-width="2"/>')
+
+    # The ATNF flux densities, with error bars
+    freqs, fluxes, errors = points
+    for px, py, flux, error in zip(x(freqs), y(fluxes), fluxes, errors):
+        if not np.isnan(error):
+            elements.append(
+                f'<line x1="{px:.1f}" y1="{y(np.array(flux + error)):.1f}" '
+                f'x2="{px:.1f}" y2="{y(np.array(flux - error)):.1f}" stroke="black"/>'
+            )
+        elements.append(f'<circle cx="{px:.1f}" cy="{py:.1f}" r="3" fill="black"/>')
+
+    elements.append('</g>')
+    elements.append('</svg>')
+
+    return "\n".join(elements).encode("utf-8")
+
+
+def _matplotlib():
+    try:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+    except ImportError:
+        raise PlotUnavailable("PNG plots need matplotlib, which isn't installed")
+    return Figure, FigureCanvasAgg
+
+
+def spectrum_png(pulsar):
+    '''
+    The spectrum of a pulsar (from its details) as a PNG image
+    '''
+
+    # Figure is used directly (rather than pyplot), so that no global state is
+    # shared between the threads serving requests
+    Figure, FigureCanvasAgg = _matplotlib()
+
+    points, curve = spectrum_data(pulsar)
+    (x_min, x_max), (y_min, y_max) = axis_limits(points, curve)
+
+    figure = Figure(figsize=(PLOT_WIDTH / 100, PLOT_HEIGHT / 100), dpi=100)
+    FigureCanvasAgg(figure)
+    # Fixed margins, as for the SVGs (tight_layout() would take longer than the rest of the drawing)
+    axes = figure.add_axes([
+        MARGIN_LEFT / PLOT_WIDTH,
+        MARGIN_BOTTOM / PLOT_HEIGHT,
+        1 - (MARGIN_LEFT + MARGIN_RIGHT) / PLOT_WIDTH,
+        1 - (MARGIN_TOP + MARGIN_BOTTOM) / PLOT_HEIGHT,
+    ])
+
+    curve_freqs, curve_fluxes, curve_errors = curve
+    if np.any(np.isfinite(curve_errors)):
+        axes.fill_between(curve_freqs, curve_fluxes - curve_errors, curve_fluxes + curve_errors, color="steelblue", alpha=0.25, linewidth=0)
+    if np.any(np.isfinite(curve_fluxes)):
+        axes.plot(curve_freqs, curve_fluxes, color="steelblue", linewidth=2)
+
+    freqs, fluxes, errors = points
+    if len(freqs):
+        axes.errorbar(freqs, fluxes, yerr=np.where(np.isnan(errors), 0, errors), fmt="o", color="black", markersize=4)
+
+    axes.set_xscale("log")
+    axes.set_yscale("log")
+    axes.set_xlim(10.0**x_min, 10.0**x_max)
+    axes.set_ylim(10.0**y_min, 10.0**y_max)
+    # Ticks at each decade only, as for the SVGs (matplotlib's log tick
+    # locators and formatters take most of the drawing time)
+    axes.minorticks_off()
+    axes.set_xticks([10.0**decade for decade in range(x_min, x_max + 1)], labels=[f"$10^{{{decade}}}$" for decade in range(x_min, x_max + 1)])
+    axes.set_yticks([10.0**decade for decade in range(y_min, y_max + 1)], labels=[f"$10^{{{decade}}}$" for decade in range(y_min, y_max + 1)])
+    axes.set_xlabel("Frequency (MHz)")
+    axes.set_ylabel("Flux density (Jy)")
+    axes.set_title(pulsar["name"])
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+# format: (content type, renderer)
+PLOT_FORMATS = {
+    'svg': ('image/svg+xml', spectrum_svg),
+    'png': ('image/png', spectrum_png),
+}
+
+
+def cached_spectrum_plot(pk, plot_format):
+    '''
+    The spectrum plot of the pulsar with the given ID in the given format (see
+    PLOT_FORMATS), as bytes, or None if there's no such pulsar. Raises
+    PlotUnavailable if the format's dependencies aren't installed.
+    '''
+
+    _, renderer = PLOT_FORMATS[plot_format]
+
+    key = f"spectrum_plot:{plot_format}:{details.details_revision(pk)}:{pk}"
+    plot = cache.get(key)
+    if plot is None:
+        pulsar = details.cached_pulsar_details(pk)
+        if pulsar is None:
+            return None
+        plot = renderer(pulsar)
+        cache.set(key, plot)
+    return plot
+
+
+def brightest_pulsars(count, freq_MHz):
+    '''
+    The IDs of the count pulsars with the highest flux densities at freq_MHz
+    predicted by their active fits, brightest first
+    '''
+
+    catalogue = snapshot.get_snapshot()
+    fluxes, _ = catalogue.predict_fluxes(np.array([freq_MHz * 1e6]))
+    fluxes = np.nan_to_num(fluxes[:, 0], nan=-np.inf)
+    order = np.argsort(-fluxes, kind='stable')
+    order = order[np.isfinite(fluxes[order])][:count]
+    return catalogue.columns['id'][order].tolist()
+
+
+def warm_spectrum_plots(job=None, count=SPECTRUM_PLOT_WARM_COUNT, freq_MHz=SPECTRUM_PLOT_WARM_FREQ_MHZ, plot_formats=None):
+    '''
+    Draws (and caches) the spectrum plots of the brightest pulsars, so that
+    they're ready before anyone asks for them. Formats whose dependencies
+    aren't installed are skipped.
+    '''
+
+    plot_formats = plot_formats or list(PLOT_FORMATS)
+
+    with (job or Job("warm_spectrum_plots")) as job:
+        with job.stage("db read"):
+            pulsar_ids = brightest_pulsars(count, freq_MHz)
+
+        for i, pk in enumerate(pulsar_ids):
+            for plot_format in plot_formats:
+                with job.stage(f"render {plot_format}"):
+                    try:
+                        cached_spectrum_plot(pk, plot_format)
+                    except PlotUnavailable:
+                        continue
+                job.count(f"{plot_format} plots")
+            job.progress(i + 1, len(pulsar_ids))
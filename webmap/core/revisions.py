@@ -0,0 +1,102 @@
+'''
+Revision counters used to invalidate cached, derived data.
+
+Each counter is a row of the Revision table, incremented atomically (in the
+database) by the signal handlers in core.signals whenever the underlying
+tables are written to. Cache keys for derived data include the current
+revision, so stale entries simply stop being looked up.
+
+The counters are read through the default cache (shared between worker
+processes), so that reading one doesn't cost a query on every request. A bump
+deletes the cached copy once it's committed; the copies also expire after
+REVISION_CACHE_TIMEOUT seconds, which bounds how long a copy read just before
+a bump (and cached just after it) can be served.
+
+A counter starts from the current time (in ns) rather than from zero, so that
+it can't collide with an old revision if the table is emptied.
+'''
+
+import time
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+# How long (seconds) a counter is cached for
+REVISION_CACHE_TIMEOUT = 10
+
+MEASUREMENTS = "measurements"
+CATALOGUE = "catalogue"
+
+# Rows that the details of every pulsar depend on (spectrum models, properties,
+# references); each pulsar's own rows are covered by pulsar(pk)
+PULSARS = "pulsars"
+
+
+def pulsar(pk):
+    '''
+    The name of the revision counter of a single pulsar's details
+    '''
+    return f"pulsar:{pk}"
+
+
+def _key(name):
+    return f"revision:{name}"
+
+
+def _read(name):
+    from .models import Revision
+
+    revision = Revision.objects.filter(name=name).values_list('value', flat=True).first()
+    if revision is None:
+        try:
+            with transaction.atomic():
+                revision = Revision.objects.create(name=name, value=time.time_ns()).value
+        except IntegrityError:
+            # Created by another process in the meantime
+            revision = Revision.objects.get(name=name).value
+    return revision
+
+
+def get_revision(name):
+    revision = cache.get(_key(name))
+    if revision is None:
+        revision = _read(name)
+        cache.set(_key(name), revision, timeout=REVISION_CACHE_TIMEOUT)
+    return revision
+
+
+def bump_revision(name):
+    from .models import Revision
+
+    with transaction.atomic():
+        if not Revision.objects.filter(name=name).update(value=F('value') + 1):
+            _read(name)
+            Revision.objects.filter(name=name).update(value=F('value') + 1)
+        revision = Revision.objects.get(name=name).value
+
+    transaction.on_commit(lambda: cache.delete(_key(name)))
+    return revision
+
+
+def bump_revisions(names):
+    '''
+    Bumps many counters at once (in a few queries, rather than a few per counter)
+    '''
+
+    from .models import Revision
+
+    names = set(names)
+    if not names:
+        return
+
+    with transaction.atomic():
+        # Start any new counters (at the current time, as in _read())
+        existing = set(Revision.objects.filter(name__in=names).values_list('name', flat=True))
+        Revision.objects.bulk_create(
+            [Revision(name=name, value=time.time_ns()) for name in names - existing],
+            ignore_conflicts=True,
+        )
+        Revision.objects.filter(name__in=names).update(value=F('value') + 1)
+
+    transaction.on_commit(lambda: cache.delete_many([_key(name) for name in names]))
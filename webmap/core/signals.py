@@ -0,0 +1,162 @@
+'''
+Keeps the denormalised active fits (models.ActiveSpectralFit) and the revision
+counters (core.revisions) in step with the tables they're derived from.
+
+The updates are made once the saving transaction commits (straight away
+outside a transaction), so a rolled-back save leaves them alone. Within a
+deferred_updates() block, as used by the bulk ingestion jobs, they're instead
+collected, and made once for all the saved rows (per DEFERRED_FLUSH_SIZE
+pulsars or counters) rather than after every save.
+'''
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+import literature.models as literature_models
+
+from . import models
+from . import revisions
+
+from contextlib import contextmanager
+import threading
+
+# How many pulsars' active fits (or revision counters) a deferred_updates() block collects before updating them
+DEFERRED_FLUSH_SIZE = 500
+
+_deferred = threading.local()
+
+
+class DeferredUpdates:
+
+    def __init__(self):
+        self.pulsar_ids = set()
+        self.revisions = set()
+
+    def flush(self):
+        pulsar_ids, self.pulsar_ids = sorted(self.pulsar_ids), set()
+        names, self.revisions = self.revisions, set()
+
+        def update():
+            if pulsar_ids:
+                models.ActiveSpectralFit.refresh(pulsar_ids)
+            revisions.bump_revisions(names)
+
+        transaction.on_commit(update)
+
+
+@contextmanager
+def deferred_updates():
+    '''
+    Defers the active fit refreshes and revision bumps of the rows saved (in
+    this thread) within the block until the end of it
+    '''
+
+    if getattr(_deferred, 'updates', None) is not None:
+        # Already deferred by an enclosing block
+        yield
+        return
+
+    updates = _deferred.updates = DeferredUpdates()
+    try:
+        yield
+    finally:
+        _deferred.updates = None
+        updates.flush()
+
+
+def refresh_active_fits(pulsar_ids):
+    updates = getattr(_deferred, 'updates', None)
+    if updates is None:
+        transaction.on_commit(lambda: models.ActiveSpectralFit.refresh(pulsar_ids))
+        return
+
+    updates.pulsar_ids.update(pulsar_ids)
+    if len(updates.pulsar_ids) >= DEFERRED_FLUSH_SIZE:
+        updates.flush()
+
+
+def bump_revision(name):
+    updates = getattr(_deferred, 'updates', None)
+    if updates is None:
+        transaction.on_commit(lambda: revisions.bump_revision(name))
+        return
+
+    updates.revisions.add(name)
+    if len(updates.revisions) >= DEFERRED_FLUSH_SIZE:
+        updates.flush()
+
+
+@receiver([post_save, post_delete], sender=models.PulsarPropertyMeasurement)
+@receiver([post_save, post_delete], sender=models.PulsarProperty)
+@receiver([post_save, post_delete], sender=literature_models.Bibtex)
+def measurements_changed(sender, **kwargs):
+    bump_revision(revisions.MEASUREMENTS)
+
+
+@receiver([post_save, post_delete], sender=models.SpectralFit)
+@receiver([post_save, post_delete], sender=models.SpectralFitCovariance)
+def spectral_fit_changed(sender, instance, **kwargs):
+    refresh_active_fits([instance.pulsar_id])
+
+
+@receiver(post_save, sender=models.Pulsar)
+def pulsar_changed(sender, instance, **kwargs):
+    # The pulsar's choice of spectrum model may have changed
+    refresh_active_fits([instance.pk])
+    # ...and its other columns of the catalogue snapshot
+    bump_revision(revisions.CATALOGUE)
+
+
+@receiver(post_delete, sender=models.Pulsar)
+def pulsar_deleted(sender, instance, **kwargs):
+    bump_revision(revisions.CATALOGUE)
+
+
+@receiver([post_save, post_delete], sender=models.ATNFFluxMeasurement)
+@receiver([post_save, post_delete], sender=models.SpectralFit)
+@receiver([post_save, post_delete], sender=models.SpectralFitCovariance)
+@receiver([post_save, post_delete], sender=models.PulsarMention)
+@receiver([post_save, post_delete], sender=models.PulsarPropertyMeasurement)
+def pulsar_row_changed(sender, instance, **kwargs):
+    bump_revision(revisions.pulsar(instance.pulsar_id))
+
+
+@receiver([post_save, post_delete], sender=models.Pulsar)
+def pulsar_details_changed(sender, instance, **kwargs):
+    bump_revision(revisions.pulsar(instance.pk))
+
+
+@receiver([post_save, post_delete], sender=models.SpectrumModel)
+@receiver([post_save, post_delete], sender=models.SpectrumModelParameter)
+@receiver([post_save, post_delete], sender=models.PulsarProperty)
+@receiver([post_save, post_delete], sender=literature_models.Bibtex)
+@receiver([post_save, post_delete], sender=literature_models.Journal)
+@receiver([post_save, post_delete], sender=literature_models.Author)
+@receiver([post_save, post_delete], sender=literature_models.AuthorOrder)
+def shared_row_changed(sender, **kwargs):
+    # These are shared by many pulsars, so all pulsars' details are invalidated
+    bump_revision(revisions.PULSARS)
+
+
+@receiver(post_save, sender=models.SpectrumModelParameter)
+def spectrum_model_parameter_changed(sender, instance, **kwargs):
+    refresh_active_fits(
+        models.SpectralFit.objects.filter(parameter=instance).values_list('pulsar', flat=True).distinct()
+    )
+
+
+@receiver(post_save, sender=models.SpectrumModel)
+def spectrum_model_changed(sender, instance, **kwargs):
+    # The active fits of the pulsars using it have a copy of its pulsar_spectra_name
+    refresh_active_fits(
+        models.Pulsar.objects.filter(spectrum_model=instance).values_list('pk', flat=True)
+    )
+
+
+@receiver(post_delete, sender=models.SpectrumModel)
+def spectrum_model_deleted(sender, instance, **kwargs):
+    # Its pulsars' spectrum_model has been set to null (without saving them)
+    refresh_active_fits(
+        models.ActiveSpectralFit.objects.filter(pulsar__spectrum_model__isnull=True).values_list('pulsar', flat=True)
+    )
@@ -0,0 +1,521 @@
+'''
+An immutable, columnar, in-memory snapshot of the catalogue (pulsars and their
+active spectral fits), so that the read-only endpoints don't have to query the
+database on every request.
+
+Each worker process holds one snapshot, swapped in with a single assignment,
+so that requests always see a complete snapshot. When the CATALOGUE revision
+(see core.revisions) moves on, workers go on serving the snapshot on disk
+until a newer one has been written (by the pipeline, or by a background job
+worker, see write_snapshot_if_stale()), rather than each rebuilding it from
+the database. Only if there's no snapshot on disk at all do they build their
+own.
+
+The ingestion pipeline also writes the snapshot to disk (write_snapshot()),
+as a directory of .npy files, one per column, plus meta.json:
+
+    <settings.CATALOGUE_SNAPSHOT_DIR>/
+        current -> catalogue-<revision>
+        catalogue-<revision>/
+            meta.json
+            id.npy  ra.npy  dec.npy  ...  parameter-a.npy  ...  covariance.npy
+            flux-1400MHz.npy  ...
+            map.json
+
+Alongside the columns, it holds precomputed data that every worker would
+otherwise compute for itself: the flux densities (and their uncertainties)
+at FLUX_GRID_FREQS_MHZ, and the map's payload.
+
+Workers memory-map the current snapshot (if it's up to date) instead of
+querying the database, so its pages are shared between them. Offline tools
+can read it with nothing but NumPy, e.g.
+
+    np.load(".../current/ra.npy", mmap_mode="r")
+'''
+
+from django.conf import settings
+
+from . import models
+from . import revisions
+from . import spectra
+from .jobs import Job
+
+from functools import cached_property
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+
+# The float columns; missing values are NaN
+FLOAT_COLUMNS = ['ra', 'dec', 'period', 'pdot', 'dm', 'dm_error', 'rm', 'rm_error']
+
+# The maximum length of the pulsar names
+NAME_LENGTH = 32
+
+# Incremented whenever the layout of the snapshot files changes
+FORMAT_VERSION = 3
+
+# The number of snapshot files (besides the current one) kept on disk
+SNAPSHOTS_KEPT = 2
+
+# The height (deg) of the declination bands of the map's sky index
+MAP_INDEX_CELL_SIZE = 3
+
+# How often (s) a worker whose snapshot is behind the CATALOGUE revision looks
+# for a newer one on disk
+SNAPSHOT_RECHECK_INTERVAL = 1.0
+
+# The frequencies (MHz) at which the flux densities of all of the pulsars are
+# precomputed: the map's default, and other commonly observed bands
+FLUX_GRID_FREQS_MHZ = [150, 400, 1400, 3000]
+
+
+def snapshot_queryset():
+    '''
+    All pulsars with their active fits (if any), in ID order
+    '''
+
+    return models.Pulsar.objects.values_list(
+        'id', 'bname', 'jname', *FLOAT_COLUMNS,
+        'active_fit__spectrum_model_name', 'active_fit__parameters',
+        'active_fit__errors', 'active_fit__covariance',
+    ).order_by('id')
+
+
+def _float_array(values):
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+def _none_if_nan(value):
+    return None if value != value else value
+
+
+def _flux_grid_filename(freq_MHz):
+    return f"flux-{freq_MHz:g}MHz.npy"
+
+
+def _column_filename(name):
+    return name.replace(':', '-') + '.npy'
+
+
+def sky_index(ra, dec, cell_size=MAP_INDEX_CELL_SIZE):
+    '''
+    A spatial index of points on the sky, for finding the points near a given
+    position without looking at all of them.
+
+    The sky is divided into declination bands cell_size degrees high, and each
+    band into as many equal cells in RA as make them roughly cell_size wide
+    (so the cells have roughly equal areas). Cells are numbered band by band,
+    from the south pole, and in RA within each band.
+
+    Returns (order, index): the order that sorts the points by cell, and
+    {"cell_size": ..., "ra_cells": [number of cells in each band], "cell_start": [...]},
+    where the points (in the sorted order) in cell i are cell_start[i] to
+    cell_start[i + 1] - 1. Points without positions are put at RA = Dec = 0.
+    '''
+
+    ra = np.nan_to_num(np.asarray(ra, dtype=np.float64)) % 360
+    dec = np.nan_to_num(np.asarray(dec, dtype=np.float64))
+
+    num_bands = int(np.ceil(180 / cell_size))
+    band_centres = -90 + (np.arange(num_bands) + 0.5) * cell_size
+    ra_cells = np.maximum(1, np.floor(360 * np.cos(np.radians(band_centres)) / cell_size)).astype(np.int64)
+    band_offsets = np.concatenate([[0], np.cumsum(ra_cells)])
+
+    band = np.clip(np.floor((dec + 90) / cell_size).astype(np.int64), 0, num_bands - 1)
+    ra_cell = np.minimum(np.floor(ra / (360 / ra_cells[band])).astype(np.int64), ra_cells[band] - 1)
+    cell = band_offsets[band] + ra_cell
+
+    order = np.argsort(cell, kind='stable')
+    cell_start = np.searchsorted(cell[order], np.arange(band_offsets[-1] + 1))
+
+    return order, {
+        'cell_size': cell_size,
+        'ra_cells': ra_cells.tolist(),
+        'cell_start': cell_start.tolist(),
+    }
+
+
+class CatalogueSnapshot:
+    '''
+    Columns (NumPy arrays, one element per pulsar, in ID order):
+
+      id                  int64
+      bname, jname        fixed-width strings ('' if missing)
+      ra, dec, period, dm, rm
+                          float64 (NaN if missing)
+      spectrum_model      int16 index into spectrum_models (-1 if the pulsar has no active fit)
+      parameter:<name>    float64 value of each spectral fit parameter (NaN if it's not in
+                          the pulsar's active fit), for each name in parameter_names
+      covariance          float64 (N, P, P) covariance matrices of the active fits, over
+                          parameter_names (NaN if the fit's uncertainties aren't known)
+
+    flux_grids holds the precomputed flux densities (Jy) of all of the pulsars,
+    as {frequency (MHz): (2, N) array of the flux densities and their 1σ
+    uncertainties}.
+    '''
+
+    def __init__(self, revision, columns, spectrum_models, parameter_names, flux_grids=None, path=None):
+        self.revision = revision
+        self.columns = columns
+        self.spectrum_models = spectrum_models
+        self.parameter_names = parameter_names
+        self.flux_grids = flux_grids or {}
+        # The directory the snapshot was loaded from, if any
+        self.path = path
+
+    @classmethod
+    def from_database(cls, revision=None):
+
+        if revision is None:
+            revision = revisions.get_revision(revisions.CATALOGUE)
+
+        rows = list(snapshot_queryset())
+        ids, bnames, jnames, *float_values, spectrum_model_names, parameters, errors, covariances = (
+            zip(*rows) if rows else [()] * (len(FLOAT_COLUMNS) + 7)
+        )
+
+        spectrum_models = sorted({name for name in spectrum_model_names if name})
+        parameter_names = sorted({name for fit in parameters if fit for name in fit})
+
+        model_index = {name: i for i, name in enumerate(spectrum_models)}
+
+        columns = {
+            'id': np.array(ids, dtype=np.int64),
+            'bname': np.array([name or '' for name in bnames], dtype=f'U{NAME_LENGTH}'),
+            'jname': np.array([name or '' for name in jnames], dtype=f'U{NAME_LENGTH}'),
+            'spectrum_model': np.array([model_index.get(name, -1) for name in spectrum_model_names], dtype=np.int16),
+        }
+        for column, values in zip(FLOAT_COLUMNS, float_values):
+            columns[column] = _float_array(values)
+        for name in parameter_names:
+            columns[f'parameter:{name}'] = _float_array([(fit or {}).get(name) for fit in parameters])
+        columns['covariance'] = spectra.covariance_matrices(parameter_names, errors, covariances)
+
+        snapshot = cls(revision, columns, spectrum_models, parameter_names)
+        fluxes, flux_errors = snapshot.predict_fluxes(np.array(FLUX_GRID_FREQS_MHZ, dtype=np.float64) * 1e6)
+        snapshot.flux_grids = {
+            freq: np.stack([fluxes[:, i], flux_errors[:, i]])
+            for i, freq in enumerate(FLUX_GRID_FREQS_MHZ)
+        }
+
+        return snapshot
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Reads a snapshot written by save(), memory-mapping its columns unless
+        mmap is False
+        '''
+
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        if meta['format_version'] != FORMAT_VERSION:
+            raise ValueError(f"{path} has format version {meta['format_version']}, not {FORMAT_VERSION}")
+
+        mmap_mode = 'r' if mmap else None
+        columns = {
+            name: np.load(os.path.join(path, _column_filename(name)), mmap_mode=mmap_mode)
+            for name in meta['columns']
+        }
+        flux_grids = {
+            freq: np.load(os.path.join(path, _flux_grid_filename(freq)), mmap_mode=mmap_mode)
+            for freq in meta['flux_grid_freqs']
+        }
+
+        return cls(meta['revision'], columns, meta['spectrum_models'], meta['parameter_names'], flux_grids, path)
+
+    def save(self, directory):
+        '''
+        Writes the snapshot to a new subdirectory of directory, and makes it
+        the current one. Returns its path.
+        '''
+
+        name = f"catalogue-{self.revision}"
+        path = os.path.join(directory, name)
+        tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+
+        os.makedirs(tmp_path)
+        try:
+            for column_name, column in self.columns.items():
+                np.save(os.path.join(tmp_path, _column_filename(column_name)), column)
+            for freq, grid in self.flux_grids.items():
+                np.save(os.path.join(tmp_path, _flux_grid_filename(freq)), grid)
+
+            with open(os.path.join(tmp_path, "map.json"), "w") as f:
+                f.write(self.map_json)
+
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump({
+                    'format_version': FORMAT_VERSION,
+                    'revision': self.revision,
+                    'num_pulsars': len(self),
+                    'columns': list(self.columns),
+                    'spectrum_models': self.spectrum_models,
+                    'parameter_names': self.parameter_names,
+                    'flux_grid_freqs': list(self.flux_grids),
+                }, f, indent=2)
+
+            if os.path.exists(path):
+                # The same revision has already been written
+                shutil.rmtree(tmp_path)
+            else:
+                os.rename(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        # Swap the "current" link atomically, so readers never see a missing or half-written snapshot
+        tmp_link = os.path.join(directory, f".current.{os.getpid()}.tmp")
+        os.symlink(name, tmp_link)
+        os.replace(tmp_link, os.path.join(directory, "current"))
+
+        return path
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def index(self, pk):
+        '''
+        The row of the pulsar with the given ID, or None if there isn't one
+        '''
+
+        i = np.searchsorted(self.columns['id'], pk)
+        if i < len(self) and self.columns['id'][i] == pk:
+            return int(i)
+        return None
+
+    def rows(self, indices=None):
+        '''
+        The pulsars at the given rows (default: all), as dicts
+        '''
+
+        if indices is None:
+            indices = np.arange(len(self))
+
+        # Convert each column to Python objects in one go, rather than element by element
+        values = {
+            name: column[indices].tolist()
+            for name, column in self.columns.items()
+            if not name.startswith('parameter:') and name != 'covariance'
+        }
+        parameters = [self.columns[f'parameter:{name}'][indices].tolist() for name in self.parameter_names]
+
+        rows = []
+        for i in range(len(indices)):
+            model = values['spectrum_model'][i]
+            rows.append({
+                'id': values['id'][i],
+                'name': values['bname'][i] or values['jname'][i],
+                **{column: _none_if_nan(values[column][i]) for column in FLOAT_COLUMNS},
+                'spectrum_model': self.spectrum_models[model] if model >= 0 else None,
+                'parameters': {
+                    name: parameters[j][i]
+                    for j, name in enumerate(self.parameter_names)
+                    if _none_if_nan(parameters[j][i]) is not None
+                } if model >= 0 else None,
+            })
+
+        return rows
+
+    def predict_fluxes(self, freqs):
+        '''
+        The flux densities (Jy) of all of the pulsars at the given frequencies
+        (Hz), and their 1σ uncertainties, as two (N, M) arrays (NaN for
+        pulsars without fits, or with unknown uncertainties)
+        '''
+
+        grids = [self.flux_grids.get(freq / 1e6) for freq in np.asarray(freqs, dtype=np.float64).tolist()]
+        if grids and all(grid is not None for grid in grids):
+            return np.stack([grid[0] for grid in grids], axis=1), np.stack([grid[1] for grid in grids], axis=1)
+
+        spectrum_models = np.array(self.spectrum_models + [None], dtype=object)[self.columns['spectrum_model']]
+        parameters = {name: self.columns[f'parameter:{name}'] for name in self.parameter_names}
+
+        return spectra.predict_flux_errors(
+            spectrum_models, parameters, self.columns['covariance'], self.parameter_names, freqs,
+        )
+
+    @cached_property
+    def map_json(self):
+        '''
+        The map's data, as JSON: {"pulsars": [...], "index": ...}, where pulsars
+        are the pulsars with active fits, in the order of the sky index (see
+        sky_index()). Read from the snapshot's directory, if it was saved with
+        the snapshot.
+        '''
+
+        if self.path is not None:
+            try:
+                with open(os.path.join(self.path, "map.json")) as f:
+                    return f.read()
+            except OSError:
+                pass
+
+        indices = np.flatnonzero(self.columns['spectrum_model'] >= 0)
+        order, index = sky_index(self.columns['ra'][indices], self.columns['dec'][indices])
+
+        pulsars = [
+            {
+                'id': row['id'],
+                'name': row['name'],
+                'ra': row['ra'],
+                'dec': row['dec'],
+                'period': row['period'] or '',
+                'dm': row['dm'] or '',
+                'rm': row['rm'] or '',
+                'spectrum_model': row['spectrum_model'],
+                'parameters': row['parameters'],
+            }
+            for row in self.rows(indices[order])
+        ]
+
+        return json.dumps({'pulsars': pulsars, 'index': index})
+
+
+def snapshot_dir():
+    return settings.CATALOGUE_SNAPSHOT_DIR
+
+
+def current_revision():
+    '''
+    The revision of the current snapshot on disk, or None if there isn't one
+    (that this version can read)
+    '''
+
+    try:
+        with open(os.path.join(snapshot_dir(), "current", "meta.json")) as f:
+            meta = json.load(f)
+        if meta['format_version'] != FORMAT_VERSION:
+            return None
+        return meta['revision']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def load_current(revision=None):
+    '''
+    The current snapshot on disk (memory-mapped), or None if there isn't one,
+    or if it isn't of the given revision
+    '''
+
+    try:
+        with open(os.path.join(snapshot_dir(), "current", "meta.json")) as f:
+            if revision is not None and json.load(f)['revision'] != revision:
+                return None
+        return CatalogueSnapshot.load(os.path.join(snapshot_dir(), "current"))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def prune_snapshots(keep=SNAPSHOTS_KEPT):
+    '''
+    Deletes all but the current and the latest keep older snapshots. (Workers
+    that still have a deleted snapshot memory-mapped can go on reading it.)
+    '''
+
+    directory = snapshot_dir()
+    current = os.path.realpath(os.path.join(directory, "current"))
+    paths = sorted(
+        (os.path.join(directory, name) for name in os.listdir(directory) if name.startswith("catalogue-")),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    old = [path for path in paths if os.path.realpath(path) != current][keep:]
+    for path in old:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def write_snapshot(job=None):
+    '''
+    Writes a snapshot of the catalogue to settings.CATALOGUE_SNAPSHOT_DIR
+    '''
+
+    with (job or Job("write_snapshot")) as job:
+        with job.stage("db read"):
+            snapshot = CatalogueSnapshot.from_database()
+        job.count("pulsars", len(snapshot))
+
+        with job.stage("write"):
+            os.makedirs(snapshot_dir(), exist_ok=True)
+            path = snapshot.save(snapshot_dir())
+            prune_snapshots()
+
+        job.write(f"write_snapshot: wrote {path}")
+
+
+def is_stale():
+    '''
+    Whether the snapshot on disk is missing or behind the CATALOGUE revision
+    '''
+
+    return current_revision() != revisions.get_revision(revisions.CATALOGUE)
+
+
+def write_snapshot_if_stale(write=print):
+    '''
+    Writes a new snapshot if the one on disk is stale, unless another process
+    is already doing so. Returns whether it wrote one.
+    '''
+
+    if not is_stale():
+        return False
+
+    os.makedirs(snapshot_dir(), exist_ok=True)
+    with open(os.path.join(snapshot_dir(), "write.lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        try:
+            # It may have been written while this process waited
+            if not is_stale():
+                return False
+            write_snapshot(job=Job("write_snapshot", write=write, summary=False))
+            return True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+_snapshot = None
+_checked = 0.0
+_lock = threading.Lock()
+
+
+def get_snapshot():
+    '''
+    This process's snapshot of the catalogue: the current one on disk (which
+    may be behind the catalogue until a newer one is written), or, if there
+    isn't one, one built from the database
+    '''
+
+    global _snapshot, _checked
+
+    revision = revisions.get_revision(revisions.CATALOGUE)
+    snapshot = _snapshot
+    if snapshot is not None and (
+        snapshot.revision == revision or time.monotonic() - _checked < SNAPSHOT_RECHECK_INTERVAL
+    ):
+        return snapshot
+
+    with _lock:
+        # Another thread may have replaced (or rechecked) it while this one waited for the lock
+        if _snapshot is not None and (
+            _snapshot.revision == revision or time.monotonic() - _checked < SNAPSHOT_RECHECK_INTERVAL
+        ):
+            return _snapshot
+
+        _checked = time.monotonic()
+        on_disk = current_revision()
+        if on_disk is None:
+            _snapshot = CatalogueSnapshot.from_database(revision)
+        elif _snapshot is None or _snapshot.path is None or _snapshot.revision != on_disk:
+            _snapshot = load_current() or _snapshot or CatalogueSnapshot.from_database(revision)
+        return _snapshot
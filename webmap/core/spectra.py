@@ -0,0 +1,180 @@
+'''
+Vectorised evaluation of the spectrum models, and of the uncertainties of
+their predictions, for many pulsars and frequencies at once.
+
+The models are pulsar_spectra's (which accept NumPy arrays for the frequency
+and the parameters alike), so fitted parameters are in pulsar_spectra's units:
+frequencies in Hz, and flux densities in Jy.
+
+Uncertainties are propagated linearly from the fits' covariance matrices:
+σ² = J C Jᵀ, where J is the Jacobian of the model with respect to its
+parameters (estimated by central differences, which works for every model).
+'''
+
+from pulsar_spectra import models as spectra_models
+
+from functools import lru_cache
+import inspect
+
+import numpy as np
+
+
+@lru_cache
+def model_parameter_names(spectrum_model):
+    '''
+    The names of the parameters of a pulsar_spectra model, in order
+    '''
+
+    return list(inspect.signature(getattr(spectra_models, spectrum_model)).parameters)[1:]
+
+
+def flux_density(spectrum_model, freqs, parameters):
+    '''
+    The flux densities (Jy) predicted by a pulsar_spectra model at the
+    given frequencies (Hz), with the given parameter values ({name: value}).
+    Frequencies and parameter values broadcast against each other.
+    '''
+
+    function = getattr(spectra_models, spectrum_model)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return function(freqs, **{name: parameters[name] for name in model_parameter_names(spectrum_model)})
+
+
+def predict_fluxes(spectrum_models, parameters, freqs):
+    '''
+    The flux densities (Jy) of N pulsars at M frequencies, as an (N, M) array.
+
+    spectrum_models  Array of the N pulsars' pulsar_spectra model names (None or
+                     '' for pulsars without fits)
+    parameters       {name: array of N values} of the models' parameters (NaN where a
+                     pulsar's model doesn't have the parameter)
+    freqs            Array of M frequencies (Hz)
+
+    Pulsars without fits (or with a parameter missing) get NaN.
+    '''
+
+    spectrum_models = np.asarray(spectrum_models, dtype=object)
+    freqs = np.asarray(freqs, dtype=np.float64)
+
+    fluxes = np.full((len(spectrum_models), len(freqs)), np.nan)
+
+    for spectrum_model in set(spectrum_models.tolist()):
+        if not spectrum_model:
+            continue
+
+        rows = np.flatnonzero(spectrum_models == spectrum_model)
+        missing = np.full(len(spectrum_models), np.nan)
+        model_parameters = {
+            # Parameters as columns, so that they broadcast against a row of frequencies
+            name: np.asarray(parameters.get(name, missing), dtype=np.float64)[rows, np.newaxis]
+            for name in model_parameter_names(spectrum_model)
+        }
+        fluxes[rows] = flux_density(spectrum_model, freqs[np.newaxis, :], model_parameters)
+
+    return fluxes
+
+
+# The relative step used to estimate the models' derivatives
+DERIVATIVE_STEP = 1e-6
+
+
+def covariance_matrices(parameter_names, errors, covariances):
+    '''
+    The covariance matrices of N pulsars' fits, as an (N, P, P) array over the
+    P parameter_names, from the ActiveSpectralFit errors ({name: error}) and
+    covariance ({"parameter_names": [...], "matrix": [[...], ...]}) of each.
+
+    Where a pulsar has no covariance matrix, its errors go on the diagonal.
+    Parameters without either are taken to be exact (e.g. the reference
+    frequency of a power law), unless the pulsar has no uncertainties at all,
+    in which case its matrix is all NaN.
+    '''
+
+    index = {name: i for i, name in enumerate(parameter_names)}
+    matrices = np.zeros((len(errors), len(parameter_names), len(parameter_names)))
+
+    for n, (fit_errors, covariance) in enumerate(zip(errors, covariances)):
+        if covariance:
+            names = covariance['parameter_names']
+            for i, row in zip(names, covariance['matrix']):
+                for j, value in zip(names, row):
+                    if i in index and j in index:
+                        matrices[n, index[i], index[j]] = value
+        elif fit_errors:
+            for name, error in fit_errors.items():
+                if name in index:
+                    matrices[n, index[name], index[name]] = error**2
+        else:
+            matrices[n] = np.nan
+
+    return matrices
+
+
+def predict_flux_errors(spectrum_models, parameters, covariances, parameter_names, freqs):
+    '''
+    The flux densities (Jy) of N pulsars at M frequencies and their 1σ
+    uncertainties, as two (N, M) arrays.
+
+    spectrum_models, parameters, freqs
+                     As for predict_fluxes()
+    covariances      (N, P, P) array of the fits' covariance matrices, as
+                     returned by covariance_matrices()
+    parameter_names  The P parameter names that index covariances
+
+    Uncertainties are NaN where the fit's covariance isn't known.
+    '''
+
+    spectrum_models = np.asarray(spectrum_models, dtype=object)
+    freqs = np.asarray(freqs, dtype=np.float64)[np.newaxis, :]
+    covariances = np.asarray(covariances, dtype=np.float64)
+
+    fluxes = np.full((len(spectrum_models), freqs.shape[1]), np.nan)
+    errors = np.full_like(fluxes, np.nan)
+
+    for spectrum_model in set(spectrum_models.tolist()):
+        if not spectrum_model:
+            continue
+
+        rows = np.flatnonzero(spectrum_models == spectrum_model)
+        names = model_parameter_names(spectrum_model)
+        missing = np.full(len(spectrum_models), np.nan)
+        model_parameters = {
+            name: np.asarray(parameters.get(name, missing), dtype=np.float64)[rows, np.newaxis]
+            for name in names
+        }
+        fluxes[rows] = flux_density(spectrum_model, freqs, model_parameters)
+
+        # The Jacobian, (pulsars, frequencies, model parameters)
+        jacobian = np.empty((len(rows), freqs.shape[1], len(names)))
+        for k, name in enumerate(names):
+            value = model_parameters[name]
+            step = DERIVATIVE_STEP * np.where(value != 0, np.abs(value), 1.0)
+            upper = flux_density(spectrum_model, freqs, {**model_parameters, name: value + step})
+            lower = flux_density(spectrum_model, freqs, {**model_parameters, name: value - step})
+            jacobian[:, :, k] = (upper - lower) / (2 * step)
+
+        # The model's parameters' block of each covariance matrix
+        index = [parameter_names.index(name) if name in parameter_names else None for name in names]
+        covariance = np.zeros((len(rows), len(names), len(names)))
+        for k, i in enumerate(index):
+            for l, j in enumerate(index):
+                if i is not None and j is not None:
+                    covariance[:, k, l] = covariances[rows, i, j]
+
+        with np.errstate(invalid='ignore'):
+            variance = np.einsum('nmk,nkl,nml->nm', jacobian, covariance, jacobian)
+            errors[rows] = np.sqrt(np.clip(variance, 0, None))
+
+    return fluxes, errors
+
+
+def lower_bounds(fluxes, errors, sigma):
+    '''
+    The flux densities less sigma times their uncertainties. With sigma > 0,
+    flux densities whose uncertainties aren't known get NaN, so that they
+    never pass a threshold.
+    '''
+
+    if not sigma:
+        return fluxes
+    return fluxes - sigma*errors
@@ -0,0 +1,97 @@
+// The spectrum models (as in pulsar_spectra), evaluated for many pulsars at
+// once. Loaded by the map page, and by the flux worker (flux-worker.js).
+
+// log10 flux density of pulsars without one
+const NO_FLUX = -1e30;
+
+// Flux density (Jy) at freq (Hz) of the j-th pulsar of a group, whose
+// parameters p are {name: Float64Array}
+const FLUX_MODELS = {
+    simple_power_law: function(freq, p, j) {
+        return p.c[j] * (freq/p.v0[j])**p.a[j];
+    },
+    broken_power_law: function(freq, p, j) {
+        const v0 = p.v0[j];
+        const vb = p.vb[j];
+        if (freq < vb) {
+            return p.c[j] * (freq/v0)**p.a1[j];
+        }
+        return p.c[j] * (freq/v0)**p.a2[j] * (vb/v0)**(p.a1[j] - p.a2[j]);
+    },
+    double_turn_over_spectrum: function(freq, p, j) {
+        const vc = p.vc[j];
+        if (freq >= vc) {
+            return 0;
+        }
+        const a = p.a[j];
+        return p.c[j] * (freq/p.v0[j])**a * (1 - freq/vc) * Math.exp((a/p.beta[j]) * (freq/p.vpeak[j])**(-p.beta[j]));
+    },
+    high_frequency_cut_off_power_law: function(freq, p, j) {
+        const vc = p.vc[j];
+        if (freq >= vc) {
+            return 0;
+        }
+        return p.c[j] * (freq/p.v0[j])**p.a[j] * (1 - freq/vc);
+    },
+    log_parabolic_spectrum: function(freq, p, j) {
+        const x = Math.log10(freq/p.v0[j]);
+        return 10**(p.a[j]*x*x + p.b[j]*x + p.c[j]);
+    },
+    low_frequency_turn_over_power_law: function(freq, p, j) {
+        const a = p.a[j];
+        return p.c[j] * (freq/p.v0[j])**a * Math.exp((a/p.beta[j]) * (freq/p.vpeak[j])**(-p.beta[j]));
+    },
+};
+
+// The pulsars grouped by spectrum model:
+// [{spectrum_model, indices: Int32Array, parameters: {name: Float64Array}}]
+function group_by_model(data) {
+    const groups = new Map();
+    data.forEach(function(d, i) {
+        if (!groups.has(d.spectrum_model)) {
+            groups.set(d.spectrum_model, []);
+        }
+        groups.get(d.spectrum_model).push(i);
+    });
+
+    return Array.from(groups, function([spectrum_model, indices]) {
+        const names = new Set();
+        indices.forEach((i) => Object.keys(data[i].parameters || {}).forEach((name) => names.add(name)));
+
+        const parameters = {};
+        names.forEach(function(name) {
+            parameters[name] = Float64Array.from(indices, (i) => data[i].parameters[name] ?? NaN);
+        });
+
+        return {spectrum_model: spectrum_model, indices: Int32Array.from(indices), parameters: parameters};
+    });
+}
+
+// The n pulsars' flux densities (Jy) at freq (Hz), their logs, and their
+// opacities for the given log flux density range
+function compute_fluxes(groups, n, freq, min_log_jy, max_log_jy) {
+    const fluxes = new Float64Array(n);
+    const log_fluxes = new Float32Array(n).fill(NO_FLUX);
+    const opacities = new Float32Array(n);
+
+    groups.forEach(function(group) {
+        const model = FLUX_MODELS[group.spectrum_model];
+        if (!model) {
+            return;
+        }
+        const indices = group.indices;
+        const parameters = group.parameters;
+        for (let j = 0; j < indices.length; j++) {
+            const S = model(freq, parameters, j);
+            const i = indices[j];
+            fluxes[i] = S;
+            if (S > 0) {
+                const log_S = Math.log10(S);
+                log_fluxes[i] = log_S;
+                opacities[i] = Math.min(Math.max((log_S - min_log_jy) / (max_log_jy - min_log_jy), 0), 1);
+            }
+        }
+    });
+
+    return {fluxes: fluxes, log_fluxes: log_fluxes, opacities: opacities};
+}
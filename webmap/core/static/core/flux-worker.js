@@ -0,0 +1,19 @@
+// Runs compute_fluxes() off the main thread. The first message is
+// {flux_model_url, groups, n}; each later one is a {freq, min_log_jy, max_log_jy}
+// request, answered with compute_fluxes()'s arrays (transferred, not copied).
+let groups = null;
+let n = 0;
+
+onmessage = function(event) {
+    const request = event.data;
+    if (request.flux_model_url) {
+        importScripts(request.flux_model_url);
+        groups = request.groups;
+        n = request.n;
+        return;
+    }
+
+    const result = compute_fluxes(groups, n, request.freq, request.min_log_jy, request.max_log_jy);
+    result.request = request;
+    postMessage(result, [result.fluxes.buffer, result.log_fluxes.buffer, result.opacities.buffer]);
+};
@@ -0,0 +1,123 @@
+// Zooming (with the wheel or a pinch) and rotating (by dragging) a d3-geo
+// projection drawn in an SVG element, keeping the point under the pointer
+// fixed. The rotation is worked out with unit quaternions ("versors", after
+// https://observablehq.com/@d3/versor-dragging), so that dragging works the
+// same anywhere on the sphere.
+// Calls on_move({scale, rotation}) whenever the projection has changed.
+function geo_zoom(node, projection, on_move, scale_extent = [0.1, 1000]) {
+    const unity_scale = projection.scale();
+
+    let v0, r0, q0;
+
+    function pointer(event) {
+        // The centroid of the touches, or the mouse pointer, in the SVG's coordinates
+        const points = d3.pointers(event, node);
+        return [
+            d3.mean(points, function(p) { return p[0]; }),
+            d3.mean(points, function(p) { return p[1]; }),
+        ];
+    }
+
+    function zoom_started(event) {
+        if (!event.sourceEvent) {
+            return;
+        }
+        r0 = projection.rotate();
+        q0 = versor(r0);
+        v0 = versor.cartesian(projection.invert(pointer(event.sourceEvent)));
+    }
+
+    function zoomed(event) {
+        const scale = event.transform.k * unity_scale;
+        projection.scale(scale);
+
+        let rotation = projection.rotate();
+        if (event.sourceEvent && q0) {
+            const v1 = versor.cartesian(projection.rotate(r0).invert(pointer(event.sourceEvent)));
+            rotation = versor.rotation(versor.multiply(q0, versor.delta(v0, v1)));
+            projection.rotate(rotation);
+        }
+
+        on_move({scale: scale, rotation: rotation});
+    }
+
+    d3.select(node).call(
+        d3.zoom()
+            .scaleExtent(scale_extent)
+            .on("start", zoom_started)
+            .on("zoom", zoomed)
+    );
+}
+
+const versor = (function() {
+    const radians = Math.PI / 180;
+    const degrees = 180 / Math.PI;
+
+    function clamp(x) {
+        return Math.max(-1, Math.min(1, x));
+    }
+
+    function cross(v0, v1) {
+        return [
+            v0[1]*v1[2] - v0[2]*v1[1],
+            v0[2]*v1[0] - v0[0]*v1[2],
+            v0[0]*v1[1] - v0[1]*v1[0],
+        ];
+    }
+
+    function dot(v0, v1) {
+        return v0[0]*v1[0] + v0[1]*v1[1] + v0[2]*v1[2];
+    }
+
+    // The unit quaternion of the rotation by the Euler angles [λ, φ, γ] (degrees)
+    function versor(e) {
+        const l = e[0]/2 * radians, sl = Math.sin(l), cl = Math.cos(l);
+        const p = e[1]/2 * radians, sp = Math.sin(p), cp = Math.cos(p);
+        const g = (e[2] || 0)/2 * radians, sg = Math.sin(g), cg = Math.cos(g);
+        return [
+            cl*cp*cg + sl*sp*sg,
+            sl*cp*cg - cl*sp*sg,
+            cl*sp*cg + sl*cp*sg,
+            cl*cp*sg - sl*sp*cg,
+        ];
+    }
+
+    // The Cartesian coordinates of the point [λ, φ] (degrees) on the unit sphere
+    versor.cartesian = function(e) {
+        const l = e[0] * radians, p = e[1] * radians, cp = Math.cos(p);
+        return [cp*Math.cos(l), cp*Math.sin(l), Math.sin(p)];
+    };
+
+    // The Euler angles [λ, φ, γ] (degrees) of the rotation by the quaternion q
+    versor.rotation = function(q) {
+        return [
+            Math.atan2(2*(q[0]*q[1] + q[2]*q[3]), 1 - 2*(q[1]*q[1] + q[2]*q[2])) * degrees,
+            Math.asin(clamp(2*(q[0]*q[2] - q[3]*q[1]))) * degrees,
+            Math.atan2(2*(q[0]*q[3] + q[1]*q[2]), 1 - 2*(q[2]*q[2] + q[3]*q[3])) * degrees,
+        ];
+    };
+
+    // The quaternion of the rotation from the Cartesian point v0 to v1
+    versor.delta = function(v0, v1) {
+        const w = cross(v0, v1);
+        const l = Math.sqrt(dot(w, w));
+        if (!l) {
+            return [1, 0, 0, 0];
+        }
+        const t = Math.acos(clamp(dot(v0, v1))) / 2;
+        const s = Math.sin(t);
+        return [Math.cos(t), w[2]/l*s, -w[1]/l*s, w[0]/l*s];
+    };
+
+    // The quaternion product q0 q1
+    versor.multiply = function(q0, q1) {
+        return [
+            q0[0]*q1[0] - q0[1]*q1[1] - q0[2]*q1[2] - q0[3]*q1[3],
+            q0[0]*q1[1] + q0[1]*q1[0] + q0[2]*q1[3] - q0[3]*q1[2],
+            q0[0]*q1[2] - q0[1]*q1[3] + q0[2]*q1[0] + q0[3]*q1[1],
+            q0[0]*q1[3] + q0[1]*q1[2] - q0[2]*q1[1] + q0[3]*q1[0],
+        ];
+    };
+
+    return versor;
+})();
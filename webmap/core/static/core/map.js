@@ -0,0 +1,328 @@
+// tooltip div
+var tooltip = d3.select("body").append("div")
+    .attr("id", "tooltip")
+    .attr("class", "tooltip")
+    .style("opacity", 0);
+
+var frequency = document.getElementById("frequency")
+var minLogJy = document.getElementById("minLogJy")
+var maxLogJy = document.getElementById("maxLogJy")
+
+const map_data = JSON.parse(document.getElementById('data').textContent);
+const data = map_data.pulsars;
+
+var map_svg = d3.select("#map")
+var width = +map_svg.attr("width");
+var height = +map_svg.attr("height");
+const ra_ctr = 12;
+const dec_ctr = -7;
+
+const map_config = JSON.parse(document.getElementById('map-config').textContent);
+const renderer = map_config.renderer;
+
+function switch_renderer(name) {
+    // Reload the map with the same settings
+    const params = new URLSearchParams({
+        freq: (10**(frequency.value - 6)).toFixed(1),
+        minjy: 10**minLogJy.value,
+        maxjy: 10**maxLogJy.value,
+        renderer: name,
+    });
+    window.location.search = params.toString();
+}
+
+function toggle_flashing(cb) {
+    if (renderer != "svg") {
+        point_layer.set_flashing(cb.checked);
+        return;
+    }
+
+    if (cb.checked) {
+        data.forEach(function(d) {
+            const svg_dot = document.getElementById(d.name)
+            svg_dot.style.animation = "flashing " + d.period + "s linear infinite";
+        });
+    }
+    else {
+        data.forEach(function(d) {
+            const svg_dot = document.getElementById(d.name)
+            svg_dot.style.animation = "none";
+        });
+    }
+}
+
+var projection = d3.geoStereographic()
+    .translate([width / 2, height / 2])
+    .scale(width*50/30)
+    .precision(0.1)
+    .rotate([ra_ctr, dec_ctr])
+
+const path = d3.geoPath(projection);
+
+// Add coordinate grid
+let geoGenerator = d3.geoPath()
+    .projection(projection)
+
+let graticuleGenerator = d3.geoGraticule().
+    step([5,5]);
+let graticules = graticuleGenerator();
+
+const coord_grid = map_svg.append('path')
+    .attr("class", "graticules")
+    .datum(graticules)
+    .attr('d', path)
+    .style("fill", "none")
+    .attr("stroke", "#ccc");
+
+// Add pulsars
+var pulsars = null;
+var point_layer = null;
+
+if (renderer == "svg") {
+    var selection = map_svg.selectAll(".pulsar").data(data)
+
+    pulsars = selection.join(
+        enter => enter.append("circle")
+            .attr("id", function(d) { return d.name; })
+            .attr("r", 2)
+            .style("fill", "yellow"),
+        update => update,
+        exit => exit.remove()
+    ).attr("cx", function(d) { return projection([-d.ra, d.dec])[0]; })
+     .attr("cy", function(d) { return projection([-d.ra, d.dec])[1]; })
+}
+else {
+    point_layer = create_point_layer(document.getElementById("points"), map_svg.node(), data);
+}
+
+// Define the div for the tooltip
+var tooltip = d3.select("body").append("div")
+    .attr("id", "tooltip")
+    .attr("class", "tooltip")
+    .style("opacity", 0);
+
+var mouse_over_pulsar_func = function(event, d) {
+    tooltip.transition()
+        .duration(400)
+        .style("opacity", 1);
+    tooltip.html(function() {
+        const outputStr = "<b>" + d.name + "</b><br>" +
+                    "Period: " + d.period + " s<br>" +
+                    "DM: " + d.dm + " pc/cm³<br>" +
+                    "RM: " + d.rm + " rad/m²<br>" +
+                    "Spectrum model: " + d.spectrum_model + "<br>" +
+                    "Flux density: " + (d.flux_density*1e3).toFixed(4) + " mJy @ " +
+                    (10**(frequency.value-6)).toFixed(0) + " MHz";
+        return outputStr;
+    })
+        .style("left", (event.pageX + 20) + "px")
+        .style("top", (event.pageY) + "px");
+}
+
+var mouse_out_pulsar_func = function(event, d) {
+    tooltip.style("left", "-10000px")
+        .style("top", "-10000px")
+        .style("opacity", "0");
+}
+
+geo_zoom(map_svg.node(), projection, render);
+
+function render() {
+    coord_grid.attr('d', path);
+    if (renderer == "svg") {
+        pulsars.attr("cx", function(d) { return projection([-d.ra, d.dec])[0]; })
+            .attr("cy", function(d) { return projection([-d.ra, d.dec])[1]; })
+    }
+    else {
+        point_layer.project(projection);
+    }
+}
+
+// Flux densities are computed by a worker (or, if workers aren't available, by
+// the same code on this thread). Requests are made at most once a frame, and
+// only one at a time: while the worker is busy, only the latest is kept. If the
+// worker fails (to load, or while computing), this thread takes over.
+const flux_groups = group_by_model(data);
+let flux_worker = null;
+let flux_frame = null;
+let flux_busy = false;
+let flux_pending = false;
+
+try {
+    flux_worker = new Worker(map_config.flux_worker_url);
+    flux_worker.postMessage({flux_model_url: map_config.flux_model_url, groups: flux_groups, n: data.length});
+    flux_worker.onmessage = function(event) {
+        flux_busy = false;
+        apply_fluxes(event.data);
+        if (flux_pending) {
+            flux_pending = false;
+            update_fluxes();
+        }
+    };
+    flux_worker.onerror = abandon_flux_worker;
+    flux_worker.onmessageerror = abandon_flux_worker;
+}
+catch (error) {
+    flux_worker = null;
+}
+
+function abandon_flux_worker() {
+    if (flux_worker) {
+        flux_worker.terminate();
+        flux_worker = null;
+    }
+    flux_busy = false;
+    flux_pending = false;
+    // Redo the request that the worker didn't answer
+    update_fluxes();
+}
+
+function apply_fluxes(result) {
+    const fluxes = result.fluxes;
+    const opacities = result.opacities;
+    data.forEach(function(d, i) { d.flux_density = fluxes[i]; });
+
+    if (renderer == "svg") {
+        pulsars.attr("opacity", (d, i) => opacities[i]);
+    }
+    else {
+        point_layer.set_fluxes(result.log_fluxes, result.request.min_log_jy, result.request.max_log_jy);
+    }
+}
+
+function request_fluxes() {
+    const request = {
+        freq: 10**frequency.value,
+        min_log_jy: +minLogJy.value,
+        max_log_jy: +maxLogJy.value,
+    };
+
+    if (!flux_worker) {
+        const result = compute_fluxes(flux_groups, data.length, request.freq, request.min_log_jy, request.max_log_jy);
+        result.request = request;
+        apply_fluxes(result);
+    }
+    else if (flux_busy) {
+        flux_pending = true;
+    }
+    else {
+        flux_busy = true;
+        flux_worker.postMessage(request);
+    }
+}
+
+// Update opacities based on values
+function update_fluxes() {
+    if (flux_frame === null) {
+        flux_frame = requestAnimationFrame(function() {
+            flux_frame = null;
+            request_fluxes();
+        });
+    }
+}
+
+// The pulsar nearest to the given point (in the SVG's viewBox), if it's within
+// hit_radius, found with the sky index sent with the data (see snapshot.sky_index()):
+// only the pulsars in the index cells around the point are looked at
+const hit_radius = 3;
+
+function pulsar_at(x, y) {
+    const centre = projection.invert([x, y]);
+    const edge = projection.invert([x + hit_radius, y]);
+    if (!centre || !edge) {
+        return null;
+    }
+
+    // hit_radius as an angle on the sky (deg)
+    const radius = d3.geoDistance(centre, edge) * 180/Math.PI;
+    const ra = ((-centre[0] % 360) + 360) % 360;
+    const dec = centre[1];
+
+    const cell_size = map_data.index.cell_size;
+    const ra_cells = map_data.index.ra_cells;
+    const cell_start = map_data.index.cell_start;
+
+    let nearest = null;
+    let nearest_distance = hit_radius*hit_radius;
+
+    const first_band = Math.max(Math.floor((dec - radius + 90)/cell_size), 0);
+    const last_band = Math.min(Math.floor((dec + radius + 90)/cell_size), ra_cells.length - 1);
+    let band_offset = 0;
+    for (let band = 0; band < first_band; band++) {
+        band_offset += ra_cells[band];
+    }
+
+    for (let band = first_band; band <= last_band; band++) {
+        const num_cells = ra_cells[band];
+        const cell_width = 360/num_cells;
+
+        // The RA range covered by the radius, at the band's edge nearest a pole
+        const max_dec = Math.max(Math.abs(-90 + band*cell_size), Math.abs(-90 + (band + 1)*cell_size));
+        const cos_dec = Math.cos(Math.min(max_dec, 90) * Math.PI/180);
+        const ra_span = cos_dec > 0 ? radius/cos_dec : 360;
+
+        let first_cell = Math.floor((ra - ra_span)/cell_width);
+        let last_cell = Math.floor((ra + ra_span)/cell_width);
+        if (last_cell - first_cell + 1 >= num_cells) {
+            first_cell = 0;
+            last_cell = num_cells - 1;
+        }
+
+        for (let c = first_cell; c <= last_cell; c++) {
+            const cell = band_offset + ((c % num_cells) + num_cells) % num_cells;
+            for (let i = cell_start[cell]; i < cell_start[cell + 1]; i++) {
+                const [px, py] = projection([-data[i].ra, data[i].dec]);
+                const distance = (px - x)**2 + (py - y)**2;
+                if (distance <= nearest_distance) {
+                    nearest = i;
+                    nearest_distance = distance;
+                }
+            }
+        }
+
+        band_offset += num_cells;
+    }
+
+    return nearest === null ? null : data[nearest];
+}
+
+// One listener for the whole map, instead of one per pulsar
+var hovered = null;
+map_svg.on("mousemove.pulsars", function(event) {
+    const [x, y] = d3.pointer(event, map_svg.node());
+    const d = pulsar_at(x, y);
+    if (d === hovered) {
+        return;
+    }
+    hovered = d;
+    if (d) {
+        mouse_over_pulsar_func(event, d);
+    }
+    else {
+        mouse_out_pulsar_func(event, d);
+    }
+});
+map_svg.on("mouseleave.pulsars", function(event) {
+    hovered = null;
+    mouse_out_pulsar_func(event, null);
+});
+
+// Show the spectrum of a pulsar when it's clicked (the plots are drawn, and cached, by the server)
+map_svg.on("click.pulsars", function(event) {
+    const [x, y] = d3.pointer(event, map_svg.node());
+    const d = pulsar_at(x, y);
+    if (!d) {
+        return;
+    }
+    document.getElementById("spectrum-plot").src = map_config.spectrum_url.replace("{id}", d.id);
+    document.getElementById("spectrum-link").href = map_config.pulsar_url.replace("{id}", d.id);
+    document.getElementById("spectrum").style.display = "block";
+});
+
+if (renderer != "svg") {
+    window.addEventListener("resize", () => point_layer.resize());
+    point_layer.project(projection);
+}
+
+update_fluxes();
+
@@ -0,0 +1,226 @@
+// A single layer of points, drawn with WebGL (or, without it, a 2D canvas),
+// for when there are too many pulsars for one SVG element each.
+// Projected positions, flux densities and periods are kept in typed arrays,
+// and the opacities (and the flashing) are worked out on the GPU.
+function create_point_layer(canvas, svg, data) {
+    const n = data.length;
+    const radius = 2;      // in the SVG's viewBox units, as for the SVG circles
+
+    const positions = new Float32Array(2*n);
+    const log_fluxes = new Float32Array(n).fill(NO_FLUX);
+    const periods = new Float32Array(n);
+    data.forEach(function(d, i) { periods[i] = +d.period || 0; });
+
+    let min_log_jy = 0;
+    let max_log_jy = 1;
+    let flashing = false;
+    let flashing_start = 0;
+    let frame = null;
+
+    const gl = canvas.getContext("webgl");
+    const ctx = gl ? null : canvas.getContext("2d");
+
+    let program, buffers, uniforms;
+    if (gl) {
+        init_gl();
+    }
+
+    function compile(type, source) {
+        const shader = gl.createShader(type);
+        gl.shaderSource(shader, source);
+        gl.compileShader(shader);
+        if (!gl.getShaderParameter(shader, gl.COMPILE_STATUS)) {
+            throw new Error(gl.getShaderInfoLog(shader));
+        }
+        return shader;
+    }
+
+    function init_gl() {
+        program = gl.createProgram();
+        gl.attachShader(program, compile(gl.VERTEX_SHADER, `
+            attribute vec2 a_position;
+            attribute float a_log_flux;
+            attribute float a_period;
+            uniform vec2 u_scale;
+            uniform vec2 u_offset;
+            uniform float u_point_size;
+            uniform float u_min_log_jy;
+            uniform float u_max_log_jy;
+            uniform float u_time;
+            uniform bool u_flashing;
+            varying float v_alpha;
+
+            void main() {
+                gl_Position = vec4(a_position*u_scale + u_offset, 0.0, 1.0);
+                gl_PointSize = u_point_size;
+                if (u_flashing && a_period > 0.0) {
+                    // As the SVG's "flashing" animation: fade in and out once a period
+                    v_alpha = 1.0 - abs(2.0*fract(u_time/a_period) - 1.0);
+                }
+                else {
+                    v_alpha = clamp((a_log_flux - u_min_log_jy) / (u_max_log_jy - u_min_log_jy), 0.0, 1.0);
+                }
+            }
+        `));
+        gl.attachShader(program, compile(gl.FRAGMENT_SHADER, `
+            precision mediump float;
+            varying float v_alpha;
+
+            void main() {
+                // Round points
+                vec2 p = 2.0*gl_PointCoord - 1.0;
+                if (dot(p, p) > 1.0) {
+                    discard;
+                }
+                // Yellow, with premultiplied alpha
+                gl_FragColor = vec4(v_alpha, v_alpha, 0.0, v_alpha);
+            }
+        `));
+        gl.linkProgram(program);
+        if (!gl.getProgramParameter(program, gl.LINK_STATUS)) {
+            throw new Error(gl.getProgramInfoLog(program));
+        }
+        gl.useProgram(program);
+
+        buffers = {};
+        [["a_position", 2, positions], ["a_log_flux", 1, log_fluxes], ["a_period", 1, periods]].forEach(function([name, size, array]) {
+            const location = gl.getAttribLocation(program, name);
+            buffers[name] = gl.createBuffer();
+            gl.bindBuffer(gl.ARRAY_BUFFER, buffers[name]);
+            gl.bufferData(gl.ARRAY_BUFFER, array, gl.DYNAMIC_DRAW);
+            gl.enableVertexAttribArray(location);
+            gl.vertexAttribPointer(location, size, gl.FLOAT, false, 0, 0);
+        });
+
+        uniforms = {};
+        ["u_scale", "u_offset", "u_point_size", "u_min_log_jy", "u_max_log_jy", "u_time", "u_flashing"].forEach(function(name) {
+            uniforms[name] = gl.getUniformLocation(program, name);
+        });
+
+        gl.enable(gl.BLEND);
+        gl.blendFunc(gl.ONE, gl.ONE_MINUS_SRC_ALPHA);
+        gl.clearColor(0, 0, 0, 0);
+    }
+
+    function upload(name, array) {
+        gl.bindBuffer(gl.ARRAY_BUFFER, buffers[name]);
+        gl.bufferSubData(gl.ARRAY_BUFFER, 0, array);
+    }
+
+    // Lay the canvas over the SVG, at the screen's resolution
+    function resize() {
+        const rect = svg.getBoundingClientRect();
+        const parent_rect = canvas.parentElement.getBoundingClientRect();
+        const ratio = window.devicePixelRatio || 1;
+        canvas.style.left = (rect.left - parent_rect.left) + "px";
+        canvas.style.top = (rect.top - parent_rect.top) + "px";
+        canvas.style.width = rect.width + "px";
+        canvas.style.height = rect.height + "px";
+        canvas.width = Math.round(rect.width*ratio);
+        canvas.height = Math.round(rect.height*ratio);
+        if (gl) {
+            gl.viewport(0, 0, canvas.width, canvas.height);
+        }
+        request_draw();
+    }
+
+    // The transformation from the SVG's viewBox to the canvas's CSS pixels
+    function view_transform() {
+        const m = svg.getScreenCTM();
+        const rect = svg.getBoundingClientRect();
+        return {scale: [m.a, m.d], offset: [m.e - rect.left, m.f - rect.top], width: rect.width, height: rect.height};
+    }
+
+    function alpha(i, time) {
+        if (flashing && periods[i] > 0) {
+            const phase = (time/periods[i]) % 1;
+            return 1 - Math.abs(2*phase - 1);
+        }
+        return Math.min(Math.max((log_fluxes[i] - min_log_jy) / (max_log_jy - min_log_jy), 0), 1);
+    }
+
+    function draw(time) {
+        const t = view_transform();
+        const ratio = window.devicePixelRatio || 1;
+
+        if (gl) {
+            gl.clear(gl.COLOR_BUFFER_BIT);
+            gl.uniform2f(uniforms.u_scale, 2*t.scale[0]/t.width, -2*t.scale[1]/t.height);
+            gl.uniform2f(uniforms.u_offset, 2*t.offset[0]/t.width - 1, 1 - 2*t.offset[1]/t.height);
+            gl.uniform1f(uniforms.u_point_size, 2*radius*t.scale[0]*ratio);
+            gl.uniform1f(uniforms.u_min_log_jy, min_log_jy);
+            gl.uniform1f(uniforms.u_max_log_jy, max_log_jy);
+            gl.uniform1f(uniforms.u_time, time);
+            gl.uniform1i(uniforms.u_flashing, flashing);
+            gl.drawArrays(gl.POINTS, 0, n);
+            return;
+        }
+
+        ctx.setTransform(1, 0, 0, 1, 0, 0);
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
+        ctx.setTransform(ratio*t.scale[0], 0, 0, ratio*t.scale[1], ratio*t.offset[0], ratio*t.offset[1]);
+        ctx.fillStyle = "yellow";
+        for (let i = 0; i < n; i++) {
+            const a = alpha(i, time);
+            if (a <= 0) {
+                continue;
+            }
+            ctx.globalAlpha = a;
+            ctx.beginPath();
+            ctx.arc(positions[2*i], positions[2*i + 1], radius, 0, 2*Math.PI);
+            ctx.fill();
+        }
+    }
+
+    // Draw at most once a frame, and keep drawing while flashing
+    function request_draw() {
+        if (frame === null) {
+            frame = requestAnimationFrame(function(now) {
+                frame = null;
+                draw((now - flashing_start)/1000);
+                if (flashing) {
+                    request_draw();
+                }
+            });
+        }
+    }
+
+    function project(projection) {
+        for (let i = 0; i < n; i++) {
+            const [x, y] = projection([-data[i].ra, data[i].dec]);
+            positions[2*i] = x;
+            positions[2*i + 1] = y;
+        }
+        if (gl) {
+            upload("a_position", positions);
+        }
+        request_draw();
+    }
+
+    // The pulsars' log10 flux densities (Jy) (as a Float32Array), and the range
+    // of them that's shown
+    function set_fluxes(new_log_fluxes, min, max) {
+        log_fluxes.set(new_log_fluxes);
+        min_log_jy = min;
+        max_log_jy = max;
+        if (gl) {
+            upload("a_log_flux", log_fluxes);
+        }
+        request_draw();
+    }
+
+    function set_flashing(on) {
+        flashing = on;
+        flashing_start = performance.now();
+        request_draw();
+    }
+
+    resize();
+
+    return {
+        project: project,
+        set_fluxes: set_fluxes,
+        set_flashing: set_flashing,
+        resize: resize,
+    };
+}
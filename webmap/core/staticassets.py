@@ -0,0 +1,157 @@
+'''
+The map's static assets.
+
+The third-party libraries the map uses are pinned to exact versions, committed
+(under core/static/core/vendor, with their SHA-256 digests in SHA256SUMS) and
+served from our own static files, rather than from CDNs at page load (python
+manage.py vendor_static checks them against their digests, and downloads a
+new version's file when a pin changes). If a library is missing from the
+collected static files anyway, the map falls back to its pinned CDN URL, with
+its digest as the script's integrity, rather than failing.
+collectstatic then gives every static
+file a content-hashed name (so that the front proxy can tell browsers to cache
+them forever), and writes gzip (and, if the brotli package is installed,
+Brotli) compressed copies of them for the proxy to serve.
+'''
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.templatetags.static import static
+
+import base64
+import functools
+import gzip
+import hashlib
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# core/static, where the app's static files are found
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+# The directory (under core/static) of the vendored libraries
+VENDOR_DIR = "core/vendor"
+
+# The map's third-party scripts, in the order they're loaded: (static path, source URL)
+VENDOR_SCRIPTS = [
+    (f"{VENDOR_DIR}/d3-7.9.0.min.js", "https://cdn.jsdelivr.net/npm/d3@7.9.0/dist/d3.min.js"),
+]
+
+# The SHA-256 digests of the vendored libraries (in sha256sum's format, in
+# VENDOR_DIR), which vendor_static checks them against
+VENDOR_CHECKSUMS = f"{VENDOR_DIR}/SHA256SUMS"
+
+# The extensions of the files worth compressing
+COMPRESSED_EXTENSIONS = ('.js', '.css', '.svg', '.json', '.map', '.txt', '.html')
+
+# Files smaller than this (bytes) aren't compressed
+COMPRESS_MIN_SIZE = 256
+
+
+@functools.lru_cache
+def vendor_script_urls():
+    '''
+    The map's third-party scripts, as [{"src": URL, "integrity": SRI hash or
+    None}]: our own copies, or the pinned CDN URLs (checked against their
+    recorded digests) of any that are missing from the collected static files
+    '''
+
+    checksums = read_checksums()
+    scripts = []
+    for path, url in VENDOR_SCRIPTS:
+        try:
+            scripts.append({"src": static(path), "integrity": None})
+        except ValueError:
+            logger.warning(f"{path} isn't in the static files manifest (run collectstatic); using {url}")
+            digest = checksums.get(os.path.basename(path))
+            scripts.append({"src": url, "integrity": subresource_integrity(digest) if digest else None})
+    return scripts
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def subresource_integrity(digest):
+    '''
+    The integrity attribute (https://www.w3.org/TR/SRI/) of a script with the
+    given (hex) SHA-256 digest
+    '''
+
+    return "sha256-" + base64.b64encode(bytes.fromhex(digest)).decode("ascii")
+
+
+def read_checksums(path=None):
+    '''
+    {filename: SHA-256 digest} from VENDOR_CHECKSUMS ({} if there isn't one)
+    '''
+
+    path = path or os.path.join(STATIC_DIR, VENDOR_CHECKSUMS)
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return {}
+
+    checksums = {}
+    for line in lines:
+        if line.strip():
+            digest, filename = line.split(maxsplit=1)
+            checksums[filename.lstrip("*")] = digest
+    return checksums
+
+
+def write_checksums(checksums, path=None):
+    path = path or os.path.join(STATIC_DIR, VENDOR_CHECKSUMS)
+    with open(path, "w") as f:
+        for filename, digest in sorted(checksums.items()):
+            f.write(f"{digest}  {filename}\n")
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    '''
+    Stores static files with content-hashed names (see ManifestStaticFilesStorage),
+    alongside .gz (and .br) compressed copies of them
+    '''
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+
+        if dry_run:
+            return
+
+        brotli = _brotli()
+        for name in set(self.hashed_files.values()):
+            if name.endswith(COMPRESSED_EXTENSIONS):
+                self.compress(name, brotli)
+
+    def compress(self, name, brotli=None):
+        path = self.path(name)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if len(data) < COMPRESS_MIN_SIZE:
+            return
+
+        # mtime=0, so that the same file always compresses to the same bytes
+        self._write_if_smaller(path + ".gz", data, gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            self._write_if_smaller(path + ".br", data, brotli.compress(data))
+
+    @staticmethod
+    def _write_if_smaller(path, data, compressed):
+        if len(compressed) < len(data):
+            with open(path, "wb") as f:
+                f.write(compressed)
+        elif os.path.exists(path):
+            os.remove(path)
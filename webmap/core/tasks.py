@@ -0,0 +1,263 @@
+'''
+A database-backed queue of background jobs, so that slow work (e.g. refitting
+a large selection of pulsars from the admin) doesn't have to happen inside a
+web request.
+
+enqueue() adds a BackgroundJob row; workers (python manage.py run_worker)
+claim queued jobs one at a time, run the named task with a Job that records
+its progress in the row, and mark the row done or failed. While a job runs,
+its worker updates the row's heartbeat, so that jobs orphaned by a worker that
+died can be recognised (see fail_stale_jobs()).
+'''
+
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from . import httpcache
+from . import ingest
+from . import models
+from . import revisions
+from . import signals
+from . import snapshot
+from . import warmup
+from .jobs import Job
+
+import datetime
+import os
+import socket
+import threading
+import time
+import traceback
+
+# How often (s) a worker updates the heartbeat of the job it's running
+HEARTBEAT_INTERVAL = 30
+
+# How often (s) progress is written to the job's row
+PROGRESS_INTERVAL = 2.0
+
+
+TASKS = {}
+
+
+def task(name, description):
+    '''
+    Registers a task function, which is called as function(job, **arguments)
+    '''
+
+    def register(function):
+        function.description = description
+        TASKS[name] = function
+        return function
+
+    return register
+
+
+@task("set_atnf_power_laws", "Fit ATNF power laws")
+def set_atnf_power_laws(job, pulsar_ids, overwrite=False):
+
+    with job.stage("db read"):
+        pulsars = list(models.Pulsar.objects.filter(pk__in=pulsar_ids).order_by('pk'))
+
+    with signals.deferred_updates():
+        for i, pulsar in enumerate(pulsars):
+            if ingest.set_atnf_power_law(pulsar, overwrite=overwrite, job=job):
+                job.count("pulsars fitted")
+            job.progress(i + 1, len(pulsars), message=str(pulsar))
+
+
+@task("update_atnf_fluxes", "Re-import ATNF flux densities")
+def update_atnf_fluxes(job, pulsar_ids=None):
+    ingest.update_atnf_fluxes(job=job, pulsar_ids=pulsar_ids)
+
+
+@task("regenerate_caches", "Regenerate cached data")
+def regenerate_caches(job, pulsar_ids=None):
+
+    with job.stage("db write"):
+        models.ActiveSpectralFit.refresh(pulsar_ids)
+
+    # Cached ephemerides, pulsar details etc. are keyed by these revisions, so they'll be regenerated when next requested
+    revisions.bump_revision(revisions.MEASUREMENTS)
+    revisions.bump_revision(revisions.PULSARS)
+    revisions.bump_revision(revisions.CATALOGUE)
+
+    snapshot.write_snapshot(job=job)
+    warmup.warm_up(job=job)
+    httpcache.purge_proxy_cache(job=job)
+
+
+def enqueue(task_name, requested_by=None, **arguments):
+    if task_name not in TASKS:
+        raise ValueError(f"Unknown task: {task_name}")
+
+    return models.BackgroundJob.objects.create(
+        task=task_name,
+        arguments=arguments,
+        requested_by=requested_by,
+    )
+
+
+class BackgroundJobRecorder(Job):
+    '''
+    A Job that records its progress and summary in a BackgroundJob row
+    '''
+
+    def __init__(self, background_job):
+        self.background_job = background_job
+        self.lines = []
+        super().__init__(background_job.task, write=self.lines.append, progress_interval=PROGRESS_INTERVAL)
+
+    def progress(self, done, total=None, message=""):
+        now = time.perf_counter()
+        if now - self.last_progress < self.progress_interval and done != total:
+            return
+        self.last_progress = now
+
+        models.BackgroundJob.objects.filter(pk=self.background_job.pk).update(
+            progress_done=done,
+            progress_total=total,
+            message=message[:256],
+        )
+
+
+class Heartbeat:
+    '''
+    Updates a running job's heartbeat from a background thread
+    '''
+
+    def __init__(self, background_job, interval=HEARTBEAT_INTERVAL):
+        self.background_job = background_job
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def beat(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                models.BackgroundJob.objects.filter(pk=self.background_job.pk).update(heartbeat=timezone.now())
+        finally:
+            # The thread has its own database connection
+            connection.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_next(worker=None):
+    '''
+    Marks the oldest queued job as running and returns it, or returns None if
+    there are no queued jobs
+    '''
+
+    while True:
+        background_job = models.BackgroundJob.objects.filter(
+            status=models.BackgroundJob.QUEUED,
+        ).order_by('created', 'pk').first()
+
+        if background_job is None:
+            return None
+
+        now = timezone.now()
+        fields = {
+            'status': models.BackgroundJob.RUNNING,
+            'worker': worker or worker_name(),
+            'started': now,
+            'heartbeat': now,
+        }
+
+        # Only one worker can win this update, so no row locking is needed
+        claimed = models.BackgroundJob.objects.filter(
+            pk=background_job.pk,
+            status=models.BackgroundJob.QUEUED,
+        ).update(**fields)
+
+        if claimed:
+            for name, value in fields.items():
+                setattr(background_job, name, value)
+            return background_job
+
+
+def run(background_job):
+    '''
+    Runs a claimed job, and records whether it succeeded
+    '''
+
+    recorder = BackgroundJobRecorder(background_job)
+
+    try:
+        with Heartbeat(background_job):
+            with recorder:
+                TASKS[background_job.task](recorder, **background_job.arguments)
+    except Exception:
+        status = models.BackgroundJob.FAILED
+        output = traceback.format_exc()
+    else:
+        status = models.BackgroundJob.DONE
+        output = "\n".join(recorder.lines)
+
+    models.BackgroundJob.objects.filter(pk=background_job.pk).update(
+        status=status,
+        output=output,
+        finished=timezone.now(),
+    )
+    background_job.refresh_from_db()
+
+    return background_job
+
+
+def fail_stale_jobs(stale_after):
+    '''
+    Marks as failed the running jobs whose heartbeat is more than stale_after
+    seconds old, i.e. whose worker has died. They aren't requeued, in case it
+    was the job that killed the worker.
+    '''
+
+    cutoff = timezone.now() - datetime.timedelta(seconds=stale_after)
+    return models.BackgroundJob.objects.filter(
+        status=models.BackgroundJob.RUNNING,
+        heartbeat__lt=cutoff,
+    ).update(
+        status=models.BackgroundJob.FAILED,
+        output=f"The worker stopped responding (no heartbeat for {stale_after} s)",
+        finished=timezone.now(),
+    )
+
+
+def work(stop, poll_interval=5.0, stale_after=10*HEARTBEAT_INTERVAL, write=print):
+    '''
+    Runs queued jobs until the stop event is set
+    '''
+
+    worker = worker_name()
+    write(f"Worker {worker} started")
+
+    while not stop.is_set():
+        close_old_connections()
+
+        fail_stale_jobs(stale_after)
+
+        background_job = claim_next(worker)
+        if background_job is None:
+            # Bring the snapshot that the web workers serve up to date with
+            # any changes made outside the pipeline (e.g. in the admin)
+            try:
+                snapshot.write_snapshot_if_stale(write=write)
+            except Exception:
+                write(f"Worker {worker} couldn't write the snapshot:\n{traceback.format_exc()}")
+            stop.wait(poll_interval)
+            continue
+
+        write(f"Worker {worker} running {background_job}")
+        background_job = run(background_job)
+        write(f"Worker {worker} finished {background_job}")
+
+    write(f"Worker {worker} stopped")
@@ -1,3 +1,513 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
 
-# Create your tests here.
+import literature.models as literature_models
+
+from . import metrics
+from . import models
+from . import revisions
+from . import signals
+from . import snapshot
+from . import staticassets
+from . import tasks
+from . import views
+from .jobs import Job
+
+import io
+import tarfile
+import tempfile
+from unittest import mock
+import zipfile
+
+
+def quiet(line):
+    pass
+
+
+def write_snapshot():
+    snapshot.write_snapshot(job=Job("write_snapshot", write=quiet, summary=False))
+
+
+class CoreTestCase(TestCase):
+    '''
+    Keeps each test's cache entries, catalogue snapshots and request metrics
+    out of the real ones (and each other's), and doesn't depend on
+    collectstatic's manifest of hashed static file names
+    '''
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        isolated_settings = override_settings(
+            CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+            STORAGES={
+                "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+                "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+            },
+            CATALOGUE_SNAPSHOT_DIR=f"{tmpdir.name}/snapshots",
+            METRICS_DIR=f"{tmpdir.name}/metrics",
+            PROXY_CACHE_DIR=None,
+        )
+        isolated_settings.enable()
+        self.addCleanup(isolated_settings.disable)
+        cache.clear()
+
+        old_store = metrics.store
+        metrics.store = metrics.MetricsStore()
+        self.addCleanup(setattr, metrics, "store", old_store)
+        self.addCleanup(metrics.store.close)
+
+        snapshot._snapshot = None
+        self.addCleanup(setattr, snapshot, "_snapshot", None)
+        staticassets.vendor_script_urls.cache_clear()
+        self.addCleanup(staticassets.vendor_script_urls.cache_clear)
+
+    def bump(self, name):
+        '''
+        Bumps a revision counter, and lets its cached copy go (which only
+        happens on commit)
+        '''
+        with self.captureOnCommitCallbacks(execute=True):
+            revisions.bump_revision(name)
+
+
+def create_catalogue(cls):
+    '''
+    A few pulsars with spectral fits and property measurements, as attributes of cls
+    '''
+
+    cls.spectrum_model = models.SpectrumModel.objects.create(name="Simple power law", pulsar_spectra_name="simple_power_law")
+    cls.a = models.SpectrumModelParameter.objects.create(spectrum_model=cls.spectrum_model, name="a")
+    cls.c = models.SpectrumModelParameter.objects.create(spectrum_model=cls.spectrum_model, name="c")
+
+    cls.pulsar = models.Pulsar.objects.create(jname="J0437-4715", ra=69.3, dec=-47.3, period=0.0058, spectrum_model=cls.spectrum_model)
+    cls.other_pulsar = models.Pulsar.objects.create(jname="J0534+2200", bname="B0531+21", ra=83.6, dec=22.0, period=0.033)
+
+    cls.fit_a = models.SpectralFit.objects.create(pulsar=cls.pulsar, parameter=cls.a, value=-1.6, error=0.1)
+    cls.fit_c = models.SpectralFit.objects.create(pulsar=cls.pulsar, parameter=cls.c, value=0.5)
+    models.ActiveSpectralFit.refresh()
+
+    cls.bibtex = literature_models.Bibtex.objects.create(citekey="paper1", title="Paper 1", year="2000")
+    cls.later_bibtex = literature_models.Bibtex.objects.create(citekey="paper2", title="Paper 2", year="2010")
+    cls.period = models.PulsarProperty.objects.create(name="Period", symbol="P", unit="s")
+    cls.f0 = models.PulsarProperty.objects.create(name="Spin frequency", symbol="ν", ephemeris_parameter_name="F0", unit="Hz")
+    cls.dm = models.PulsarProperty.objects.create(name="Dispersion measure", symbol="DM", ephemeris_parameter_name="DM", unit="pc/cm3")
+
+
+class MeasurementAggregateTests(CoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_catalogue(cls)
+
+    def add_measurement(self, value, error, unit=None, **kwargs):
+        return models.PulsarPropertyMeasurement.objects.create(
+            pulsar=self.pulsar,
+            pulsar_property=self.period,
+            value=value,
+            error=error,
+            unit=unit,
+            bibtex=self.bibtex,
+            **kwargs,
+        )
+
+    def test_weighted_mean_converts_units(self):
+        self.add_measurement("1.0", "0.1")
+        self.add_measurement("3000", "100", unit="ms")
+
+        [result] = views.aggregate_weighted_mean(models.PulsarPropertyMeasurement.objects.all())
+
+        # Weights 100 and 1/0.01 = 100 (both in s)
+        self.assertEqual(result['unit'], "s")
+        self.assertAlmostEqual(result['value'], 2.0)
+        self.assertAlmostEqual(result['error'], (1/200)**0.5)
+        self.assertEqual(result['num_measurements'], 2)
+
+    def test_weighted_mean_skips_unconvertible_units(self):
+        self.add_measurement("1.0", "0.1")
+        self.add_measurement("5", "1", unit="not-a-unit")
+
+        [result] = views.aggregate_weighted_mean(models.PulsarPropertyMeasurement.objects.all())
+
+        self.assertAlmostEqual(result['value'], 1.0)
+        self.assertEqual(result['num_measurements'], 1)
+
+    def test_weighted_mean_ignores_limits_and_is_unweighted_without_errors(self):
+        self.add_measurement("1.0", None)
+        self.add_measurement("2.0", None)
+        self.add_measurement("100", None, is_upper_limit=True)
+
+        [result] = views.aggregate_weighted_mean(models.PulsarPropertyMeasurement.objects.all())
+
+        self.assertAlmostEqual(result['value'], 1.5)
+        self.assertAlmostEqual(result['error'], 0.5)
+        self.assertEqual(result['num_measurements'], 2)
+
+    def test_spectrum_converts_units(self):
+        self.add_measurement("1.5", "0.1", freq_MHz=150)
+        self.add_measurement("2000", None, unit="ms", freq_MHz=1400)
+
+        [result] = views.aggregate_spectrum(models.PulsarPropertyMeasurement.objects.all())
+
+        self.assertEqual(result['unit'], "s")
+        self.assertEqual(result['freq_MHz'], [150, 1400])
+        self.assertAlmostEqual(result['value'][0], 1.5)
+        self.assertAlmostEqual(result['value'][1], 2.0)
+        self.assertAlmostEqual(result['error'][0], 0.1)
+        self.assertIsNone(result['error'][1])
+
+    def test_latest(self):
+        self.add_measurement("1.0", None, mjd=50000)
+        latest = self.add_measurement("2.0", None, mjd=60000)
+        self.add_measurement("3.0", None)
+
+        [result] = views.aggregate_latest(models.PulsarPropertyMeasurement.objects.all())
+
+        self.assertEqual(result['id'], latest.id)
+
+
+class MeasurementsApiTests(CoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_catalogue(cls)
+
+        def measurement(pulsar, pulsar_property, value, **kwargs):
+            return models.PulsarPropertyMeasurement.objects.create(
+                pulsar=pulsar, pulsar_property=pulsar_property, value=value, bibtex=cls.bibtex, **kwargs,
+            )
+
+        cls.low = measurement(cls.pulsar, cls.period, "0.0058", freq_MHz=150, bandwidth_MHz=30, mjd=50000)
+        cls.high = measurement(cls.pulsar, cls.period, "0.0057", freq_MHz=1400, bandwidth_MHz=400, mjd=55000)
+        cls.other = measurement(cls.other_pulsar, cls.dm, "56.8", freq_MHz=400, mjd=58000)
+
+    def get(self, **params):
+        return self.client.get(reverse('measurements_api'), params)
+
+    def ids(self, response):
+        self.assertEqual(response.status_code, 200)
+        return sorted(result['id'] for result in response.json()['results'])
+
+    def test_all(self):
+        response = self.get()
+        self.assertEqual(self.ids(response), sorted([self.low.id, self.high.id, self.other.id]))
+        self.assertEqual(response.json()['count'], 3)
+
+    def test_pulsar_filter(self):
+        self.assertEqual(self.ids(self.get(pulsar=self.pulsar.pk)), sorted([self.low.id, self.high.id]))
+        self.assertEqual(self.ids(self.get(pulsar="B0531+21")), [self.other.id])
+        self.assertEqual(self.ids(self.get(pulsar="J0534+2200")), [self.other.id])
+        # Not an ID (and no pulsar is called that)
+        self.assertEqual(self.ids(self.get(pulsar="²")), [])
+        self.assertEqual(self.ids(self.get(pulsar="99999999999999999999999")), [])
+
+    def test_property_filter(self):
+        self.assertEqual(self.ids(self.get(property="DM")), [self.other.id])
+        self.assertEqual(self.ids(self.get(property="Period")), sorted([self.low.id, self.high.id]))
+
+    def test_bibtex_filter(self):
+        self.assertEqual(len(self.ids(self.get(bibtex="paper1"))), 3)
+        self.assertEqual(self.ids(self.get(bibtex="paper2")), [])
+
+    def test_frequency_filter_matches_overlapping_bands(self):
+        # 1400 ± 200 MHz overlaps 1150-1250 MHz, though its centre is outside it
+        self.assertEqual(self.ids(self.get(freq_min=1150, freq_max=1250)), [self.high.id])
+        self.assertEqual(self.ids(self.get(freq_max=160)), [self.low.id])
+        self.assertEqual(self.ids(self.get(freq_min=170, freq_max=180)), [])
+
+    def test_mjd_filter(self):
+        self.assertEqual(self.ids(self.get(mjd_min=54000, mjd_max=56000)), [self.high.id])
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.get(freq_min="low").status_code, 400)
+        self.assertEqual(self.get(aggregate="median").status_code, 400)
+        self.assertEqual(self.get(page_size="many").status_code, 400)
+        self.assertEqual(self.get(page_size=0).status_code, 400)
+
+    def test_pagination(self):
+        response = self.get(page_size=2, page=2)
+        self.assertEqual(response.json()['num_pages'], 2)
+        self.assertEqual(len(response.json()['results']), 1)
+
+    def test_aggregate(self):
+        response = self.get(aggregate="weighted_mean", property="Period")
+        self.assertEqual(response.status_code, 200)
+        [result] = response.json()['results']
+        self.assertAlmostEqual(result['value'], 0.00575)
+        self.assertEqual(result['num_measurements'], 2)
+
+    def test_etag(self):
+        response = self.get()
+        etag = response["ETag"]
+        self.assertIn("measurements", response["Surrogate-Key"])
+
+        response = self.client.get(reverse('measurements_api'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.bump(revisions.MEASUREMENTS)
+        response = self.client.get(reverse('measurements_api'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class EphemerisExportTests(CoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_catalogue(cls)
+
+        def measurement(pulsar, pulsar_property, value, bibtex, **kwargs):
+            return models.PulsarPropertyMeasurement.objects.create(
+                pulsar=pulsar, pulsar_property=pulsar_property, value=value, bibtex=bibtex, **kwargs,
+            )
+
+        measurement(cls.pulsar, cls.f0, "173.687", cls.bibtex, mjd=50000)
+        measurement(cls.pulsar, cls.f0, "173.688", cls.bibtex, mjd=55000)
+        measurement(cls.pulsar, cls.dm, "2.64", cls.bibtex)
+        measurement(cls.pulsar, cls.dm, "2.65", cls.later_bibtex)
+        # Not an ephemeris parameter
+        measurement(cls.pulsar, cls.period, "0.0058", cls.bibtex)
+        measurement(cls.other_pulsar, cls.dm, "56.8", cls.bibtex)
+
+    def get(self, *pulsars, **params):
+        return self.client.get(reverse('ephemeris_export'), {'pulsar': list(pulsars), **params})
+
+    def par_lines(self, par):
+        return [line.split() for line in par.splitlines()]
+
+    def test_zip(self):
+        response = self.get(self.pulsar.pk, "B0531+21")
+        self.assertEqual(response.status_code, 200)
+
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as archive:
+            self.assertEqual(sorted(archive.namelist()), ["B0531+21.par", "J0437-4715.par"])
+            par = archive.read("J0437-4715.par").decode()
+
+        # The latest F0, and the DM of the latest publication
+        self.assertEqual(self.par_lines(par), [
+            ["PSRJ", "J0437-4715"],
+            ["DM", "2.65"],
+            ["F0", "173.688"],
+        ])
+
+    def test_tar(self):
+        response = self.get("J0437-4715", format="tar")
+        self.assertEqual(response.status_code, 200)
+
+        with tarfile.open(fileobj=io.BytesIO(b"".join(response.streaming_content)), mode="r:gz") as archive:
+            self.assertEqual(archive.getnames(), ["J0437-4715.par"])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.get().status_code, 400)
+        self.assertEqual(self.get(self.pulsar.pk, format="rar").status_code, 400)
+        self.assertEqual(self.get("J9999+9999").status_code, 400)
+        self.assertEqual(self.get("²").status_code, 400)
+
+    def test_par_files_are_cached_until_the_measurements_change(self):
+        views.par_files([self.pulsar])
+        with self.assertNumQueries(0):
+            views.par_files([self.pulsar])
+
+        self.bump(revisions.MEASUREMENTS)
+        with self.assertNumQueries(2):
+            # The revision, and the measurements
+            views.par_files([self.pulsar])
+
+
+class ActiveSpectralFitTests(CoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_catalogue(cls)
+
+    def active_fit(self):
+        return models.ActiveSpectralFit.objects.get(pulsar=self.pulsar)
+
+    def test_refresh(self):
+        self.assertEqual(self.active_fit().spectrum_model_name, "simple_power_law")
+        self.assertEqual(self.active_fit().parameters, {"a": -1.6, "c": 0.5})
+        self.assertEqual(self.active_fit().errors, {"a": 0.1})
+        # Without a spectrum model, there's no active fit
+        self.assertFalse(models.ActiveSpectralFit.objects.filter(pulsar=self.other_pulsar).exists())
+
+    def test_refresh_only_bumps_the_catalogue_on_changes(self):
+        revision = revisions.get_revision(revisions.CATALOGUE)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertFalse(models.ActiveSpectralFit.refresh([self.pulsar.pk]))
+        self.assertEqual(revisions.get_revision(revisions.CATALOGUE), revision)
+
+        models.SpectralFit.objects.filter(pk=self.fit_a.pk).update(value=-1.7)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(models.ActiveSpectralFit.refresh([self.pulsar.pk]))
+        self.assertGreater(revisions.get_revision(revisions.CATALOGUE), revision)
+        self.assertEqual(self.active_fit().parameters["a"], -1.7)
+
+    def test_saving_a_fit_refreshes_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.fit_c.value = 0.7
+            self.fit_c.save()
+            # Not until the transaction commits
+            self.assertEqual(self.active_fit().parameters["c"], 0.5)
+
+        self.assertEqual(self.active_fit().parameters["c"], 0.7)
+
+    def test_rolled_back_save_changes_nothing(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.fit_c.value = 0.7
+                    self.fit_c.save()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.active_fit().parameters["c"], 0.5)
+
+    def test_changing_the_spectrum_model_refreshes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pulsar.spectrum_model = None
+            self.pulsar.save()
+
+        self.assertFalse(models.ActiveSpectralFit.objects.exists())
+
+    def test_deferred_updates_refresh_once(self):
+        refresh = models.ActiveSpectralFit.refresh
+        with mock.patch.object(models.ActiveSpectralFit, "refresh", side_effect=refresh) as patched:
+            with self.captureOnCommitCallbacks(execute=True):
+                with signals.deferred_updates():
+                    self.fit_a.value = -1.8
+                    self.fit_a.save()
+                    self.fit_c.value = 0.9
+                    self.fit_c.save()
+
+        patched.assert_called_once_with([self.pulsar.pk])
+        self.assertEqual(self.active_fit().parameters, {"a": -1.8, "c": 0.9})
+
+    def test_renaming_the_spectrum_model_refreshes_the_active_fits(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.spectrum_model.pulsar_spectra_name = "renamed_power_law"
+            self.spectrum_model.save()
+
+        self.assertEqual(self.active_fit().spectrum_model_name, "renamed_power_law")
+
+    def test_deleting_the_spectrum_model_removes_the_active_fits(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.spectrum_model.delete()
+
+        self.assertFalse(models.ActiveSpectralFit.objects.exists())
+
+
+class RevisionTests(CoreTestCase):
+
+    def test_bump(self):
+        revision = revisions.get_revision("test")
+        self.assertEqual(revisions.bump_revision("test"), revision + 1)
+
+    def test_bump_many(self):
+        revision = revisions.get_revision("test")
+        revisions.bump_revisions(["test", "new"])
+        cache.clear()
+        self.assertEqual(revisions.get_revision("test"), revision + 1)
+        self.assertIsNotNone(revisions.get_revision("new"))
+
+    def test_reads_are_cached_until_a_bump_commits(self):
+        revision = revisions.get_revision("test")
+        with self.assertNumQueries(0):
+            self.assertEqual(revisions.get_revision("test"), revision)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            revisions.bump_revision("test")
+            self.assertEqual(revisions.get_revision("test"), revision)
+
+        self.assertEqual(revisions.get_revision("test"), revision + 1)
+
+
+class SnapshotTests(CoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_catalogue(cls)
+
+    def test_round_trip(self):
+        built = snapshot.CatalogueSnapshot.from_database()
+        write_snapshot()
+
+        loaded = snapshot.load_current()
+        self.assertEqual(loaded.revision, built.revision)
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(loaded.rows(), built.rows())
+        self.assertEqual(loaded.map_json, built.map_json)
+        self.assertEqual(loaded.spectrum_models, ["simple_power_law"])
+
+    def test_staleness(self):
+        self.assertTrue(snapshot.is_stale())
+        self.assertTrue(snapshot.write_snapshot_if_stale(write=quiet))
+        self.assertFalse(snapshot.is_stale())
+        self.assertFalse(snapshot.write_snapshot_if_stale(write=quiet))
+
+        self.bump(revisions.CATALOGUE)
+        self.assertTrue(snapshot.is_stale())
+
+    def test_get_snapshot_serves_the_one_on_disk(self):
+        write_snapshot()
+        written = snapshot.get_snapshot()
+        self.assertIsNotNone(written.path)
+
+        with self.assertNumQueries(0):
+            self.assertIs(snapshot.get_snapshot(), written)
+
+        # Even once it's behind the catalogue, until a newer one is written
+        self.bump(revisions.CATALOGUE)
+        snapshot._checked = 0
+        with self.assertNumQueries(1):
+            self.assertEqual(snapshot.get_snapshot().revision, written.revision)
+
+        write_snapshot()
+        snapshot._checked = 0
+        self.assertEqual(snapshot.get_snapshot().revision, revisions.get_revision(revisions.CATALOGUE))
+
+    def test_map_etag(self):
+        response = self.client.get(reverse('map'))
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        response = self.client.get(reverse('map'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class JobClaimTests(CoreTestCase):
+
+    def test_claims_the_oldest_queued_job(self):
+        first = tasks.enqueue("regenerate_caches")
+        second = tasks.enqueue("regenerate_caches")
+        cancelled = tasks.enqueue("regenerate_caches")
+        models.BackgroundJob.objects.filter(pk=cancelled.pk).update(status=models.BackgroundJob.CANCELLED)
+
+        claimed = tasks.claim_next(worker="worker-1")
+        self.assertEqual(claimed.pk, first.pk)
+        self.assertEqual(claimed.status, models.BackgroundJob.RUNNING)
+        first.refresh_from_db()
+        self.assertEqual(first.status, models.BackgroundJob.RUNNING)
+        self.assertEqual(first.worker, "worker-1")
+        self.assertIsNotNone(first.started)
+
+        self.assertEqual(tasks.claim_next(worker="worker-2").pk, second.pk)
+        self.assertIsNone(tasks.claim_next(worker="worker-3"))
+
+    def test_unknown_task(self):
+        with self.assertRaises(ValueError):
+            tasks.enqueue("no_such_task")
+
+    def test_stale_jobs_fail(self):
+        tasks.enqueue("regenerate_caches")
+        claimed = tasks.claim_next(worker="worker-1")
+        models.BackgroundJob.objects.filter(pk=claimed.pk).update(heartbeat=claimed.heartbeat - tasks.datetime.timedelta(hours=1))
+
+        self.assertEqual(tasks.fail_stale_jobs(stale_after=60), 1)
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, models.BackgroundJob.FAILED)
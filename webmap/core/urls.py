@@ -23,6 +23,13 @@ from . import views
 
 urlpatterns = [
     re_path(r'^$', views.map, name='map'),
-    #re_path(r'^pulsar/(?P<pk>[0-9]+)/$', views.pulsar_view, name='pulsar_view'),
+    re_path(r'^api/measurements/$', views.measurements_api, name='measurements_api'),
+    re_path(r'^api/cone/$', views.cone_search, name='cone_search'),
+    re_path(r'^api/fluxes/$', views.flux_search, name='flux_search'),
+    re_path(r'^api/pulsars/(?P<pk>[0-9]+)/$', views.pulsar_detail, name='pulsar_detail'),
+    re_path(r'^api/pulsars/(?P<pk>[0-9]+)/spectrum/$', views.spectrum_plot, name='spectrum_plot'),
+    re_path(r'^ephemeris/$', views.ephemeris_export, name='ephemeris_export'),
+    re_path(r'^export/$', views.catalogue_export, name='catalogue_export'),
+    re_path(r'^pulsar/(?P<pk>[0-9]+)/$', views.pulsar_view, name='pulsar_view'),
     #re_path(r'^construct-ephemeris/(?P<pk>[0-9]+)/$', views.construct_ephemeris, name='construct_ephemeris'),
 ]
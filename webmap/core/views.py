@@ -1,20 +1,38 @@
 from django.shortcuts import render, redirect
 from django.urls import reverse
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse, FileResponse, StreamingHttpResponse
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.templatetags.static import static
+from django.views.decorators.cache import never_cache
+from asgiref.sync import sync_to_async
 
 from . import models
-from django.db.models import Q
+from . import details
+from . import export
+from . import httpcache
+from . import plots
+from . import revisions
+from . import snapshot
+from . import spectra
+from . import staticassets
+from . import warmup
+from django.db.models import Q, F, Window
+from django.db.models.functions import RowNumber
 
 from collections import defaultdict
-import subprocess
-from scipy.optimize import curve_fit
+import io
+import zipfile
+import tarfile
 import numpy as np
-import json
 
-from pulsar_spectra.catalogue import collect_catalogue_fluxes
-from pulsar_spectra.spectral_fit import find_best_spectral_fit
 
-def map(request):
+# The ways the map can draw the pulsars: one SVG circle each, or a single WebGL
+# point layer (which falls back to a 2D canvas if WebGL isn't available)
+MAP_RENDERERS = ["svg", "webgl"]
+
+
+async def map(request):
 
     try:
         minJy = float(request.GET.get("minjy"))
@@ -34,448 +52,742 @@ def map(request):
         freq = 1.4e9
     logFreq = np.log10(freq)
 
-    pulsars = models.Pulsar.objects.filter(spectrum_model__isnull=False).prefetch_related('fits').values(
-        'id', 'bname', 'jname', 'ra', 'dec', 'period', 'dm', 'rm',
-        'spectrum_model__pulsar_spectra_name', 'fits__parameter__spectrum_model__pulsar_spectra_name',
-        'fits__parameter__name', 'fits__value',
-    )
+    renderer = request.GET.get("renderer", "svg")
+    if renderer not in MAP_RENDERERS:
+        renderer = "svg"
 
-    data = defaultdict(lambda: {
-        'id': None,
-        'name': None,
-        'ra': None,
-        'dec': None,
-        'period': None,
-        'dm': None,
-        'rm': None,
-        'spectrum_model': None,
-        'parameters': {},
-    })
+    catalogue = await sync_to_async(snapshot.get_snapshot)()
 
-    for pulsar in pulsars:
-        pulsar_id = pulsar['id']
-        if data[pulsar_id]['id'] is None and pulsar['spectrum_model__pulsar_spectra_name'] == pulsar['fits__parameter__spectrum_model__pulsar_spectra_name']:
-            data[pulsar_id]['id'] = pulsar_id
-            data[pulsar_id]['name'] = pulsar['bname'] or pulsar['jname']
-            data[pulsar_id]['ra'] = pulsar['ra']
-            data[pulsar_id]['dec'] = pulsar['dec']
-            data[pulsar_id]['period'] = pulsar['period'] or ''
-            data[pulsar_id]['dm'] = pulsar['dm'] or ''
-            data[pulsar_id]['rm'] = pulsar['rm'] or ''
-            data[pulsar_id]['spectrum_model'] = pulsar['spectrum_model__pulsar_spectra_name']
-        if pulsar['fits__parameter__name'] is not None and pulsar['fits__value'] is not None:
-            data[pulsar_id]['parameters'][pulsar['fits__parameter__name']] = pulsar['fits__value']
-
-    nested_json = json.dumps(list(data.values()))
+    response = httpcache.not_modified(request, catalogue.revision)
+    if response is not None:
+        return httpcache.cache_headers(response, catalogue.revision, [httpcache.CATALOGUE])
 
     context = {
-        'data': nested_json,
+        'data': catalogue.map_json,
         'maxJy': maxJy,
         'maxLogJy': maxLogJy,
         'minJy': minJy,
         'minLogJy': minLogJy,
         'freq_MHz': freq/1e6,
         'logFreq': logFreq,
+        'renderers': MAP_RENDERERS,
+        'renderer': renderer,
+        'vendor_scripts': staticassets.vendor_script_urls(),
+        'map_config': {
+            'renderer': renderer,
+            'flux_model_url': static('core/flux-model.js'),
+            'flux_worker_url': static('core/flux-worker.js'),
+            # With "{id}" to be replaced by a pulsar's ID
+            'spectrum_url': reverse('spectrum_plot', args=[0]).replace('/0/', '/{id}/'),
+            'pulsar_url': reverse('pulsar_view', args=[0]).replace('/0/', '/{id}/'),
+        },
     }
 
-    return render(request, 'map.html', context)
+    response = render(request, 'map.html', context)
+    return httpcache.cache_headers(response, catalogue.revision, [httpcache.CATALOGUE])
+
+
+@never_cache
+def ready(request):
+    '''
+    Readiness check: 200 once the caches have been warmed up since the server
+    was started (see core.warmup), 503 until then
+    '''
+
+    state = warmup.readiness()
+    if state is None:
+        return JsonResponse({'ready': False}, status=503)
+
+    return JsonResponse({'ready': True, **state})
+
 
 def pulsar_view(request, pk):
 
-    pulsar = models.Pulsar.objects.get(pk=pk)
+    revision = details.details_revision(pk)
+    keys = [httpcache.PULSARS, httpcache.pulsar(pk)]
+    response = httpcache.not_modified(request, revision)
+    if response is not None:
+        return httpcache.cache_headers(response, revision, keys)
+
+    pulsar = details.cached_pulsar_details(pk)
+
+    if pulsar is None:
+        raise Http404(f"No pulsar with ID {pk}")
 
     context = {
         "pulsar": pulsar,
     }
 
-    return render(request, 'pulsar.html', context)
+    return httpcache.cache_headers(render(request, 'pulsar.html', context), revision, keys)
 
-def power_law_fit(νnorm, c, α):
-    return c*νnorm**α
 
-def power_law(ν, νref, c, α):
-    return power_law_fit(ν/νref)
+# The largest radius (deg) allowed in a cone search
+CONE_SEARCH_MAX_RADIUS = 30
 
-def set_all_atnf_power_laws():
 
-    for pulsar in models.Pulsar.objects.all():
-        set_atnf_power_law(pulsar)
+def angular_separation(ra1, dec1, ra2, dec2):
+    '''
+    The angular separation (deg) between points (in degrees), using the
+    haversine formula; any of the arguments can be arrays
+    '''
+
+    ra1, dec1, ra2, dec2 = np.radians(ra1), np.radians(dec1), np.radians(ra2), np.radians(dec2)
+    h = np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(h, 0, 1))))
 
 
-def set_atnf_power_law(pulsar, default_spectral_index=-1.6, overwrite=False, set_as_select=True):
+async def cone_search(request):
     '''
-    If overwrite = False, ignore pulsars which already have simple power laws
+    JSON list of the pulsars within a cone, nearest first.
+
+    GET parameters:
+      ra, dec  The centre of the cone (deg)
+      radius   The radius of the cone (deg, default 1, at most CONE_SEARCH_MAX_RADIUS)
     '''
 
-    # Ignore pulsars that don't have ATNF flux measurements
-    atnf_flux_measurements_queryset = models.ATNFFluxMeasurement.objects.filter(pulsar=pulsar)
-    if not atnf_flux_measurements_queryset.exists():
-        return False
+    ra = _parse_float(request.GET.get("ra"))
+    dec = _parse_float(request.GET.get("dec"))
+    radius = _parse_float(request.GET.get("radius", 1))
+
+    if ra is None or dec is None or radius is None:
+        return HttpResponseBadRequest("ra, dec and radius must be numbers (in degrees)")
+    if not (-90 <= dec <= 90) or not (0 < radius <= CONE_SEARCH_MAX_RADIUS):
+        return HttpResponseBadRequest(f"dec must be in [-90, 90] and radius in (0, {CONE_SEARCH_MAX_RADIUS}]")
+    ra %= 360
+
+    catalogue = await sync_to_async(snapshot.get_snapshot)()
+
+    response = httpcache.not_modified(request, catalogue.revision)
+    if response is not None:
+        return httpcache.cache_headers(response, catalogue.revision, [httpcache.CATALOGUE])
+
+    separations = angular_separation(ra, dec, catalogue.columns['ra'], catalogue.columns['dec'])
+    # (NaN separations, for pulsars without positions, fail the comparison)
+    indices = np.flatnonzero(separations <= radius)
+    indices = indices[np.argsort(separations[indices])]
+
+    pulsars = catalogue.rows(indices)
+    for pulsar, separation in zip(pulsars, separations[indices].tolist()):
+        pulsar['separation'] = separation
+
+    response = JsonResponse({
+        'ra': ra,
+        'dec': dec,
+        'radius': radius,
+        'count': len(pulsars),
+        'results': pulsars,
+    })
+    return httpcache.cache_headers(response, catalogue.revision, [httpcache.CATALOGUE])
 
-    # Retrieve the SpectrumModel object corresponding to a simple power law
-    simple_power_law = models.SpectrumModel.objects.filter(name="ATNF simple power law").first()
-    if not simple_power_law:
-        # ...then we have bigger problems. Abort! Abort!
-        return False
 
-    # Retrieve the three simple power law model parameters
-    a = models.SpectrumModelParameter.objects.filter(spectrum_model=simple_power_law, name="a").first()
-    c = models.SpectrumModelParameter.objects.filter(spectrum_model=simple_power_law, name="c").first()
-    v0 = models.SpectrumModelParameter.objects.filter(spectrum_model=simple_power_law, name="v0").first()
+def _parse_flux_threshold(params):
+    '''
+    (min_flux, sigma) from GET parameters, or None if they're invalid
+    '''
 
-    if not a or not c or not v0:
-        # ...then we have bigger problems. Abort! Abort!
-        return False
+    min_flux = _parse_float(params.get("min_flux"))
+    sigma = _parse_float(params.get("sigma", 0))
+    if (params.get("min_flux") is not None and min_flux is None) or sigma is None or sigma < 0:
+        return None
+    return min_flux, sigma
 
-    # If overwrite = False, ignore pulsars which already have simple power laws
-    spectral_fit = models.SpectralFit.objects.filter(pulsar=pulsar, parameter__spectrum_model=simple_power_law).all()
-    if spectral_fit.exists() and overwrite == False:
-        return False
 
-    # If we got this far, we're definitely going to be adding/overwriting this pulsar's power law fit
-    print(f"Updating {pulsar}'s {simple_power_law}...")
+async def flux_search(request):
+    '''
+    JSON list of the pulsars' predicted flux densities at a frequency, with
+    their 1σ uncertainties (null if the fit's uncertainties aren't known).
+
+    GET parameters:
+      freq      The frequency (MHz, default 1400)
+      min_flux  Only include pulsars whose flux density (Jy) is at least this...
+      sigma     ...after subtracting sigma times its uncertainty (default 0). With
+                sigma > 0, pulsars with unknown uncertainties are left out.
+    '''
 
-    # That means we've got to DO the fit on the ATNF data...
-    atnf_flux_measurements = atnf_flux_measurements_queryset.all()
+    freq = _parse_float(request.GET.get("freq", 1400))
+    threshold = _parse_flux_threshold(request.GET)
+    if freq is None or freq <= 0 or threshold is None:
+        return HttpResponseBadRequest("freq (MHz) must be a positive number, min_flux (Jy) a number and sigma a non-negative number")
+    min_flux, sigma = threshold
+
+    catalogue = await sync_to_async(snapshot.get_snapshot)()
+
+    response = httpcache.not_modified(request, catalogue.revision)
+    if response is not None:
+        return httpcache.cache_headers(response, catalogue.revision, [httpcache.CATALOGUE])
+
+    fluxes, errors = catalogue.predict_fluxes([freq*1e6])
+    fluxes, errors = fluxes[:, 0], errors[:, 0]
+
+    with np.errstate(invalid='ignore'):
+        if min_flux is None:
+            selected = np.isfinite(fluxes)
+        else:
+            selected = spectra.lower_bounds(fluxes, errors, sigma) >= min_flux
+    indices = np.flatnonzero(selected)
+
+    results = [
+        {'id': pk, 'name': bname or jname, 'flux': flux, 'flux_error': None if error != error else error}
+        for pk, bname, jname, flux, error in zip(
+            catalogue.columns['id'][indices].tolist(),
+            catalogue.columns['bname'][indices].tolist(),
+            catalogue.columns['jname'][indices].tolist(),
+            fluxes[indices].tolist(),
+            errors[indices].tolist(),
+        )
+    ]
+
+    response = JsonResponse({
+        'freq': freq,
+        'min_flux': min_flux,
+        'sigma': sigma,
+        'count': len(results),
+        'results': results,
+    })
+    return httpcache.cache_headers(response, catalogue.revision, [httpcache.CATALOGUE])
 
-    # If there is only one measurement, assume a spectral index
-    if len(atnf_flux_measurements) == 1:
 
-        atnf = atnf_flux_measurements.first()
-        X_ref = atnf.freq # in MHz
-        a_value = default_spectral_index
-        c_value = atnf.flux
+async def pulsar_detail(request, pk):
+    '''
+    JSON view of a pulsar, its spectral fits (with the active fit's curve),
+    its ATNF flux densities, and its mentions and property measurements in
+    the literature; see core.details
+    '''
 
-    elif len(atnf_flux_measurements) == 2:
-        # Calculate the power law explicitly
-        X_MHz = np.array([atnf.freq for atnf in atnf_flux_measurements]) # in MHz
-        X_ref = np.sqrt(X_MHz[0]*X_MHz[-1]) # in MHz
-        X = X_MHz / X_ref # Now normalised to the geometric mean of the range
-        Y = np.array([atnf.flux for atnf in atnf_flux_measurements]) # in mJy
+    revision = await sync_to_async(details.details_revision)(pk)
+    keys = [httpcache.PULSARS, httpcache.pulsar(pk)]
+    response = httpcache.not_modified(request, revision)
+    if response is not None:
+        return httpcache.cache_headers(response, revision, keys)
 
-        a_value = np.log(Y[1]/Y[0]) / np.log(X[1]/X[0])
-        c_value = Y[0] / X[0]**a_value
+    pulsar = await sync_to_async(details.cached_pulsar_details)(pk)
 
-    else: # if len(...) > 1
+    if pulsar is None:
+        raise Http404(f"No pulsar with ID {pk}")
 
-        X_MHz = np.array([atnf.freq for atnf in atnf_flux_measurements]) # in MHz
-        X_ref = np.sqrt(X_MHz[0]*X_MHz[-1]) # in MHz
-        X = X_MHz / X_ref # Now normalised to the geometric mean of the range
-        Y = np.array([atnf.flux for atnf in atnf_flux_measurements]) # in mJy
+    return httpcache.cache_headers(JsonResponse(pulsar), revision, keys)
 
-        # Not sure how to handle the case where some flux measurements have errors
-        # but others don't. For now, I'll just treat them all as not having errors.
-        #sigma = [atnf.error for atnf in atnf_flux_measurements]
 
-        p0 = (0.05, -1.6)
-        popt, pcov = curve_fit(power_law_fit, X, Y, p0=p0)
+async def spectrum_plot(request, pk):
+    '''
+    The spectrum of a pulsar (its ATNF flux densities and its active spectral
+    fit) as an image; see core.plots
 
-        a_value = popt[1]
-        c_value = popt[0]
+    GET parameters:
+      format  "svg" (default) or "png"
+    '''
 
-    # If any of the parameters have turned up non-finite, do nothing with them
-    if not np.isfinite(a_value) or not np.isfinite(c_value) or not np.isfinite(X_ref):
-        return False
+    plot_format = request.GET.get("format", "svg")
+    if plot_format not in plots.PLOT_FORMATS:
+        return HttpResponseBadRequest(f"Unknown format '{plot_format}'. Choose from {list(plots.PLOT_FORMATS)}")
 
-    # ATNF fluxes are in mJy, but pulsar_spectra expects Jy
-    c_value /= 1e3
+    revision = await sync_to_async(details.details_revision)(pk)
+    keys = [httpcache.PULSARS, httpcache.pulsar(pk)]
+    response = httpcache.not_modified(request, revision)
+    if response is not None:
+        return httpcache.cache_headers(response, revision, keys)
 
-    fit_a = models.SpectralFit.objects.filter(pulsar=pulsar, parameter=a).first()
-    if fit_a:
-        fit_a.value = a_value
-    else:
-        fit_a = models.SpectralFit(pulsar=pulsar, parameter=a, value=a_value)
-    fit_a.save()
+    try:
+        plot = await sync_to_async(plots.cached_spectrum_plot)(pk, plot_format)
+    except plots.PlotUnavailable as e:
+        return HttpResponse(str(e), status=501)
 
-    fit_c = models.SpectralFit.objects.filter(pulsar=pulsar, parameter=c).first()
-    if fit_c:
-        fit_c.value = c_value
-    else:
-        fit_c = models.SpectralFit(pulsar=pulsar, parameter=c, value=c_value)
-    fit_c.save()
+    if plot is None:
+        raise Http404(f"No pulsar with ID {pk}")
 
-    fit_v0 = models.SpectralFit.objects.filter(pulsar=pulsar, parameter=v0).first()
-    if fit_v0:
-        fit_v0.value = X_ref*1e6 # in Hz
-    else:
-        fit_v0 = models.SpectralFit(pulsar=pulsar, parameter=v0, value=X_ref*1e6)
-    fit_v0.save()
+    content_type, _ = plots.PLOT_FORMATS[plot_format]
+    return httpcache.cache_headers(HttpResponse(plot, content_type=content_type), revision, keys)
+
+
+def ephemeris_measurements_queryset(pulsars):
+    '''
+    Chooses one measurement per (pulsar, ephemeris parameter) for the given
+    pulsars (or pulsar IDs), preferring the most recent MJD and then the most
+    recent publication. The choice is made in the database with a single
+    windowed query.
+    '''
 
-    if set_as_select:
-        if not pulsar.spectrum_model:
-            pulsar.spectrum_model = simple_power_law
-            pulsar.save()
+    return models.PulsarPropertyMeasurement.objects.filter(
+        pulsar__in=pulsars,
+        pulsar_property__ephemeris_parameter_name__isnull=False,
+    ).exclude(
+        pulsar_property__ephemeris_parameter_name='',
+    ).annotate(
+        rank=Window(
+            expression=RowNumber(),
+            partition_by=[F('pulsar'), F('pulsar_property__ephemeris_parameter_name')],
+            order_by=[
+                F('mjd').desc(nulls_last=True),
+                F('bibtex__year').desc(nulls_last=True),
+                F('id').desc(),
+            ],
+        ),
+    ).filter(
+        rank=1,
+    ).select_related(
+        'pulsar_property',
+    ).order_by('pulsar', 'pulsar_property__ephemeris_parameter_name')
+
+
+def ephemeris_measurements(pulsars):
+    '''
+    Returns a dictionary of {pulsar_id: [measurements]}, with the measurements
+    chosen by ephemeris_measurements_queryset()
+    '''
 
-    return True
+    chosen = defaultdict(list)
+    for measurement in ephemeris_measurements_queryset(pulsars):
+        chosen[measurement.pulsar_id].append(measurement)
 
-def update_atnf_fluxes():
+    return chosen
 
-    # Now grab the catalogue's contents
-    completed_process = subprocess.run(
-        ['psrcat', '-nonumber', '-nohead', '-o', 'short_error', '-c',
-         'bname jname S30 S40 S50 S60 S80 S100 S150 S200 S300 S350 S400 S600 S700 S800 S900 S1400 S1600 S2000 S3000 S4000 S5000 S6000 S8000 S10G S20G S50G S100G S150G'],
-        capture_output=True,
-    )
-    stdout = completed_process.stdout.decode("utf-8")
 
-    # ***WARNING***
-    # The below column indices may change for different versions of the catalogue!!
-    freqs = [30, 40, 50, 60, 80, 100, 150, 200, 300, 350, 400, 600, 700, 800, 900, 1400, 1600, 2000, 3000, 4000, 5000, 6000, 8000, 10000, 20000, 50000, 100000, 150000]
-    flux_cols = [2, 3, 5, 7, 9, 11, 13, 15, 17, 19, 21, 23, 25, 27, 29, 31, 33, 35, 37, 39, 41, 43, 45, 47, 48, 49, 50, 52]
-    error_cols = [None, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26, 28, 30, 32, 34, 36, 38, 40, 42, 44, 46, None, None, None, 51, 53]
+def par_file_lines(measurements):
+    return "".join([
+        f"{measurement.pulsar_property.ephemeris_parameter_name:<32} {measurement.value:>32}\n"
+        for measurement in measurements
+    ])
 
-    for line in stdout.split('\n'):
 
-        tokens = line.split()
+def par_file_header(pulsar):
+    header = ""
+    if pulsar.jname:
+        header += f"{'PSRJ':<32} {pulsar.jname:>32}\n"
+    if pulsar.bname:
+        header += f"{'PSRB':<32} {pulsar.bname:>32}\n"
+    return header
 
-        # Ignore problematic lines with too few tokens
-        if len(tokens) < 12:
-            continue
 
-        bname = None if tokens[0] == '*' else tokens[0]
-        jname = None if tokens[1] == '*' else tokens[1]
+def par_files(pulsars):
+    '''
+    Returns a dictionary of {pulsar: par file string} for the given pulsars.
+    Pulsars without any ephemeris measurements are omitted.
 
-        # Find the matching pulsar, otherwise ignore
-        pulsar = models.Pulsar.objects.filter(bname=bname, jname=jname).first()
-        if not pulsar:
-            continue
+    The measurement part of each par file is cached until any measurement
+    (or property, or bibtex) changes; see core.revisions.
+    '''
 
-        for i in range(len(freqs)):
-            freq = freqs[i]
-            try:
-                flux = float(tokens[flux_cols[i]])
-            except:
-                # If there's no flux for this frequency, skip this and go to the next frequency
-                continue
-            try:
-                error = float(tokens[error_cols[i]])
-            except:
-                # If there's no error, just set it to None
-                error = None
-
-            # Look for matching entries
-            atnf_flux_measurement = models.ATNFFluxMeasurement.objects.filter(pulsar=pulsar, freq=freq).first()
-
-            if atnf_flux_measurement is not None:
-                # Update the existing entry
-                atnf_flux_measurement.flux = flux
-                atnf_flux_measurement.error = error
-                print(f"Updating {atnf_flux_measurement}...")
-            else:
-                # Make a new entry
-                atnf_flux_measurement = models.ATNFFluxMeasurement(
-                    pulsar=pulsar,
-                    freq=freq,
-                    flux=flux,
-                    error=error,
-                )
-                print(f"Creating {atnf_flux_measurement}...")
-
-            atnf_flux_measurement.save()
-
-
-def import_atnf():
-
-    # Grab the ATNF catalogue number (this also tests whether psrcat is installed)
-    completed_process = subprocess.run(
-        ['psrcat', '-v'],
-        capture_output=True,
-    )
-    stdout = completed_process.stdout.decode("utf-8")
-    catalogue_version = stdout.split()[-1]
+    revision = revisions.get_revision(revisions.MEASUREMENTS)
+    keys = {pulsar.pk: f"ephemeris:{revision}:{pulsar.pk}" for pulsar in pulsars}
+    cached = cache.get_many(keys.values())
+
+    missing = [pulsar.pk for pulsar in pulsars if keys[pulsar.pk] not in cached]
+    if missing:
+        chosen = ephemeris_measurements(missing)
+        new_entries = {keys[pk]: par_file_lines(chosen.get(pk, [])) for pk in missing}
+        cache.set_many(new_entries)
+        cached.update(new_entries)
+
+    return {
+        pulsar: par_file_header(pulsar) + cached[keys[pulsar.pk]]
+        for pulsar in pulsars
+        if cached[keys[pulsar.pk]]
+    }
 
-    # Now grab the catalogue's contents
-    completed_process = subprocess.run(
-        ['psrcat', '-nonumber', '-nohead', '-o', 'short_error', '-c', 'bname jname rajd decjd p0 dm rm'],
-        capture_output=True,
-    )
-    stdout = completed_process.stdout.decode("utf-8")
 
-    atnf_pulsars = []
-    bnames = []
-    jnames = []
+def construct_ephemeris(request, pk):
 
-    for line in stdout.split('\n'):
+    pulsar = models.Pulsar.objects.filter(pk=pk).first()
+    if not pulsar:
+        return HttpResponseBadRequest(f"Pulsar ID {pk} not found")
 
-        tokens = line.split()
+    measurements = ephemeris_measurements([pulsar])[pulsar.pk]
+    if not measurements:
+        return HttpResponseBadRequest(f"{pulsar} does not have any measurements")
 
-        # Ignore problematic lines with too few tokens
-        if len(tokens) < 12:
-            continue
+    context = {
+        'pulsar': pulsar,
+        'measurements': measurements,
+    }
 
-        bname = None if tokens[0] == '*' else tokens[0]
-        jname = None if tokens[1] == '*' else tokens[1]
+    return render(request, 'construct_ephemeris.html', context)
 
+
+def ephemeris_export(request):
+    '''
+    Bundles the par files of many pulsars into a single archive.
+
+    GET parameters:
+      pulsar   Pulsar ID, Bname or Jname (repeatable)
+      format   "zip" (default) or "tar" (gzipped)
+    '''
+
+    names = request.GET.getlist("pulsar")
+    if not names:
+        return HttpResponseBadRequest("At least one pulsar must be given")
+
+    archive_format = request.GET.get("format", "zip")
+    if archive_format not in ("zip", "tar"):
+        return HttpResponseBadRequest("format must be one of 'zip', 'tar'")
+
+    revision, keys = measurements_revision()
+    response = httpcache.not_modified(request, revision)
+    if response is not None:
+        return httpcache.cache_headers(response, revision, keys)
+
+    ids = [_parse_id(name) for name in names if _parse_id(name) is not None]
+    names = [name for name in names if _parse_id(name) is None]
+    pulsars = models.Pulsar.objects.filter(Q(pk__in=ids) | Q(bname__in=names) | Q(jname__in=names))
+
+    files = par_files(list(pulsars))
+    if not files:
+        return HttpResponseBadRequest("None of the requested pulsars have any measurements")
+
+    buffer = io.BytesIO()
+    if archive_format == "zip":
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for pulsar, par in files.items():
+                archive.writestr(f"{pulsar.name}.par", par)
+        filename = "ephemerides.zip"
+    else:
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            for pulsar, par in files.items():
+                data = par.encode("utf-8")
+                info = tarfile.TarInfo(name=f"{pulsar.name}.par")
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        filename = "ephemerides.tar.gz"
+
+    buffer.seek(0)
+    response = FileResponse(buffer, as_attachment=True, filename=filename)
+    return httpcache.cache_headers(response, revision, keys)
+
+
+def measurements_revision():
+    '''
+    The revision of the measurements (which are listed with their pulsars'
+    names), and the surrogate keys of the responses made from them
+    '''
+
+    revision = f"{revisions.get_revision(revisions.MEASUREMENTS)}-{revisions.get_revision(revisions.CATALOGUE)}"
+    return revision, [httpcache.MEASUREMENTS, httpcache.CATALOGUE]
+
+
+def _parse_id(value):
+    '''
+    Returns value as a primary key, or None if it isn't one (e.g. it's a name,
+    or a number too big for the database)
+    '''
+    if not value.isdecimal():
+        return None
+    pk = int(value)
+    return pk if pk < 2**63 else None
+
+
+def _parse_float(value):
+    '''
+    Returns value as a float, or None if it can't be interpreted as one
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _unit_scale(measurement, scales):
+    '''
+    The factor that converts the measurement's value (and errors) from its own
+    unit to its property's, or None if they aren't convertible. scales caches
+    the factors by pair of units.
+    '''
+
+    prop_unit = measurement.pulsar_property.unit or ""
+    unit = measurement.unit or prop_unit
+    if unit == prop_unit:
+        return 1.0
+
+    if (unit, prop_unit) not in scales:
+        import astropy.units as u
         try:
-            ra = float(tokens[2])
-        except:
-            ra = None
-        try:
-            dec = float(tokens[4])
-        except:
-            dec = None
-        try:
-            period = float(tokens[6])
-        except:
-            period = None
-        try:
-            dm = float(tokens[8])
-        except:
-            dm = None
-        try:
-            dm_error = float(tokens[9])
-        except:
-            dm_error = None
-        try:
-            rm = float(tokens[10])
-        except:
-            rm = None
-        try:
-            rm_error = float(tokens[11])
-        except:
-            rm_error = None
-
-        print(f"Importing {bname}...")
-
-        atnf_pulsars.append(
-            models.Pulsar(
-                bname=bname,
-                jname=jname,
-                ra=ra,
-                dec=dec,
-                period=period,
-                dm=dm,
-                dm_error=dm_error,
-                rm=rm,
-                rm_error=rm_error,
-                catalogue_version=catalogue_version,
-            )
+            scales[(unit, prop_unit)] = u.Unit(unit).to(u.Unit(prop_unit))
+        except (ValueError, TypeError, u.UnitsError):
+            scales[(unit, prop_unit)] = None
+
+    return scales[(unit, prop_unit)]
+
+
+def measurement_dict(measurement):
+
+    return {
+        'id': measurement.id,
+        'pulsar_id': measurement.pulsar_id,
+        'pulsar': measurement.pulsar.name,
+        'property': measurement.pulsar_property.name,
+        'ephemeris_parameter_name': measurement.pulsar_property.ephemeris_parameter_name,
+        'value': measurement.value,
+        'error': measurement.error,
+        'error_low': measurement.error_low,
+        'is_lower_limit': measurement.is_lower_limit,
+        'is_upper_limit': measurement.is_upper_limit,
+        'mode': measurement.mode,
+        'unit': measurement.unit or measurement.pulsar_property.unit,
+        'freq_MHz': measurement.freq_MHz,
+        'bandwidth_MHz': measurement.bandwidth_MHz,
+        'mjd': measurement.mjd,
+        'time_span_s': measurement.time_span_s,
+        'bibtex': measurement.bibtex.citekey,
+    }
+
+
+def filter_measurements(params):
+    '''
+    Applies the measurement API's GET filters to the PulsarPropertyMeasurement table.
+    Raises ValueError if any of the numerical filters can't be parsed.
+
+    A measurement matches a frequency range if any part of its band
+    (freq_MHz ± bandwidth_MHz/2) overlaps the requested range.
+    '''
+
+    measurements = models.PulsarPropertyMeasurement.objects.select_related(
+        'pulsar', 'pulsar_property', 'bibtex',
+    )
+
+    pulsar = params.get("pulsar")
+    if pulsar:
+        if _parse_id(pulsar) is not None:
+            measurements = measurements.filter(pulsar_id=_parse_id(pulsar))
+        else:
+            measurements = measurements.filter(Q(pulsar__bname=pulsar) | Q(pulsar__jname=pulsar))
+
+    pulsar_property = params.get("property")
+    if pulsar_property:
+        measurements = measurements.filter(
+            Q(pulsar_property__name=pulsar_property) |
+            Q(pulsar_property__symbol=pulsar_property) |
+            Q(pulsar_property__ephemeris_parameter_name=pulsar_property)
         )
 
-        bnames.append(bname)
-        jnames.append(jname)
+    bibtex = params.get("bibtex")
+    if bibtex:
+        measurements = measurements.filter(bibtex__citekey=bibtex)
 
-    duplicates = models.Pulsar.objects.filter(Q(bname__in=bnames) | Q(jname__in=jnames))
-    duplicate_names = [p.name for p in duplicates]
-    new_pulsars = [p for p in atnf_pulsars if p.name not in duplicate_names]
-    models.Pulsar.objects.bulk_create(new_pulsars)
+    if params.get("freq_min"):
+        freq_min = float(params.get("freq_min"))
+        measurements = measurements.filter(
+            Q(freq_MHz__gte=freq_min) |
+            Q(bandwidth_MHz__isnull=False, freq_MHz__gte=freq_min - F('bandwidth_MHz')/2)
+        )
 
+    if params.get("freq_max"):
+        freq_max = float(params.get("freq_max"))
+        measurements = measurements.filter(
+            Q(freq_MHz__lte=freq_max) |
+            Q(bandwidth_MHz__isnull=False, freq_MHz__lte=freq_max + F('bandwidth_MHz')/2)
+        )
 
-def import_spectra():
+    if params.get("mjd_min"):
+        measurements = measurements.filter(mjd__gte=float(params.get("mjd_min")))
 
-    cat_dict = collect_catalogue_fluxes()
-    pulsars = models.Pulsar.objects.all()
-    for pulsar in pulsars:
-        print(pulsar)
-        try:
-            freqs, bands, fluxs, flux_errs, refs = cat_dict[pulsar.jname]
-            best_model_name, iminuit_result, fit_info, p_best, p_category = find_best_spectral_fit(
-                pulsar.name,
-                freqs,
-                bands,
-                fluxs,
-                flux_errs,
-                refs,
-                plot_best=False
-            )
-
-        except:
+    if params.get("mjd_max"):
+        measurements = measurements.filter(mjd__lte=float(params.get("mjd_max")))
+
+    return measurements
+
+
+def aggregate_weighted_mean(measurements):
+    '''
+    Inverse-variance weighted mean of the numerical values of each (pulsar, property) pair.
+    The values are converted to their property's unit first. Limits and
+    non-numerical values (or units) are ignored. If any of the contributing
+    measurements are missing errors, an unweighted mean is used instead.
+    '''
+
+    groups = defaultdict(list)
+    scales = {}
+    for measurement in measurements:
+        if measurement.is_lower_limit or measurement.is_upper_limit:
+            continue
+        value = _parse_float(measurement.value)
+        scale = _unit_scale(measurement, scales)
+        if value is None or scale is None:
             continue
+        groups[(measurement.pulsar_id, measurement.pulsar_property_id)].append((measurement, scale))
+
+    results = []
+    for group in groups.values():
+        values = np.array([_parse_float(m.value)*scale for m, scale in group])
+        errors = np.array([(_parse_float(m.error) or np.nan)*scale for m, scale in group])
+        group = [m for m, _ in group]
+
+        if np.all(errors > 0):
+            weights = 1/errors**2
+            mean = np.sum(weights*values) / np.sum(weights)
+            error = np.sqrt(1/np.sum(weights))
+        else:
+            mean = np.mean(values)
+            error = np.std(values, ddof=1)/np.sqrt(len(values)) if len(values) > 1 else None
+
+        first = group[0]
+        results.append({
+            'pulsar_id': first.pulsar_id,
+            'pulsar': first.pulsar.name,
+            'property': first.pulsar_property.name,
+            'ephemeris_parameter_name': first.pulsar_property.ephemeris_parameter_name,
+            'unit': first.pulsar_property.unit,
+            'value': float(mean),
+            'error': float(error) if error is not None else None,
+            'num_measurements': len(group),
+            'bibtex': [m.bibtex.citekey for m in group],
+        })
+
+    return results
+
+
+def aggregate_latest(measurements):
+    '''
+    The measurement with the most recent MJD for each (pulsar, property) pair
+    '''
+
+    latest = {}
+    for measurement in measurements.filter(mjd__isnull=False).order_by('pulsar', 'pulsar_property', '-mjd'):
+        key = (measurement.pulsar_id, measurement.pulsar_property_id)
+        if key not in latest:
+            latest[key] = measurement
+
+    return [measurement_dict(measurement) for measurement in latest.values()]
+
+
+def aggregate_spectrum(measurements):
+    '''
+    The numerical values of each (pulsar, property) pair as a function of
+    frequency, converted to the property's unit
+    '''
 
-        # Find the django counterpart of the spectrum model
-        spectrum_model = models.SpectrumModel.objects.filter(pulsar_spectra_name=best_model_name).first()
-        if not spectrum_model:
-            print(f"Couldn't find SpectrumModel {best_model_name}")
+    groups = defaultdict(list)
+    scales = {}
+    for measurement in measurements.filter(freq_MHz__isnull=False).order_by('pulsar', 'pulsar_property', 'freq_MHz'):
+        value = _parse_float(measurement.value)
+        scale = _unit_scale(measurement, scales)
+        if value is None or scale is None:
             continue
-        pulsar.spectrum_model = spectrum_model
-        pulsar.save()
-        for p, v, _ in zip(iminuit_result.parameters, iminuit_result.values, iminuit_result.errors):
-            fit = models.SpectralFit.objects.filter(pulsar=pulsar, parameter__name=p).first()
-            if fit:
-                # Update the value
-                fit.value=v
-            else:
-                # Find a matching parameter object, or create a new one
-                parameter = models.SpectrumModelParameter.objects.filter(
-                    spectrum_model=spectrum_model,
-                    name=p,
-                ).first()
-
-                if not parameter:
-                    # Create a new parameter
-                    parameter = models.SpectrumModelParameter(
-                        spectrum_model=spectrum_model,
-                        name=p,
-                    )
-                    parameter.save()
-
-                # And a new fit
-                fit = models.SpectralFit(pulsar=pulsar, parameter=parameter, value=v)
-                fit.save()
+        groups[(measurement.pulsar_id, measurement.pulsar_property_id)].append((measurement, scale))
+
+    results = []
+    for group in groups.values():
+        values = [_parse_float(m.value)*scale for m, scale in group]
+        errors = [_parse_float(m.error) for m, _ in group]
+        errors = [error*scale if error is not None else None for error, (_, scale) in zip(errors, group)]
+        group = [m for m, _ in group]
+        first = group[0]
+        results.append({
+            'pulsar_id': first.pulsar_id,
+            'pulsar': first.pulsar.name,
+            'property': first.pulsar_property.name,
+            'unit': first.pulsar_property.unit,
+            'freq_MHz': [m.freq_MHz for m in group],
+            'bandwidth_MHz': [m.bandwidth_MHz for m in group],
+            'value': values,
+            'error': errors,
+            'bibtex': [m.bibtex.citekey for m in group],
+        })
+
+    return results
+
+
+MEASUREMENT_AGGREGATES = {
+    'weighted_mean': aggregate_weighted_mean,
+    'latest': aggregate_latest,
+    'spectrum': aggregate_spectrum,
+}
+
+
+def measurements_api(request):
+    '''
+    Paginated, filterable JSON view of PulsarPropertyMeasurements.
+
+    GET parameters:
+      pulsar             Pulsar ID, Bname or Jname
+      property           PulsarProperty name, symbol or ephemeris parameter name
+      bibtex             Bibtex citekey
+      freq_min, freq_max Frequency range (MHz)
+      mjd_min, mjd_max   MJD range
+      aggregate          One of "weighted_mean", "latest", "spectrum"
+      page, page_size    Pagination (page_size is capped at 1000)
+    '''
 
+    revision, keys = measurements_revision()
+    response = httpcache.not_modified(request, revision)
+    if response is not None:
+        return httpcache.cache_headers(response, revision, keys)
 
-def construct_ephemeris(request, pk):
+    try:
+        measurements = filter_measurements(request.GET)
+    except ValueError:
+        return HttpResponseBadRequest("Could not parse frequency/MJD range")
+
+    aggregate = request.GET.get("aggregate")
+    if aggregate:
+        if aggregate not in MEASUREMENT_AGGREGATES:
+            return HttpResponseBadRequest(f"Unknown aggregate '{aggregate}'. Choose from {list(MEASUREMENT_AGGREGATES)}")
+        results = MEASUREMENT_AGGREGATES[aggregate](measurements)
+    else:
+        results = measurements
 
-    pulsar = models.Pulsar.objects.get(pk=pk)
-    if not pulsar:
-        return HttpResponseBadRequest(f"Pulsar ID {pk} not found")
+    try:
+        page_size = min(int(request.GET.get("page_size", 100)), 1000)
+    except ValueError:
+        return HttpResponseBadRequest("page_size must be an integer")
+    if page_size < 1:
+        return HttpResponseBadRequest("page_size must be at least 1")
 
-    measurements = models.PulsarPropertyMeasurement.objects.filter(pulsar=pulsar, pulsar_property__ephemeris_parameter_name__isnull=False)
-    if not measurements.exists():
-        return HttpResponseBadRequest(f"{pulsar} does not have any measurements")
+    paginator = Paginator(results, page_size)
+    page = paginator.get_page(request.GET.get("page"))
 
-    context = {
-        'pulsar': pulsar,
-        'measurements': measurements,
-    }
+    if aggregate:
+        page_results = list(page.object_list)
+    else:
+        page_results = [measurement_dict(measurement) for measurement in page.object_list]
+
+    response = JsonResponse({
+        'count': paginator.count,
+        'num_pages': paginator.num_pages,
+        'page': page.number,
+        'aggregate': aggregate,
+        'results': page_results,
+    })
+    return httpcache.cache_headers(response, revision, keys)
 
-    return render(request, 'construct_ephemeris.html', context)
 
+def catalogue_export(request):
+    '''
+    Streams the catalogue, with each pulsar's active spectral fit and
+    predicted flux densities, as a file download.
+
+    GET parameters:
+      format    One of "csv" (default), "votable", "arrow", "parquet"
+      freq      Frequency (MHz) to predict flux densities at (repeatable)
+      min_flux  Only export pulsars whose flux density (Jy) at one of the frequencies
+                is at least this...
+      sigma     ...after subtracting sigma times its uncertainty (default 0)
+    '''
+
+    export_format = request.GET.get("format", "csv")
+    if export_format not in export.EXPORT_FORMATS:
+        return HttpResponseBadRequest(f"Unknown format '{export_format}'. Choose from {list(export.EXPORT_FORMATS)}")
+
+    freqs = [_parse_float(freq) for freq in request.GET.getlist("freq")]
+    if any(freq is None or freq <= 0 for freq in freqs):
+        return HttpResponseBadRequest("Frequencies must be positive numbers (in MHz)")
+    if len(freqs) > export.EXPORT_MAX_FREQS:
+        return HttpResponseBadRequest(f"At most {export.EXPORT_MAX_FREQS} frequencies can be requested")
+
+    threshold = _parse_flux_threshold(request.GET)
+    if threshold is None:
+        return HttpResponseBadRequest("min_flux (Jy) must be a number and sigma a non-negative number")
+    min_flux, sigma = threshold
+
+    revision = revisions.get_revision(revisions.CATALOGUE)
+    response = httpcache.not_modified(request, revision)
+    if response is not None:
+        return httpcache.cache_headers(response, revision, [httpcache.CATALOGUE])
+
+    try:
+        content = export.export(export_format, freqs, min_flux=min_flux, sigma=sigma)
+    except export.ExportUnavailable as e:
+        return HttpResponse(str(e), status=501)
 
-def init_spectrum_models():
-
-    spl = models.SpectrumModel.objects.create(name="Simple power law", pulsar_spectra_name="simple_power_law")
-    aspl = models.SpectrumModel.objects.create(name="ATNF simple power law", pulsar_spectra_name="simple_power_law")
-    bpl = models.SpectrumModel.objects.create(name="Broken power law", pulsar_spectra_name="broken_power_law")
-    dto = models.SpectrumModel.objects.create(name="Double turn-over", pulsar_spectra_name="double_turn_over_spectrum")
-    hfco = models.SpectrumModel.objects.create(name="High frequency cut-off power law", pulsar_spectra_name="high_frequency_cut_off_power_law")
-    lp = models.SpectrumModel.objects.create(name="Log-parabolic", pulsar_spectra_name="log_parabolic_spectrum")
-    lfto = models.SpectrumModel.objects.create(name="Low frequency turn-over power law", pulsar_spectra_name="low_frequency_turn_over_power_law")
-
-    bpl.parameters.create(name='vb')
-    bpl.parameters.create(name='a1')
-    bpl.parameters.create(name='a2')
-    bpl.parameters.create(name='c')
-    bpl.parameters.create(name='v0')
-
-    dto.parameters.create(name='vc')
-    dto.parameters.create(name='vpeak')
-    dto.parameters.create(name='a')
-    dto.parameters.create(name='beta')
-    dto.parameters.create(name='c')
-    dto.parameters.create(name='v0')
-
-    hfco.parameters.create(name='vc')
-    hfco.parameters.create(name='a')
-    hfco.parameters.create(name='c')
-    hfco.parameters.create(name='v0')
-
-    lp.parameters.create(name='a')
-    lp.parameters.create(name='b')
-    lp.parameters.create(name='c')
-    lp.parameters.create(name='v0')
-
-    lfto.parameters.create(name='vpeak')
-    lfto.parameters.create(name='a')
-    lfto.parameters.create(name='c')
-    lfto.parameters.create(name='beta')
-    lfto.parameters.create(name='v0')
-
-    spl.parameters.create(name='a')
-    spl.parameters.create(name='c')
-    spl.parameters.create(name='v0')
-
-    aspl.parameters.create(name='a')
-    aspl.parameters.create(name='c')
-    aspl.parameters.create(name='v0')
+    content_type, extension, _ = export.EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="pulsar-sky.{extension}"'
 
+    return httpcache.cache_headers(response, revision, [httpcache.CATALOGUE])
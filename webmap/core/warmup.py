@@ -0,0 +1,99 @@
+'''
+Warming up the caches, so that the first requests after a deploy or a refresh
+of the data don't pay for building everything:
+
+  - the snapshot of the catalogue on disk (with the map's payload and the
+    flux densities at the common frequencies precomputed) is brought up to
+    date, so that the workers only have to memory-map it, and
+  - the details and spectrum plots of the brightest pulsars are cached.
+
+Once a warm-up has finished, it writes settings.WARM_UP_READY_FILE, which the
+readiness endpoint (core.views.ready) checks for. The entrypoint removes the
+file before starting the server, so that a new deployment isn't reported as
+ready until it has been warmed up.
+
+preload() is the per-process counterpart: under uwsgi, it loads the app and
+the snapshot in the master before it forks the workers, so that they start
+with them already loaded, sharing the memory (copy-on-write) instead of each
+loading its own copy.
+'''
+
+from django.conf import settings
+from django.db import connections
+from django.urls import get_resolver
+
+from . import plots
+from . import revisions
+from . import snapshot
+from .jobs import Job
+
+import gc
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def mark_ready(revision):
+    path = settings.WARM_UP_READY_FILE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({'revision': revision, 'time': time.time()}, f)
+    os.replace(tmp_path, path)
+
+
+def readiness():
+    '''
+    The contents of the ready file written by the last warm-up ({"revision":
+    ..., "time": ...}), or None if there hasn't been one since deployment
+    '''
+
+    try:
+        with open(settings.WARM_UP_READY_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def warm_up(job=None):
+
+    with (job or Job("warm_up")) as job:
+        revision = revisions.get_revision(revisions.CATALOGUE)
+
+        with job.stage("snapshot"):
+            current = snapshot.load_current(revision)
+        if current is None:
+            snapshot.write_snapshot(job=job)
+        else:
+            job.write(f"warm_up: snapshot {current.path} is up to date")
+
+        plots.warm_spectrum_plots(job=job)
+
+        mark_ready(revision)
+        job.write("warm_up: ready")
+
+
+def preload():
+    '''
+    Loads every view and the current snapshot of the catalogue (with the map's
+    payload) into this process, for processes that fork workers. Anything that
+    can't be loaded yet (e.g. before the first snapshot has been written) is
+    left for the workers to load for themselves.
+    '''
+
+    get_resolver().url_patterns
+    try:
+        snapshot.get_snapshot().map_json
+    except Exception:
+        logger.exception("preload: couldn't load the snapshot of the catalogue")
+    finally:
+        # The workers mustn't share the master's database connections
+        connections.close_all()
+
+    # Keep the loaded objects out of the garbage collector's generations, so
+    # that collections in the workers don't write to (and so copy) their pages
+    gc.freeze()
@@ -8,14 +8,41 @@ if [ ! -e /$CONTAINER_FIRST_STARTUP ]; then
 
     python manage.py makemigrations
     python manage.py migrate
-    python manage.py collectstatic --no-input
 fi
 
+# Collect the static files on every start-up, so that changed files get new hashed names.
+# The vendored libraries are committed, so this only checks them against their
+# digests (without downloading anything), and refuses to start if they don't match
+python manage.py vendor_static --check
+python manage.py collectstatic --no-input
+
+# Clear the front proxy's cache of pages from the previous deployment (see nginx/pulsar-sky.conf)
+if [ -n "$PROXY_CACHE_DIR" ] && [ -d "$PROXY_CACHE_DIR" ]; then
+    find "$PROXY_CACHE_DIR" -type f -delete
+fi
+
+# Warm up the caches alongside the server; /ready reports ready once this has finished
+rm -f "${PIPELINE_STATE_DIR:-/tmp/pulsar-sky-pipeline}/warm-up-ready.json"
+# Start the request metrics afresh (see core/metrics.py)
+rm -rf "${METRICS_DIR:-/tmp/pulsar-sky-metrics}"
+python3 manage.py run_job warm_up --no-progress &
+
 if [ "$DJANGO_DEBUG" == "True" ]
 then
-    # This runs the web app locally through Django
+    # This runs the web app locally through Django, with a background job worker
+    python3 manage.py run_worker &
     python3 manage.py runserver 0.0.0.0:8000
+elif [ "$PULSARSKY_SERVER" == "asgi" ]
+then
+    # This runs the webapp as an ASGI app (so that the async views can serve
+    # many concurrent clients) with uvicorn, which creates a socket that nginx
+    # proxies HTTP to
+    python3 manage.py run_worker --processes 2 &
+    uvicorn webmap.asgi:application --uds /tmp/uwsgi/pulsar-sky-asgi.sock --workers ${ASGI_WORKERS:-2} --lifespan off
 else
     # This runs the webapp using uwsgi and creates a socket that nginx uses
-    uwsgi --ini /pulsar-sky/pulsar-sky.uwsgi.ini
+    uwsgi --ini /pulsar-sky/pulsar-sky.uwsgi.ini \
+        ${WSGI_PROCESSES:+--processes "$WSGI_PROCESSES"} \
+        ${WSGI_THREADS:+--threads "$WSGI_THREADS"} \
+        ${WSGI_HARAKIRI:+--harakiri "$WSGI_HARAKIRI"}
 fi
@@ -369,6 +369,10 @@ class Bibtex(models.Model):
         verbose_name = "BibTeX"
         verbose_name_plural = "BibTeX"
         ordering = ("citekey",)
+        indexes = [
+            # For ordering measurements by publication year
+            models.Index(fields=["year"], name="bibtex_year_idx"),
+        ]
 
 
 class Author(models.Model):
@@ -48,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "core.metrics.RequestMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -57,6 +58,27 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
+# Request instrumentation (see core/metrics.py)
+# Requests making more than QUERY_BUDGET database queries are logged as warnings
+QUERY_BUDGET = int(os.environ.get("DJANGO_QUERY_BUDGET", 50))
+
+# The client addresses allowed to read the /metrics endpoint
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1'] + os.environ.get("METRICS_ALLOWED_IPS", "").split()
+# Where each worker process keeps its accumulated metrics, for /metrics to add up
+METRICS_DIR = os.environ.get("METRICS_DIR", "/tmp/pulsar-sky-metrics")
+# How often (seconds) each worker process saves its metrics there
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+
+# Ingestion pipeline (see core/pipeline.py)
+PIPELINE_STATE_DIR = os.environ.get("PIPELINE_STATE_DIR", "/tmp/pulsar-sky-pipeline")
+PIPELINE_LOCK_FILE = os.path.join(PIPELINE_STATE_DIR, "refresh.lock")
+PIPELINE_CHECKPOINT_FILE = os.path.join(PIPELINE_STATE_DIR, "refresh-checkpoint.json")
+# Written once the caches have been warmed up (see core/warmup.py); the entrypoint removes it on start-up
+WARM_UP_READY_FILE = os.path.join(PIPELINE_STATE_DIR, "warm-up-ready.json")
+
+# The directory the catalogue snapshot files are written to (see core/snapshot.py)
+CATALOGUE_SNAPSHOT_DIR = os.environ.get("CATALOGUE_SNAPSHOT_DIR", "/tmp/pulsar-sky-snapshots")
+
 ROOT_URLCONF = "webmap.urls"
 
 TEMPLATES = [
@@ -93,6 +115,36 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+#
+# A file-based cache is shared by all the uwsgi worker processes in the
+# container, so that invalidation (see core/revisions.py) reaches every worker.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.environ.get("DJANGO_CACHE_DIR", "/tmp/pulsar-sky-cache"),
+        "TIMEOUT": None,
+        "OPTIONS": {
+            "MAX_ENTRIES": 100000,
+        },
+    }
+}
+
+# Caching of the public pages and APIs by the front proxy (see core/httpcache.py
+# and nginx/pulsar-sky.conf): how long (s) browsers and the proxy may use a
+# response before revalidating it, and how long the proxy may go on serving a
+# stale one while it revalidates it in the background
+HTTP_CACHE_MAX_AGE = int(os.environ.get("HTTP_CACHE_MAX_AGE", 60))
+HTTP_CACHE_S_MAXAGE = int(os.environ.get("HTTP_CACHE_S_MAXAGE", 600))
+HTTP_CACHE_STALE_WHILE_REVALIDATE = int(os.environ.get("HTTP_CACHE_STALE_WHILE_REVALIDATE", 30))
+
+# The front proxy's cache directory, shared with the app, so that the ingestion
+# pipeline can purge it (unset: don't purge)
+PROXY_CACHE_DIR = os.environ.get("PROXY_CACHE_DIR")
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -141,6 +193,17 @@ else:
 STATIC_URL = "static/"
 MEDIA_URL = "media/"
 
+# Static files get content-hashed names (and compressed copies) when collected,
+# so that they can be cached forever; see core/staticassets.py
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "core.staticassets.CompressedManifestStaticFilesStorage",
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
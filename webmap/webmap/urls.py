@@ -20,9 +20,14 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic import RedirectView
 
+from core.metrics import metrics
+from core.views import ready
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("map/", include('core.urls')),
+    path("metrics", metrics, name='metrics'),
+    path("ready", ready, name='ready'),
     re_path(r'^$', RedirectView.as_view(url='map/')),
 ]
 
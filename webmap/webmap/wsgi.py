@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webmap.settings")
 
 application = get_wsgi_application()
+
+# Under uwsgi (see pulsar-sky.uwsgi.ini), this module is loaded in the master
+# before it forks the workers, so load everything the workers need up front
+if os.environ.get("PULSARSKY_PRELOAD") == "1":
+    from core import warmup
+    warmup.preload()